@@ -0,0 +1,107 @@
+"""Admission control and pacing for /room/wait and /room/result polling
+
+Each token may poll at `rate` per second with bursts of `burst`; polls
+over that are rejected with 429 and the seconds until the next one is
+allowed. Polls are also shed when `max_inflight` of them are already
+reading the database. The same in-flight count drives next_poll_delay(),
+the delay handed to clients in the responses, so clients slow down
+before polls have to be rejected.
+"""
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+
+class PollRates:
+    """Per-token poll rate, one float per token (GCRA)
+
+    Keeps the "theoretical arrival time" of the next poll under the hash
+    of the token, so the token strings themselves are not held. A bucket
+    whose time has passed is the same as an empty one, so when
+    `max_tokens` is reached those are dropped first, then the oldest.
+    """
+
+    def __init__(self, rate: float, burst: int, max_tokens: int = 100_000):
+        self.interval = 1.0 / rate
+        self.tolerance = self.interval * (burst - 1)
+        self.max_tokens = max_tokens
+        self._lock = threading.Lock()
+        self._tat: dict[int, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._tat)
+
+    def hit(self, token: str, now: Optional[float] = None) -> float:
+        """Count a poll; returns 0 if allowed, else seconds to wait"""
+        if now is None:
+            now = time.monotonic()
+        key = hash(token)
+        with self._lock:
+            tat = max(self._tat.pop(key, now), now)
+            if tat - now > self.tolerance:
+                self._tat[key] = tat
+                return tat - now - self.tolerance
+            if len(self._tat) >= self.max_tokens:
+                self._evict(now)
+            self._tat[key] = tat + self.interval
+            return 0.0
+
+    def _evict(self, now: float) -> None:
+        expired = [key for key, tat in self._tat.items() if tat <= now]
+        for key in expired:
+            del self._tat[key]
+        while len(self._tat) >= self.max_tokens:
+            # 挿入順 (= 最後に poll した順) で一番古いもの
+            del self._tat[next(iter(self._tat))]
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        max_inflight: int,
+        max_tokens: int = 100_000,
+        shed_retry_after: float = 1.0,
+    ):
+        self.rates = PollRates(rate, burst, max_tokens)
+        self.max_inflight = max_inflight
+        self.shed_retry_after = shed_retry_after
+        self._inflight = 0
+        self._lock = threading.Lock()
+
+    def admit(self, token: str) -> tuple[float, Optional[str]]:
+        """(0, None) to serve the poll, else (Retry-After seconds, reason)"""
+        if self._inflight >= self.max_inflight:
+            return (self.shed_retry_after, "overload")
+        wait = self.rates.hit(token)
+        if wait > 0:
+            return (wait, "rate")
+        return (0.0, None)
+
+    @contextmanager
+    def track(self) -> Iterator[None]:
+        """Count a poll as in flight while it reads the database"""
+        with self._lock:
+            self._inflight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._inflight -= 1
+
+    def load(self) -> float:
+        """In-flight polls relative to max_inflight, 0.0 to 1.0"""
+        return min(self._inflight / self.max_inflight, 1.0)
+
+    def next_poll_delay(self, base: float, factor: float, maximum: float) -> float:
+        """`base` stretched by up to (1 + factor) times as load rises"""
+        return min(base * (1 + factor * self.load()), maximum)
+
+
+def retry_after_header(seconds: float) -> str:
+    # Retry-After は整数秒
+    return str(max(1, math.ceil(seconds)))
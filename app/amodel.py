@@ -0,0 +1,353 @@
+"""Awaitable versions of the functions in model
+
+When DB_ASYNC is enabled the model cores (model._create_room, ...) run on
+the async engine through AsyncConnection.run_sync, so no worker thread is
+blocked while waiting for the database. Otherwise the plain model
+functions are called on the threadpool, which is what FastAPI does for
+`def` endpoints.
+
+What happens after a commit (notifications, caches, open_rooms, room
+events) is not repeated here: both paths call the same model helpers
+(model._room_created, _room_joined, _room_left, _store_result, ...).
+"""
+
+import asyncio
+import functools
+from typing import Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.exc import IntegrityError
+
+from . import config, model
+from .db import async_engine
+from .model import JoinRoomResult, LiveDifficulty
+from .storage import begin_read_async
+
+
+def _sync_fallback(sync_fn):
+    def decorator(async_fn):
+        @functools.wraps(async_fn)
+        async def wrapper(*args):
+            if async_engine is None:
+                return await run_in_threadpool(sync_fn, *args)
+            return await async_fn(*args)
+
+        return wrapper
+
+    return decorator
+
+
+async def _run(fn, *args):
+    async with async_engine.begin() as conn:
+        return await conn.run_sync(fn, *args)
+
+
+async def _run_on(shard, token: Optional[str], fn, *args):
+    """_run on the database of a room shard"""
+    if shard.index and token is not None:
+        # シャードには user がないので, 先に主 DB からキャッシュに載せる
+        await get_user_by_token(token)
+    async with shard.async_engine.begin() as conn:
+        return await conn.run_sync(fn, *args)
+
+
+async def _read_on(shard, token: Optional[str], keys: tuple, fn, *args):
+    """_run_on for a read-only transaction, which may go to a replica"""
+    engine = model._read_async_engine(shard, *keys)
+    if token is not None and (shard.index or engine is not shard.async_engine):
+        # レプリカに届いていないユーザーを読み直すと同期エンジンになるので先に
+        await get_user_by_token(token)
+    async with begin_read_async(engine) as conn:
+        return await conn.run_sync(fn, *args)
+
+
+async def _read_primary(shard, fn, *args):
+    """_run_on for a read-only transaction on the shard's own database"""
+    async with begin_read_async(shard.async_engine) as conn:
+        return await conn.run_sync(fn, *args)
+
+
+def _room_shard(room_id: int):
+    return model.room_shards.for_room(room_id)
+
+
+async def _gather_room_list(live_id: int, cursor: int, limit: int) -> list:
+    pages = await asyncio.gather(
+        *(
+            _read_on(
+                shard,
+                None,
+                (model._lobby_key(live_id),),
+                model._get_room_list,
+                live_id,
+                cursor,
+                limit,
+            )
+            for shard in model.room_shards
+        )
+    )
+    return model._merge_room_lists(pages, limit)
+
+
+@_sync_fallback(model.create_user)
+async def create_user(name: str, leader_card_id: int) -> str:
+    token = await _run(model._create_user, name, leader_card_id)
+    model._wrote(token)
+    return token
+
+
+@_sync_fallback(model.create_users)
+async def create_users(users: list[tuple[str, int]]) -> list[str]:
+    tokens = await _run(model._create_users, users)
+    model._wrote(*tokens)
+    return tokens
+
+
+@_sync_fallback(model.get_user_by_token)
+async def get_user_by_token(token: str):
+    user = model.user_cache.get(token)
+    if user is not None:
+        return user
+    if model.replicas is not None:
+        read = model.replicas.async_engine(token)
+        if read is not async_engine:
+            async with begin_read_async(read) as conn:
+                user = await conn.run_sync(model._load_user, token)
+            if user is not None:
+                return user
+    async with begin_read_async(async_engine) as conn:
+        return await conn.run_sync(model._load_user, token)
+
+
+@_sync_fallback(model.update_user)
+async def update_user(token: str, name: str, leader_card_id: int) -> None:
+    await _run(model._update_user, token, name, leader_card_id)
+    model._user_updated(token)
+
+
+# ルームをメモリで持っているときは, 先にユーザーをキャッシュに載せてから
+# model の関数をそのまま呼ぶ (DB を触らないのでイベントループを止めない)
+
+
+@_sync_fallback(model.create_room)
+async def create_room(token: str, live_id: int, select_difficulty: LiveDifficulty):
+    if model.room_registry is not None:
+        await get_user_by_token(token)
+        return model.create_room(token, live_id, select_difficulty)
+    room_id = await _run_on(
+        model.room_shards.place(),
+        token,
+        model._create_room,
+        token,
+        live_id,
+        select_difficulty,
+    )
+    model._room_created(token, room_id, live_id)
+    return room_id
+
+
+@_sync_fallback(model.get_room_list)
+async def get_room_list(
+    token: str, live_id: int, cursor: Optional[int] = None, limit: Optional[int] = None
+):
+    if model.room_registry is not None:
+        return model.get_room_list(token, live_id, cursor, limit)
+    cursor, limit = model._page_args(cursor, limit)
+    key = model._room_list_key(live_id, cursor, limit)
+    page = model.room_list_cache.get(key)
+    if page is not None:
+        return page
+    rows = await _gather_room_list(live_id, cursor, limit + 1)
+    page = model._room_list_page(rows, limit)
+    model.room_list_cache.set(key, page)
+    return page
+
+
+@_sync_fallback(model.count_rooms)
+async def count_rooms() -> dict[int, int]:
+    if model.room_registry is not None:
+        return model.room_registry.count_by_status()
+    counts: dict[int, int] = {}
+    for shard_counts in await asyncio.gather(
+        *(_read_primary(shard, model._count_rooms) for shard in model.room_shards)
+    ):
+        for status, n in shard_counts.items():
+            counts[status] = counts.get(status, 0) + n
+    return counts
+
+
+@_sync_fallback(model.join_room)
+async def join_room(token: str, room_id: int, select_difficulty: LiveDifficulty):
+    result = await _join(token, room_id, select_difficulty)
+    model._join_finished(room_id, result)
+    return result
+
+
+async def _join(token: str, room_id: int, select_difficulty: LiveDifficulty):
+    if model.room_registry is not None:
+        await get_user_by_token(token)
+        return model._join(token, room_id, select_difficulty)
+    try:
+        result, live_id = await _run_on(
+            _room_shard(room_id),
+            token,
+            model._join_room,
+            token,
+            room_id,
+            select_difficulty,
+        )
+    except IntegrityError:
+        return JoinRoomResult.Ok
+    if result == JoinRoomResult.Ok:
+        model._room_joined(token, room_id, live_id)
+    return result
+
+
+@_sync_fallback(model.matchmake)
+async def matchmake(token: str, live_id: int, select_difficulty: LiveDifficulty):
+    attempts = 0
+    refilled = False
+    while attempts < config.MATCHMAKE_ATTEMPTS:
+        room_id = model.open_rooms.reserve(live_id)
+        if room_id is None:
+            if refilled:
+                break
+            if model.room_registry is not None:
+                rows = model._open_room_rows(live_id)
+            else:
+                rows = await _gather_room_list(live_id, 0, config.ROOM_LIST_PAGE_SIZE)
+            model._refill_open_rooms(rows)
+            refilled = True
+            continue
+        attempts += 1
+        result = await _join(token, room_id, select_difficulty)
+        if result == JoinRoomResult.Ok:
+            return (room_id, False)
+        model.open_rooms.remove(room_id)
+    return (await create_room(token, live_id, select_difficulty), True)
+
+
+@_sync_fallback(model.wait_room)
+async def wait_room(token: str, room_id: int):
+    if model.room_registry is not None:
+        await get_user_by_token(token)
+        return model.wait_room(token, room_id)
+    return await _read_on(
+        _room_shard(room_id),
+        token,
+        (token, model._room_key(room_id)),
+        model._wait_room,
+        token,
+        room_id,
+    )
+
+
+@_sync_fallback(model.start_room)
+async def start_room(token: str, room_id: int):
+    if model.room_registry is not None:
+        await get_user_by_token(token)
+        return model.start_room(token, room_id)
+    live_id = await _run_on(
+        _room_shard(room_id), token, model._start_room, token, room_id
+    )
+    if live_id is not None:
+        model._room_started(room_id, live_id)
+
+
+@_sync_fallback(model.end_room)
+async def end_room(token: str, room_id: int, judge_count_list: list[int], score: int):
+    buffer = model.score_buffer
+    if buffer is not None:
+        if buffer.submit(room_id, token, judge_count_list, score):
+            await run_in_threadpool(buffer.flush)
+        return
+    if model.room_registry is not None:
+        await get_user_by_token(token)
+        return model.end_room(token, room_id, judge_count_list, score)
+    result_user_list, dissolved = await _run_on(
+        _room_shard(room_id),
+        token,
+        model._end_room,
+        token,
+        room_id,
+        judge_count_list,
+        score,
+    )
+    model._store_result(room_id, result_user_list, dissolved)
+
+
+async def _flush_scores(room_id: int) -> None:
+    buffer = model.score_buffer
+    if buffer is not None and buffer.has_pending(room_id):
+        await run_in_threadpool(buffer.flush)
+
+
+@_sync_fallback(model.end_rooms)
+async def end_rooms(entries: list[tuple[int, str, list[int], int]]) -> int:
+    if model.room_registry is not None:
+        await _run(model._get_users_by_tokens, [entry[1] for entry in entries])
+        return model.end_rooms(entries)
+    if len(model.room_shards) > 1:
+        await _run(model._get_users_by_tokens, [entry[1] for entry in entries])
+    stored = 0
+    results = {}
+    for n, shard_results in await asyncio.gather(
+        *(
+            _run_on(shard, None, model._end_rooms, shard_entries)
+            for shard, shard_entries in model._entries_by_shard(entries)
+        )
+    ):
+        stored += n
+        results.update(shard_results)
+    model._store_results(results)
+    return stored
+
+
+@_sync_fallback(model.result_room)
+async def result_room(token: str, room_id: int):
+    await _flush_scores(room_id)
+    result_user_list = model.result_cache.get(room_id)
+    if result_user_list is not None:
+        return result_user_list
+    if model.room_registry is not None:
+        return model.result_room(token, room_id)
+    shard = _room_shard(room_id)
+    result_user_list, dissolved = None, False
+    # 揃うまではレプリカで見る (model.result_room)
+    read = model._read_async_engine(shard, model._room_key(room_id))
+    ready = True
+    if read is not shard.async_engine:
+        async with begin_read_async(read) as conn:
+            ready = await conn.run_sync(model._read_results, room_id) is not None
+    if ready:
+        result_user_list, dissolved = await _run_on(
+            shard, None, model._result_room, room_id
+        )
+    model._store_result(room_id, result_user_list, dissolved)
+    return result_user_list or []
+
+
+@_sync_fallback(model.get_ranking)
+async def get_ranking(token: str, live_id: int, limit: Optional[int] = None):
+    User = await get_user_by_token(token)
+    leaderboards = model.leaderboards
+    if leaderboards.needs_refresh():
+        last = len(model.room_shards) - 1
+        for shard in model.room_shards:
+            rows = await _read_primary(
+                shard, model._score_rows, leaderboards.since_id(shard.index)
+            )
+            leaderboards.apply(rows, shard.index, done=shard.index == last)
+    return model._ranking(live_id, User.id, limit)
+
+
+@_sync_fallback(model.leave_room)
+async def leave_room(token: str, room_id: int):
+    await _flush_scores(room_id)
+    if model.room_registry is not None:
+        await get_user_by_token(token)
+        return model.leave_room(token, room_id)
+    deleted, live_id, next_host = await _run_on(
+        _room_shard(room_id), token, model._leave_room, token, room_id
+    )
+    model._room_left(token, room_id, deleted, live_id, next_host)
@@ -1,22 +1,182 @@
+import logging
+import time
 from enum import Enum
-
-from fastapi import Depends, FastAPI, HTTPException
+from typing import Optional
+
+from fastapi import Depends, FastAPI, HTTPException, Request, Response, WebSocket
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import (
+    JSONResponse,
+    ORJSONResponse,
+    PlainTextResponse,
+    StreamingResponse,
+)
 from fastapi.security.http import HTTPAuthorizationCredentials, HTTPBearer
-from pydantic import BaseModel
+from pydantic import BaseModel, conlist
+from starlette.websockets import WebSocketDisconnect
 
-from . import model
+from . import amodel, config, db, metrics, model
+from .admission import AdmissionController, retry_after_header
+from .db import async_engine
 from .model import (
     JoinRoomResult,
     LiveDifficulty,
+    RankingUser,
     ResultUser,
     RoomInfo,
     RoomUser,
     SafeUser,
     WaitRoomStatus,
 )
+from .notify import room_notifier
+from .reaper import RoomReaper
+from .trace import TraceMiddleware, TraceRecorder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
+if config.METRICS:
+    app.add_middleware(metrics.MetricsMiddleware)
+    storages = [shard.storage for shard in db.room_shards]
+    if db.replicas is not None:
+        storages += db.replicas.replicas
+    for storage in storages:
+        metrics.instrument(storage.engine)
+        if storage.async_engine is not None:
+            metrics.instrument(storage.async_engine.sync_engine)
+
+trace_recorder = None
+if config.TRACE_FILE:
+    trace_recorder = TraceRecorder(
+        config.TRACE_FILE,
+        config.TRACE_KEY,
+        config.TRACE_FLUSH_INTERVAL,
+        config.TRACE_MAX_PENDING,
+    )
+    app.add_middleware(TraceMiddleware, recorder=trace_recorder)
+
+
+room_reaper = RoomReaper(config.ROOM_REAPER_INTERVAL)
+
+
+@app.on_event("startup")
+def startup():
+    model.room_events.start()
+    if model.room_registry is not None:
+        model.room_registry.start()
+    if model.score_buffer is not None:
+        model.score_buffer.start()
+    if model.replicas is not None:
+        model.replicas.start()
+    if config.ROOM_REAPER:
+        room_reaper.start()
+    if trace_recorder is not None:
+        trace_recorder.start()
+    # ランキングを live_score から作り直す
+    model.refresh_ranking()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    stops = [room_reaper.stop]
+    if trace_recorder is not None:
+        stops.append(trace_recorder.stop)
+    if model.replicas is not None:
+        stops.append(model.replicas.stop)
+    # スコアを書き切ってからルームを書き戻す
+    if model.score_buffer is not None:
+        stops.append(model.score_buffer.stop)
+    if model.room_registry is not None:
+        stops.append(model.room_registry.stop)
+    stops.append(model.room_events.stop)
+    # 1 つが失敗しても残りの書き戻しは飛ばさない
+    for stop in stops:
+        try:
+            stop()
+        except Exception:
+            logger.exception("shutdown: %s failed", stop.__qualname__)
+    if async_engine is not None:
+        await async_engine.dispose()
+
+
+def _fast_response(content: dict, headers: Optional[dict] = None) -> Response:
+    """FAST_JSON: encode plain values directly, skipping response_model
+
+    The documented schema stays the one of the endpoint's response_model;
+    callers must build exactly that shape.
+    """
+    if orjson is not None:
+        return ORJSONResponse(content, headers=headers)
+    return JSONResponse(content, headers=headers)
+
+
+# 条件付きリクエスト (CONDITIONAL_POLLS). ETag はこのワーカーの中のバージョンなので
+# ワーカーの origin を含め, 別のワーカーや再起動前の ETag には一致しないようにする
+
+
+def _etag(*parts) -> Optional[str]:
+    if not config.CONDITIONAL_POLLS:
+        return None
+    tag = ".".join(map(str, (model.room_events.origin,) + parts))
+    if model.room_registry is None:
+        # 他のワーカーの変更は届かないか, 届いても取りこぼすことがある
+        # (UnixSocketEventBus など). 発行時刻を入れて ETAG_MAX_AGE だけ使う
+        tag += "@%x" % _now_ms()
+    return 'W/"%s"' % tag
+
+
+def _now_ms() -> int:
+    return int(time.monotonic() * 1000)
+
+
+def _etag_issued(tag: str) -> tuple[str, Optional[int]]:
+    """(the ETag without its issue time, the issue time in ms or None)"""
+    body, sep, issued = tag.rpartition("@")
+    if not sep or not issued.endswith('"'):
+        return (tag, None)
+    try:
+        return (body, int(issued[:-1], 16))
+    except ValueError:
+        return (tag, None)
+
+
+def _room_etag(kind: str, room_id: int, version: int, *parts) -> Optional[str]:
+    # 0 はこのワーカーが知らないルームか, forget() したルーム. どちらも ETag を返さない
+    if version == 0:
+        return None
+    return _etag(kind, room_id, version, *parts)
+
+
+def _not_modified(
+    request: Request, etag: Optional[str], headers: dict
+) -> Optional[Response]:
+    """304 if the request's If-None-Match has `etag`, else None
+
+    A tag issued less than ETAG_MAX_AGE ago for the same version matches
+    too, and is sent back as it is, so it still expires on time.
+    """
+    if etag is None:
+        return None
+    value = request.headers.get("if-none-match")
+    if value is None:
+        return None
+    current, _ = _etag_issued(etag)
+    for tag in value.split(","):
+        tag = tag.strip()
+        body, issued = _etag_issued(tag)
+        if body != current:
+            continue
+        if issued is None or 0 <= _now_ms() - issued < config.ETAG_MAX_AGE * 1000:
+            return Response(status_code=304, headers={"ETag": tag, **headers})
+    return None
+
+
 # Sample APIs
 
 
@@ -25,6 +185,34 @@ async def root():
     return {"message": "Hello World"}
 
 
+@app.get("/debug/pool")
+async def debug_pool():
+    """Connection pool usage (checked out/idle connections, waits, overflows)
+    and cache hit/miss/eviction counts"""
+    return {**db.pool_status(), "caches": _cache_stats()}
+
+
+def _cache_stats() -> dict:
+    return {
+        "user": model.user_cache.stats(),
+        "room_list": model.room_list_cache.stats(),
+        "result": model.result_cache.stats(),
+    }
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus text exposition"""
+    rooms = await amodel.count_rooms()
+    names = {status.value: status.name for status in WaitRoomStatus}
+    body = metrics.render(
+        {names.get(status, str(status)): n for status, n in rooms.items()},
+        db.pool_status(),
+        _cache_stats(),
+    )
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
+
 # User APIs
 
 
@@ -37,6 +225,14 @@ class UserCreateResponse(BaseModel):
     user_token: str
 
 
+class UserCreateBatchRequest(BaseModel):
+    users: list[UserCreateRequest]
+
+
+class UserCreateBatchResponse(BaseModel):
+    user_tokens: list[str]
+
+
 class RoomCreateRequest(BaseModel):
     live_id: int
     select_difficulty: LiveDifficulty
@@ -48,10 +244,13 @@ class RoomCreateResponse(BaseModel):
 
 class RoomListRequest(BaseModel):
     live_id: int
+    cursor: Optional[int] = None  # 前のページの next_cursor
+    limit: Optional[int] = None
 
 
 class RoomListResponse(BaseModel):
     room_info_list: list[RoomInfo]
+    next_cursor: Optional[int] = None  # None なら最後のページ
 
 
 class RoomJoinRequest(BaseModel):
@@ -63,6 +262,16 @@ class RoomJoinResponse(BaseModel):
     join_room_result: JoinRoomResult
 
 
+class RoomMatchmakeRequest(BaseModel):
+    live_id: int
+    select_difficulty: LiveDifficulty
+
+
+class RoomMatchmakeResponse(BaseModel):
+    room_id: int
+    created: bool  # True なら新しく作ったルームで, 自分がホスト
+
+
 class RoomWaitRequest(BaseModel):
     room_id: int
 
@@ -70,37 +279,80 @@ class RoomWaitRequest(BaseModel):
 class RoomWaitResponse(BaseModel):
     status: WaitRoomStatus
     room_user_list: list[RoomUser]
+    next_poll_delay_ms: int = 0  # 次のポーリングまで待つ時間. 0 ならすぐでよい
 
 
 class RoomStartRequest(BaseModel):
     room_id: int
 
 
+# perfect, great, good, bad, miss. 長さが違うと書き込みで落ちるので入口で弾く
+JudgeCountList = conlist(int, min_items=5, max_items=5)
+
+
 class RoomEndRequest(BaseModel):
     room_id: int
-    judge_count_list: list[int]
+    judge_count_list: JudgeCountList
+    score: int
+
+
+class RoomEndBatchItem(BaseModel):
+    room_id: int
+    user_token: str
+    judge_count_list: JudgeCountList
     score: int
 
 
+class RoomEndBatchRequest(BaseModel):
+    results: list[RoomEndBatchItem]
+
+
+class RoomEndBatchResponse(BaseModel):
+    stored: int  # user_token が不正なものは数えない
+
+
 class RoomResultRequest(BaseModel):
     room_id: int
 
 
 class RoomResultResponse(BaseModel):
     result_user_list: list[ResultUser]
+    next_poll_delay_ms: int = 0  # 結果がまだのときの次のポーリングまでの時間
 
 
 class RoomLeaveRequest(BaseModel):
     room_id: int
 
 
+class LiveRankingResponse(BaseModel):
+    ranking: list[RankingUser]
+    me: Optional[RankingUser] = None  # まだスコアがなければ None
+
+
 @app.post("/user/create", response_model=UserCreateResponse)
-def user_create(req: UserCreateRequest):
+async def user_create(req: UserCreateRequest):
     """新規ユーザー作成"""
-    token = model.create_user(req.user_name, req.leader_card_id)
+    token = await amodel.create_user(req.user_name, req.leader_card_id)
     return UserCreateResponse(user_token=token)
 
 
+def _check_batch_size(n: int) -> None:
+    if n > config.BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=400, detail=f"batch size must be <= {config.BATCH_MAX_SIZE}"
+        )
+
+
+@app.post("/user/create_batch", response_model=UserCreateBatchResponse)
+async def user_create_batch(req: UserCreateBatchRequest):
+    """Create many users at once (load tests, bots)"""
+    _check_batch_size(len(req.users))
+    tokens = await amodel.create_users(
+        [(user.user_name, user.leader_card_id) for user in req.users]
+    )
+    return UserCreateBatchResponse(user_tokens=tokens)
+
+
 bearer = HTTPBearer()
 
 
@@ -111,9 +363,39 @@ def get_auth_token(cred: HTTPAuthorizationCredentials = Depends(bearer)) -> str:
     return cred.credentials
 
 
+# /room/wait と /room/result のポーリングの流量制御
+poll_admission = AdmissionController(
+    config.POLL_RATE,
+    config.POLL_BURST,
+    config.POLL_MAX_INFLIGHT,
+    config.POLL_TRACKED_TOKENS,
+)
+
+
+def admit_poll(request: Request, token: str = Depends(get_auth_token)) -> None:
+    """Reject the poll with 429 before it reaches the model"""
+    if not config.POLL_ADMISSION:
+        return
+    retry_after, reason = poll_admission.admit(token)
+    if reason is not None:
+        metrics.polls_rejected.inc((request.url.path, reason))
+        raise HTTPException(
+            status_code=429,
+            detail="Too Many Requests",
+            headers={"Retry-After": retry_after_header(retry_after)},
+        )
+
+
+def _poll_delay_ms(base: float) -> int:
+    delay = poll_admission.next_poll_delay(
+        base, config.POLL_LOAD_FACTOR, config.POLL_DELAY_MAX
+    )
+    return int(delay * 1000)
+
+
 @app.get("/user/me", response_model=SafeUser)
-def user_me(token: str = Depends(get_auth_token)):
-    user = model.get_user_by_token(token)
+async def user_me(token: str = Depends(get_auth_token)):
+    user = await amodel.get_user_by_token(token)
     if user is None:
         raise HTTPException(status_code=404)
     # print(f"user_me({token=}, {user=})")
@@ -125,64 +407,304 @@ class Empty(BaseModel):
 
 
 @app.post("/user/update", response_model=Empty)
-def update(req: UserCreateRequest, token: str = Depends(get_auth_token)):
+async def update(req: UserCreateRequest, token: str = Depends(get_auth_token)):
     """Update user attributes"""
     # print(req)
-    model.update_user(token, req.user_name, req.leader_card_id)
+    await amodel.update_user(token, req.user_name, req.leader_card_id)
     return {}
 
 
 @app.post("/room/create", response_model=RoomCreateResponse)
-def room_create(req: RoomCreateRequest, token: str = Depends(get_auth_token)):
+async def room_create(req: RoomCreateRequest, token: str = Depends(get_auth_token)):
     """Create Room for multi play"""
-    room_id = model.create_room(token, req.live_id, req.select_difficulty)
+    room_id = await amodel.create_room(token, req.live_id, req.select_difficulty)
     return RoomCreateResponse(room_id=room_id)
 
 
 @app.post("/room/list", response_model=RoomListResponse)
-def get_room_list(req: RoomListRequest, token: str = Depends(get_auth_token)):
-    """Show room list"""
-    room_info_list = model.get_room_list(token, req.live_id)
-    return RoomListResponse(room_info_list=room_info_list)
+async def get_room_list(
+    req: RoomListRequest,
+    request: Request,
+    response: Response,
+    token: str = Depends(get_auth_token),
+):
+    """Show room list
+
+    Conditional like /room/wait: If-None-Match with the last `ETag`.
+    """
+    # 一覧を読む前に取る. 読んでいる間に変わったら次は 304 にならない
+    etag = _etag(
+        "list", req.live_id, model.lobby_version(req.live_id), req.cursor, req.limit
+    )
+    not_modified = _not_modified(request, etag, {})
+    if not_modified is not None:
+        return not_modified
+    headers = {"ETag": etag} if etag is not None else {}
+    rows, next_cursor = await amodel.get_room_list(
+        token, req.live_id, req.cursor, req.limit
+    )
+    if config.FAST_JSON:
+        return _fast_response(
+            {
+                "room_info_list": [
+                    {
+                        "room_id": row[0],
+                        "live_id": row[1],
+                        "joined_user_count": row[2],
+                        "max_user_count": row[3],
+                    }
+                    for row in rows
+                ],
+                "next_cursor": next_cursor,
+            },
+            headers=headers,
+        )
+    response.headers.update(headers)
+    # model.RoomRow -> RoomInfo はここで1度だけ
+    return RoomListResponse(room_info_list=rows, next_cursor=next_cursor)
 
 
 @app.post("/room/join", response_model=RoomJoinResponse)
-def get_room_list(req: RoomJoinRequest, token: str = Depends(get_auth_token)):
+async def get_room_list(req: RoomJoinRequest, token: str = Depends(get_auth_token)):
     """Show room list"""
-    join_room_result = model.join_room(token, req.room_id, req.select_difficulty)
+    join_room_result = await amodel.join_room(token, req.room_id, req.select_difficulty)
     return RoomJoinResponse(join_room_result=join_room_result)
 
 
+@app.post("/room/matchmake", response_model=RoomMatchmakeResponse)
+async def room_matchmake(
+    req: RoomMatchmakeRequest, token: str = Depends(get_auth_token)
+):
+    """Join the fullest waiting room of live_id, or create a new one"""
+    room_id, created = await amodel.matchmake(token, req.live_id, req.select_difficulty)
+    return RoomMatchmakeResponse(room_id=room_id, created=created)
+
+
 @app.post("/room/wait", response_model=RoomWaitResponse)
-def room_wait(req: RoomWaitRequest, token: str = Depends(get_auth_token)):
-    """Show room list"""
-    (status, room_user_list) = model.wait_room(token, req.room_id)
-    return RoomWaitResponse(status=status, room_user_list=room_user_list)
+async def room_wait(
+    req: RoomWaitRequest,
+    request: Request,
+    response: Response,
+    token: str = Depends(get_auth_token),
+    version: Optional[int] = None,
+    timeout: float = 0,
+    _: None = Depends(admit_poll),
+):
+    """Show room status
+
+    Long-poll: pass the last seen `X-Room-Version` as `version` together with
+    `timeout` (seconds) and the call returns as soon as the room changes.
+    `next_poll_delay_ms` says how long to wait before the next call.
+
+    Conditional: send the last `ETag` as If-None-Match and an unchanged room
+    answers 304 without a body (the delay is in X-Next-Poll-Delay-Ms).
+    """
+    long_poll = version is not None and timeout > 0
+    if long_poll:
+        timeout = min(timeout, config.LONG_POLL_MAX_TIMEOUT)
+        await room_notifier.wait(req.room_id, version, timeout)
+    # 状態を読む前にバージョンを取る. 読んでいる間に変わっても次の待ちで拾える
+    current = room_notifier.version(req.room_id)
+    # is_me があるので ETag はユーザーごと
+    etag = _room_etag("wait", req.room_id, current, "%x" % (hash(token) & 0xFFFFFFFF))
+    not_modified = _not_modified(
+        request,
+        etag,
+        {
+            "X-Room-Version": str(current),
+            "X-Next-Poll-Delay-Ms": str(
+                _poll_delay_ms(0 if long_poll else config.WAIT_POLL_INTERVAL)
+            ),
+        },
+    )
+    if not_modified is not None:
+        return not_modified
+    with poll_admission.track():
+        status, rows = await amodel.wait_room(token, req.room_id)
+    # 待機中だけ次のポーリングが要る. ロングポーリングならサーバー側で待つ
+    waiting = WaitRoomStatus(status) == WaitRoomStatus.Waiting and not long_poll
+    delay_ms = _poll_delay_ms(config.WAIT_POLL_INTERVAL if waiting else 0)
+    headers = {"X-Room-Version": str(current)}
+    if etag is not None:
+        headers["ETag"] = etag
+    if config.FAST_JSON:
+        return _fast_response(
+            {
+                "status": status,
+                "room_user_list": _room_user_dicts(rows),
+                "next_poll_delay_ms": delay_ms,
+            },
+            headers=headers,
+        )
+    response.headers.update(headers)
+    # model.MemberRow -> RoomUser はここで1度だけ
+    return RoomWaitResponse(
+        status=status, room_user_list=rows, next_poll_delay_ms=delay_ms
+    )
+
+
+def _room_user_dicts(rows) -> list[dict]:
+    return [
+        {
+            "user_id": row[0],
+            "name": row[1],
+            "leader_card_id": row[2],
+            "select_difficulty": row[3],
+            "is_me": row[4],
+            "is_host": row[5],
+        }
+        for row in rows
+    ]
+
+
+async def _room_states(token: str, room_id: int):
+    """Yield (version, RoomWaitResponse) every time the room changes
+
+    Stops after the room leaves the waiting state. When nothing is published
+    for ROOM_STREAM_KEEPALIVE seconds the room is re-read anyway, so changes
+    made by other worker processes are still picked up.
+    """
+    last = None
+    version = room_notifier.version(room_id)
+    while True:
+        status, rows = await amodel.wait_room(token, room_id)
+        state = RoomWaitResponse(status=status, room_user_list=rows)
+        if state != last:
+            yield version, state
+            last = state
+        if state.status != WaitRoomStatus.Waiting:
+            return
+        version = await room_notifier.wait(
+            room_id, version, config.ROOM_STREAM_KEEPALIVE
+        )
+
+
+@app.websocket("/room/ws/{room_id}")
+async def room_ws(websocket: WebSocket, room_id: int, token: Optional[str] = None):
+    """Push room status to the client instead of /room/wait polling
+
+    The token is taken from the Authorization header or the `token` query.
+    """
+    auth = websocket.headers.get("authorization", "")
+    if auth.lower().startswith("bearer "):
+        token = auth[7:]
+    if not token:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    try:
+        async for version, state in _room_states(token, room_id):
+            await websocket.send_json({"version": version, **jsonable_encoder(state)})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+
+
+@app.get("/room/events/{room_id}")
+async def room_events(
+    room_id: int, request: Request, token: str = Depends(get_auth_token)
+):
+    """Server-Sent Events version of /room/ws"""
+
+    async def stream():
+        async for version, state in _room_states(token, room_id):
+            if await request.is_disconnected():
+                return
+            yield f"id: {version}\ndata: {state.json()}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
 
 
 @app.post("/room/start", response_model=Empty)
-def room_start(req: RoomStartRequest, token: str = Depends(get_auth_token)):
+async def room_start(req: RoomStartRequest, token: str = Depends(get_auth_token)):
     """Show room list"""
-    model.start_room(token, req.room_id)
+    await amodel.start_room(token, req.room_id)
     return {}
 
 
 @app.post("/room/end", response_model=Empty)
-def room_end(req: RoomEndRequest, token: str = Depends(get_auth_token)):
+async def room_end(req: RoomEndRequest, token: str = Depends(get_auth_token)):
     """Show room list"""
-    model.end_room(token, req.room_id, req.judge_count_list, req.score)
+    await amodel.end_room(token, req.room_id, req.judge_count_list, req.score)
     return {}
 
 
+@app.post("/room/end_batch", response_model=RoomEndBatchResponse)
+async def room_end_batch(req: RoomEndBatchRequest):
+    """Submit scores of many (room, user) pairs at once
+
+    Each entry is authenticated by its own user_token.
+    """
+    _check_batch_size(len(req.results))
+    stored = await amodel.end_rooms(
+        [(r.room_id, r.user_token, r.judge_count_list, r.score) for r in req.results]
+    )
+    return RoomEndBatchResponse(stored=stored)
+
+
 @app.post("/room/result", response_model=RoomResultResponse)
-def room_result(req: RoomResultRequest, token: str = Depends(get_auth_token)):
-    """Show room list"""
-    result_user_list = model.result_room(token, req.room_id)
-    return RoomResultResponse(result_user_list=result_user_list)
+async def room_result(
+    req: RoomResultRequest,
+    request: Request,
+    response: Response,
+    token: str = Depends(get_auth_token),
+    _: None = Depends(admit_poll),
+):
+    """Show room list
+
+    Conditional like /room/wait: If-None-Match with the last `ETag`.
+    """
+    # リザルトが揃うとルームのバージョンが進む
+    etag = _room_etag("result", req.room_id, room_notifier.version(req.room_id))
+    delay = {"X-Next-Poll-Delay-Ms": str(_poll_delay_ms(config.RESULT_POLL_INTERVAL))}
+    not_modified = _not_modified(request, etag, delay)
+    if not_modified is not None:
+        return not_modified
+    with poll_admission.track():
+        result_user_list = await amodel.result_room(token, req.room_id)
+    # 全員のスコアが揃うまで空のリストが返る
+    delay_ms = _poll_delay_ms(0 if result_user_list else config.RESULT_POLL_INTERVAL)
+    headers = {"ETag": etag} if etag is not None else {}
+    if config.FAST_JSON:
+        return _fast_response(
+            {
+                "result_user_list": _result_user_dicts(result_user_list),
+                "next_poll_delay_ms": delay_ms,
+            },
+            headers=headers,
+        )
+    response.headers.update(headers)
+    # model.ResultRow -> ResultUser はここで1度だけ
+    return RoomResultResponse(
+        result_user_list=result_user_list, next_poll_delay_ms=delay_ms
+    )
+
+
+def _result_user_dicts(rows) -> list[dict]:
+    return [
+        {
+            "user_id": row.user_id,
+            "judge_count_list": list(row.judge_count_list),
+            "score": row.score,
+        }
+        for row in rows
+    ]
 
 
 @app.post("/room/leave", response_model=Empty)
-def room_leave(req: RoomLeaveRequest, token: str = Depends(get_auth_token)):
+async def room_leave(req: RoomLeaveRequest, token: str = Depends(get_auth_token)):
     """Show room list"""
-    model.leave_room(token, req.room_id)
+    await amodel.leave_room(token, req.room_id)
     return {}
+
+
+# Live APIs
+
+
+@app.get("/live/{live_id}/ranking", response_model=LiveRankingResponse)
+async def live_ranking(
+    live_id: int, limit: Optional[int] = None, token: str = Depends(get_auth_token)
+):
+    """Best score per user of the song, top `limit`, and the caller's rank"""
+    ranking, me = await amodel.get_ranking(token, live_id, limit)
+    return LiveRankingResponse(ranking=ranking, me=me)
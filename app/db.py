@@ -1,5 +1,163 @@
-from sqlalchemy import create_engine
+import threading
+import time
+
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
 from . import config
+from .replicas import ReplicaSet
+from .sharding import ShardSet
+from .storage import create_storage
+
+
+class PoolStats:
+    """Counters for connection acquisition from one pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.overflow_events = 0  # pool_size を超えて接続を作った回数
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def record(self, wait: float, overflowed: bool) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds_total += wait
+            if wait > self.wait_seconds_max:
+                self.wait_seconds_max = wait
+            if overflowed:
+                self.overflow_events += 1
+
+    def record_timeout(self) -> None:
+        with self._lock:
+            self.timeouts += 1
+
+
+class _TimedPool:
+    """Measures how long callers wait for a connection
+
+    Mixed into QueuePool subclasses; `stats` is set per subclass so that it
+    survives pool.recreate().
+    """
+
+    stats: PoolStats
+
+    def _do_get(self):
+        overflow = self._overflow
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except TimeoutError:
+            self.stats.record_timeout()
+            raise
+        self.stats.record(
+            time.perf_counter() - start, self._overflow > max(overflow, 0)
+        )
+        return conn
+
+
+sync_pool_stats = PoolStats()
+async_pool_stats = PoolStats()
+
+
+class TimedQueuePool(_TimedPool, QueuePool):
+    stats = sync_pool_stats
+
+
+class TimedAsyncQueuePool(_TimedPool, AsyncAdaptedQueuePool):
+    stats = async_pool_stats
+
+
+def _engine_args() -> dict:
+    return dict(
+        future=True,
+        echo=config.DB_ECHO,
+        pool_size=config.DB_POOL_SIZE,
+        max_overflow=config.DB_MAX_OVERFLOW,
+        pool_timeout=config.DB_POOL_TIMEOUT,
+        pool_recycle=config.DB_POOL_RECYCLE,
+        pool_pre_ping=config.DB_POOL_PRE_PING,
+    )
+
+
+storage = create_storage(
+    config.DATABASE_URI,
+    config.ASYNC_DATABASE_URI,
+    config.DB_ASYNC,
+    TimedQueuePool,
+    TimedAsyncQueuePool,
+    **_engine_args(),
+)
+engine = storage.engine
+
+# DB_ASYNC のときだけ作る. model の処理は amodel から run_sync で動かす
+async_engine = storage.async_engine
+
+
+def _extra_storage(uri: str, async_uris: list[str], i: int):
+    async_uri = async_uris[i] if i < len(async_uris) else None
+    # 待ち時間の統計は主 DB のプールだけ
+    return create_storage(
+        uri,
+        async_uri,
+        config.DB_ASYNC,
+        QueuePool,
+        AsyncAdaptedQueuePool,
+        **_engine_args(),
+    )
+
+
+room_shards = ShardSet(
+    [storage]
+    + [
+        _extra_storage(uri, config.ASYNC_ROOM_SHARD_URIS, i)
+        for i, uri in enumerate(config.ROOM_SHARD_URIS)
+    ]
+)
+
+replicas = (
+    ReplicaSet(
+        storage,
+        [
+            _extra_storage(uri, config.ASYNC_REPLICA_URIS, i)
+            for i, uri in enumerate(config.REPLICA_URIS)
+        ],
+        config.REPLICA_PIN_SECONDS,
+        config.REPLICA_MAX_LAG,
+        config.REPLICA_CHECK_INTERVAL,
+        config.REPLICA_PIN_SIZE,
+    )
+    if config.REPLICA_URIS
+    else None
+)
+
+
+def _pool_status(pool, stats: PoolStats) -> dict:
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": pool._max_overflow,
+        "checkouts": stats.checkouts,
+        "overflow_events": stats.overflow_events,
+        "timeouts": stats.timeouts,
+        "wait_seconds_total": stats.wait_seconds_total,
+        "wait_seconds_max": stats.wait_seconds_max,
+    }
+
 
-engine = create_engine(config.DATABASE_URI, future=True, echo=True)
+def pool_status() -> dict:
+    """Snapshot of the connection pools, for sizing workers and pools"""
+    status = {
+        "backend": storage.name,
+        "room_shards": len(room_shards),
+        "sync": _pool_status(engine.pool, sync_pool_stats),
+    }
+    if async_engine is not None:
+        status["async"] = _pool_status(async_engine.pool, async_pool_stats)
+    if replicas is not None:
+        status["replicas"] = replicas.status()
+    return status
@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# RoomEvent.kind
+CREATED = "created"
+JOINED = "joined"
+LEFT = "left"
+HOST_CHANGED = "host_changed"
+STARTED = "started"
+RESULT_READY = "result_ready"
+DISSOLVED = "dissolved"  # 古いライブを reaper が解散させた
+DELETED = "deleted"
+
+
+class RoomEvent:
+    """ルームの状態遷移. origin は発行したプロセス (EventBus.origin)"""
+
+    __slots__ = ("kind", "room_id", "live_id", "user_id", "origin")
+
+    def __init__(self, kind, room_id, live_id=None, user_id=None, origin=None):
+        self.kind = kind
+        self.room_id = room_id
+        self.live_id = live_id
+        self.user_id = user_id
+        self.origin = origin
+
+    def encode(self) -> bytes:
+        return json.dumps(
+            [self.kind, self.room_id, self.live_id, self.user_id, self.origin]
+        ).encode()
+
+    @classmethod
+    def decode(cls, data: bytes) -> "RoomEvent":
+        return cls(*json.loads(data))
+
+    def __repr__(self) -> str:
+        return (
+            f"RoomEvent({self.kind!r}, room_id={self.room_id}, "
+            f"live_id={self.live_id}, user_id={self.user_id}, origin={self.origin!r})"
+        )
+
+
+Handler = Callable[[RoomEvent], None]
+
+
+class EventBus:
+    """Fans room events out to every subscriber of every worker
+
+    Subscribers see all events, their own process's included; compare
+    `event.origin` with `bus.origin` to tell them apart. Handlers may be
+    called from a background thread.
+    """
+
+    def __init__(self):
+        self.origin = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._handlers: list[Handler] = []
+
+    def subscribe(self, handler: Handler) -> None:
+        self._handlers.append(handler)
+
+    def unsubscribe(self, handler: Handler) -> None:
+        self._handlers.remove(handler)
+
+    def publish(self, event: RoomEvent) -> None:
+        event.origin = self.origin
+        self._deliver(event)
+
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    def _deliver(self, event: RoomEvent) -> None:
+        for handler in self._handlers:
+            try:
+                handler(event)
+            except Exception:
+                logger.exception("room event handler failed: %r", event)
+
+
+class LocalEventBus(EventBus):
+    """In-process only: a single worker, or tests"""
+
+
+class UnixSocketEventBus(EventBus):
+    """Workers on one host, over Unix datagram sockets in `directory`
+
+    Every worker binds `<directory>/<origin>.sock` and publish() sends the
+    event to every other socket there; no broker process is needed. The
+    directory is re-listed every `peer_refresh` seconds to see new workers.
+    Sockets of workers that died are removed by the first sender that gets
+    ECONNREFUSED. A peer whose receive buffer is full misses the event
+    (counted in `dropped`) rather than blocking the sender.
+    """
+
+    def __init__(self, directory: str, peer_refresh: float = 1.0):
+        super().__init__()
+        self.directory = directory
+        self.peer_refresh = peer_refresh
+        self.path = os.path.join(directory, f"{self.origin}.sock")
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self._sock: Optional[socket.socket] = None
+        self._thread: Optional[threading.Thread] = None
+        self._peers: list[str] = []
+        self._peers_at = 0.0
+        self._peers_lock = threading.Lock()
+
+    def start(self) -> None:
+        if self._sock is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.path)
+        sock.settimeout(1.0)
+        self._sock = sock
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setblocking(False)
+        self._thread = threading.Thread(
+            target=self._receive, name="room-event-bus", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        sock, self._sock = self._sock, None
+        if sock is None:
+            return
+        # 空のデータグラムで recv() を起こして受信スレッドを終わらせる
+        try:
+            self._sender.sendto(b"", self.path)
+        except OSError:
+            pass
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        sock.close()
+        self._sender.close()
+
+    def _receive(self) -> None:
+        sock = self._sock
+        while self._sock is sock:
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            if not data:
+                continue
+            try:
+                event = RoomEvent.decode(data)
+            except ValueError:
+                logger.warning("broken room event: %r", data[:100])
+                continue
+            self.received += 1
+            self._deliver(event)
+
+    def _peer_paths(self) -> list[str]:
+        now = time.monotonic()
+        with self._peers_lock:
+            if now - self._peers_at >= self.peer_refresh:
+                try:
+                    names = os.listdir(self.directory)
+                except FileNotFoundError:
+                    names = []
+                self._peers = [
+                    os.path.join(self.directory, name)
+                    for name in names
+                    if name.endswith(".sock")
+                    and os.path.join(self.directory, name) != self.path
+                ]
+                self._peers_at = now
+            return list(self._peers)
+
+    def publish(self, event: RoomEvent) -> None:
+        event.origin = self.origin
+        if self._sock is not None:
+            data = event.encode()
+            for path in self._peer_paths():
+                try:
+                    self._sender.sendto(data, path)
+                    self.sent += 1
+                except BlockingIOError:
+                    self.dropped += 1
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # 落ちたワーカーのソケット
+                    self._forget_peer(path)
+                except OSError:
+                    self.dropped += 1
+        self._deliver(event)
+
+    def _forget_peer(self, path: str) -> None:
+        with self._peers_lock:
+            if path in self._peers:
+                self._peers.remove(path)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def create_event_bus(backend: str, directory: str) -> EventBus:
+    if backend == "unix":
+        return UnixSocketEventBus(directory)
+    if backend == "local":
+        return LocalEventBus()
+    raise ValueError(f"unknown EVENT_BUS: {backend!r}")
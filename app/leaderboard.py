@@ -0,0 +1,120 @@
+import bisect
+import threading
+import time
+from typing import Optional
+
+
+class Entry:
+    __slots__ = ("user_id", "name", "leader_card_id", "score")
+
+    def __init__(self, user_id, name, leader_card_id, score):
+        self.user_id = user_id
+        self.name = name
+        self.leader_card_id = leader_card_id
+        self.score = score
+
+
+class Leaderboard:
+    """Best score per user of one live_id, kept sorted
+
+    `_keys` holds (-score, user_id) in order, so the top-K is a slice and a
+    rank is one bisect. Equal scores share a rank.
+    """
+
+    def __init__(self):
+        self._best: dict[int, Entry] = {}
+        self._keys: list[tuple[int, int]] = []
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def submit(self, user_id: int, name, leader_card_id, score: int) -> bool:
+        """Returns True if it is a new best of the user"""
+        entry = self._best.get(user_id)
+        if entry is not None:
+            if score <= entry.score:
+                return False
+            del self._keys[bisect.bisect_left(self._keys, (-entry.score, user_id))]
+        self._best[user_id] = Entry(user_id, name, leader_card_id, score)
+        bisect.insort(self._keys, (-score, user_id))
+        return True
+
+    def rank_of_score(self, score: int) -> int:
+        return bisect.bisect_left(self._keys, (-score,)) + 1
+
+    def top(self, k: int) -> list[tuple[int, Entry]]:
+        """[(rank, entry), ...] of the best `k` users"""
+        result = []
+        for neg_score, user_id in self._keys[:k]:
+            result.append((self.rank_of_score(-neg_score), self._best[user_id]))
+        return result
+
+    def get(self, user_id: int) -> Optional[tuple[int, Entry]]:
+        entry = self._best.get(user_id)
+        if entry is None:
+            return None
+        return (self.rank_of_score(entry.score), entry)
+
+
+class Leaderboards:
+    """Leaderboard per live_id, fed by the rows of the `live_score` table
+
+    Rows are applied in id order with apply(). Taking the best score is
+    idempotent, so the next read starts `overlap` ids before the last one
+    seen; that catches rows whose transaction committed late, out of id
+    order. With room shards every shard has its own `live_score` and ids,
+    told apart by `source`.
+    """
+
+    def __init__(self, refresh_interval: float = 1.0, overlap: int = 1000):
+        self.refresh_interval = refresh_interval
+        self.overlap = overlap
+        self._lock = threading.Lock()
+        self._boards: dict[int, Leaderboard] = {}
+        self._last_ids: dict[int, int] = {}  # source -> 最後に見た id
+        self._loaded = False
+        self._refreshed_at = 0.0
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def since_id(self, source: int = 0) -> int:
+        """Read rows of `source` with id > since_id() next"""
+        last_id = self._last_ids.get(source)
+        return max(last_id - self.overlap, 0) if last_id is not None else 0
+
+    def needs_refresh(self) -> bool:
+        return (
+            not self._loaded
+            or time.monotonic() - self._refreshed_at >= self.refresh_interval
+        )
+
+    def apply(self, rows, source: int = 0, done: bool = True) -> None:
+        """rows: (id, live_id, user_id, name, leader_card_id, score)
+
+        Pass done=False for all but the last source of one refresh.
+        """
+        with self._lock:
+            last_id = self._last_ids.get(source, 0)
+            for id, live_id, user_id, name, leader_card_id, score in rows:
+                board = self._boards.get(live_id)
+                if board is None:
+                    board = self._boards[live_id] = Leaderboard()
+                board.submit(user_id, name, leader_card_id, score)
+                if id > last_id:
+                    last_id = id
+            self._last_ids[source] = last_id
+            if done:
+                self._loaded = True
+                self._refreshed_at = time.monotonic()
+
+    def ranking(
+        self, live_id: int, user_id: int, k: int
+    ) -> tuple[list[tuple[int, Entry]], Optional[tuple[int, Entry]]]:
+        """(top-k, the rank and entry of `user_id` or None)"""
+        with self._lock:
+            board = self._boards.get(live_id)
+            if board is None:
+                return ([], None)
+            return (board.top(k), board.get(user_id))
@@ -0,0 +1,89 @@
+import threading
+from typing import Optional
+
+
+class OpenRoomIndex:
+    """Waiting rooms per live_id, bucketed by free slots
+
+    reserve() hands out the fullest room that still has a seat and takes
+    the seat in the index at once, so two matchmakers in this process never
+    race for the last slot. The index only knows rooms this process has
+    seen; the join against the database stays the authority and callers
+    remove() rooms whose join failed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # room_id -> (live_id, free)
+        self._rooms: dict[int, tuple[int, int]] = {}
+        # live_id -> free -> room_id (dict を挿入順つきの集合として使う)
+        self._buckets: dict[int, dict[int, dict[int, None]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._rooms)
+
+    def __contains__(self, room_id: int) -> bool:
+        return room_id in self._rooms
+
+    def free_slots(self, room_id: int) -> Optional[int]:
+        entry = self._rooms.get(room_id)
+        return entry[1] if entry is not None else None
+
+    def _put(self, room_id: int, live_id: int, free: int) -> None:
+        self._rooms[room_id] = (live_id, free)
+        buckets = self._buckets.setdefault(live_id, {})
+        buckets.setdefault(free, {})[room_id] = None
+
+    def _drop(self, room_id: int) -> Optional[tuple[int, int]]:
+        entry = self._rooms.pop(room_id, None)
+        if entry is None:
+            return None
+        live_id, free = entry
+        buckets = self._buckets[live_id]
+        del buckets[free][room_id]
+        if not buckets[free]:
+            del buckets[free]
+            if not buckets:
+                del self._buckets[live_id]
+        return entry
+
+    def add(self, room_id: int, live_id: int, joined: int, max_user_count: int) -> None:
+        with self._lock:
+            self._drop(room_id)
+            self._put(room_id, live_id, max(max_user_count - joined, 0))
+
+    def update(self, room_id: int, joined_delta: int) -> None:
+        """A member joined (+1) or left (-1); unknown rooms are ignored"""
+        with self._lock:
+            entry = self._drop(room_id)
+            if entry is not None:
+                live_id, free = entry
+                self._put(room_id, live_id, max(free - joined_delta, 0))
+
+    def remove(self, room_id: int) -> None:
+        """The room started, was dissolved or deleted"""
+        with self._lock:
+            self._drop(room_id)
+
+    def has_open(self, live_id: int) -> bool:
+        with self._lock:
+            buckets = self._buckets.get(live_id, {})
+            return any(free > 0 for free in buckets)
+
+    def reserve(self, live_id: int) -> Optional[int]:
+        """Take a seat in the fullest open room of `live_id`
+
+        Ties go to the oldest room. Returns None if no room has a seat.
+        """
+        with self._lock:
+            buckets = self._buckets.get(live_id)
+            if not buckets:
+                return None
+            open_slots = [free for free in buckets if free > 0]
+            if not open_slots:
+                return None
+            free = min(open_slots)
+            room_id = next(iter(buckets[free]))
+            self._drop(room_id)
+            self._put(room_id, live_id, free - 1)
+            return room_id
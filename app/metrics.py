@@ -0,0 +1,324 @@
+"""Request, SQL and room metrics in the Prometheus text format
+
+`MetricsMiddleware` times every HTTP request per route template and counts
+errors; `instrument(engine)` adds statement counts and DB time to the
+request being served. render() produces the /metrics body.
+
+Everything is plain counters under one lock per metric, so it is cheap
+enough to leave on.
+"""
+
+import bisect
+import contextvars
+import threading
+import time
+from typing import Iterable, Optional
+
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, label_values: tuple, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, label_values: tuple) -> float:
+        return self._values.get(label_values, 0)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            yield f"{self.name}{_labels(self.labels, label_values)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...], buckets: tuple):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # label_values -> [bucket counts..., +Inf count, sum]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, label_values: tuple, value: float) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(label_values)
+            if row is None:
+                row = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[i] += 1
+            row[-1] += value
+
+    def count(self, label_values: tuple) -> int:
+        row = self._values.get(label_values)
+        return sum(row[:-1]) if row is not None else 0
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        for label_values, row in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), row):
+                cumulative += n
+                labels = _labels(self.labels + ("le",), label_values + (str(bound),))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {row[-1]}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+def _labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _gauge(
+    name: str, help: str, labels: tuple[str, ...], values: dict, kind: str = "gauge"
+) -> list[str]:
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for label_values, value in sorted(values.items()):
+        lines.append(f"{name}{_labels(labels, label_values)} {value}")
+    return lines
+
+
+request_seconds = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency",
+    ("method", "route"),
+    LATENCY_BUCKETS,
+)
+requests_total = Counter(
+    "http_requests_total", "HTTP requests", ("method", "route", "status")
+)
+request_errors = Counter(
+    "http_request_errors_total",
+    "HTTP requests that raised or returned 5xx",
+    ("method", "route"),
+)
+db_statements = Histogram(
+    "db_statements_per_request",
+    "SQL statements executed while serving one request",
+    ("route",),
+    STATEMENT_BUCKETS,
+)
+db_seconds = Histogram(
+    "db_seconds_per_request",
+    "Time spent in SQL statements while serving one request",
+    ("route",),
+    LATENCY_BUCKETS,
+)
+db_statements_total = Counter(
+    "db_statements_total", "SQL statements, including background work", ()
+)
+rooms_reaped = Counter(
+    "rooms_reaped_total",
+    "Rooms removed by the reaper (expired, dissolved, deleted)",
+    ("reason",),
+)
+reaper_seconds = Histogram(
+    "room_reaper_pass_seconds", "Duration of one reaper pass", (), LATENCY_BUCKETS
+)
+polls_rejected = Counter(
+    "polls_rejected_total",
+    "Polls answered with 429 (rate: per-token limit, overload: too many in flight)",
+    ("route", "reason"),
+)
+
+
+# リクエスト中の SQL の集計. run_in_threadpool / run_sync にもコンテキストごと渡る
+class _RequestDB:
+    __slots__ = ("statements", "seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+
+
+_current: contextvars.ContextVar[Optional[_RequestDB]] = contextvars.ContextVar(
+    "metrics_request_db", default=None
+)
+
+
+def _before_cursor_execute(conn, cursor, statement, params, context, executemany):
+    context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, params, context, executemany):
+    db_statements_total.inc(())
+    current = _current.get()
+    if current is not None:
+        current.statements += 1
+        current.seconds += time.perf_counter() - context._metrics_start
+
+
+def instrument(engine) -> None:
+    """Count statements and DB time of `engine` (a sync Engine)"""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def route_template(scope, cache: dict) -> str:
+    """Path template of the route that served `scope`, e.g. /room/events/{room_id}
+
+    `cache` maps endpoint -> template; pass the same dict every time.
+    """
+    # ルーティング後の scope には endpoint が入る. パスそのままだと
+    # /room/events/{room_id} のような経路でラベルが増え続ける
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    route = cache.get(endpoint)
+    if route is None:
+        app = scope.get("app")
+        for r in getattr(app, "routes", ()):
+            if getattr(r, "endpoint", None) is endpoint:
+                route = r.path
+                break
+        else:
+            route = scope["path"]
+        cache[endpoint] = route
+    return route
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing HTTP requests per route template"""
+
+    def __init__(self, app):
+        self.app = app
+        self._routes: dict = {}
+
+    def _route(self, scope) -> str:
+        return route_template(scope, self._routes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        db = _RequestDB()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        token = _current.set(db)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            status = 500
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            _current.reset(token)
+            route = self._route(scope)
+            method = scope["method"]
+            request_seconds.observe((method, route), elapsed)
+            requests_total.inc((method, route, str(status)))
+            if status >= 500:
+                request_errors.inc((method, route))
+            db_statements.observe((route,), db.statements)
+            db_seconds.observe((route,), db.seconds)
+
+
+_POOL_GAUGES = (
+    ("checked_out", "Connections in use"),
+    ("idle", "Idle connections in the pool"),
+    ("overflow", "Connections open beyond pool_size"),
+)
+
+# TTLCache.stats() のキー -> (メトリクス名, 説明, 型)
+_CACHE_SERIES = (
+    ("hits", "cache_hits_total", "Cache lookups that found a live entry", "counter"),
+    ("misses", "cache_misses_total", "Cache lookups that missed or expired", "counter"),
+    (
+        "evictions",
+        "cache_evictions_total",
+        "Entries dropped by the size limit",
+        "counter",
+    ),
+    ("size", "cache_entries", "Entries currently cached", "gauge"),
+)
+
+
+def render(
+    rooms_by_status: dict[str, int],
+    pool: Optional[dict] = None,
+    caches: Optional[dict[str, dict]] = None,
+) -> str:
+    """/metrics body. `rooms_by_status` is counted by the caller at scrape time
+
+    `caches` maps a cache name to its TTLCache.stats().
+    """
+    lines: list[str] = []
+    for metric in (
+        request_seconds,
+        requests_total,
+        request_errors,
+        db_statements,
+        db_seconds,
+        db_statements_total,
+        rooms_reaped,
+        reaper_seconds,
+        polls_rejected,
+    ):
+        lines.extend(metric.render())
+    lines.extend(
+        _gauge(
+            "rooms",
+            "Rooms by room_status",
+            ("status",),
+            {(status,): n for status, n in rooms_by_status.items()},
+        )
+    )
+    if pool is not None:
+        for key, help in _POOL_GAUGES:
+            lines.extend(
+                _gauge(
+                    f"db_pool_{key}",
+                    help,
+                    ("pool",),
+                    {
+                        (kind,): pool[kind][key]
+                        for kind in ("sync", "async")
+                        if kind in pool
+                    },
+                )
+            )
+    if caches is not None:
+        for key, name, help, kind in _CACHE_SERIES:
+            lines.extend(
+                _gauge(
+                    name,
+                    help,
+                    ("cache",),
+                    {(cache,): stats[key] for cache, stats in caches.items()},
+                    kind,
+                )
+            )
+    lines.append("")
+    return "\n".join(lines)
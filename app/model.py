@@ -6,16 +6,26 @@
 
 
 import json
+import time
 import uuid
 from enum import Enum, IntEnum
-from typing import Optional
+from typing import NamedTuple, Optional
 
 from fastapi import HTTPException
 from pydantic import BaseModel
-from sqlalchemy import text
-from sqlalchemy.exc import NoResultFound
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import DataError, IntegrityError, NoResultFound
 
-from .db import engine
+from . import config, events
+from .cache import TTLCache
+from .db import engine, replicas, room_shards
+from .events import RoomEvent, create_event_bus
+from .leaderboard import Leaderboards
+from .matchmaking import OpenRoomIndex
+from .notify import room_notifier
+from .registry import RoomRegistry
+from .scores import BAD_ENTRY_ERRORS, ScoreBuffer
+from .storage import begin_read
 
 
 class InvalidToken(Exception):
@@ -59,6 +69,9 @@ class RoomInfo(BaseModel):
     joined_user_count: int
     max_user_count: int
 
+    class Config:
+        orm_mode = True
+
 
 class RoomUser(BaseModel):
     user_id: int
@@ -68,31 +81,125 @@ class RoomUser(BaseModel):
     is_me: bool
     is_host: bool
 
+    class Config:
+        orm_mode = True
+
 
 class ResultUser(BaseModel):
     user_id: int
     judge_count_list: list[int]
     score: int
 
+    class Config:
+        orm_mode = True
+
+
+class RankingUser(BaseModel):
+    rank: int
+    user_id: int
+    name: str
+    leader_card_id: int
+    score: int
+
+    class Config:
+        orm_mode = True
+
+
+# model の中で持ち回る行. pydantic を作るのは api でレスポンスにするときだけ
+# (SafeUser, RoomInfo, RoomUser, ResultUser, RankingUser は orm_mode なので
+# 属性からそのまま作れる)
+class UserRow(NamedTuple):
+    id: int
+    name: str
+    leader_card_id: int
+
+
+class MemberRow(NamedTuple):
+    """RoomUser as seen by one user"""
+
+    user_id: int
+    name: str
+    leader_card_id: int
+    select_difficulty: int
+    is_me: bool
+    is_host: bool
+
+
+class ResultRow(NamedTuple):
+    user_id: int
+    judge_count_list: tuple[int, int, int, int, int]  # perfect, great, good, bad, miss
+    score: int
+
+
+class RoomRow(NamedTuple):
+    room_id: int
+    live_id: int
+    joined_user_count: int
+    max_user_count: int
+
+
+class RankingRow(NamedTuple):
+    rank: int
+    user_id: int
+    name: str
+    leader_card_id: int
+    score: int
+
 
 # user関連
 def create_user(name: str, leader_card_id: int) -> str:
     """Create new user and returns their token"""
+    with engine.begin() as conn:
+        token = _create_user(conn, name, leader_card_id)
+    _wrote(token)
+    return token
+
+
+def _create_user(conn, name: str, leader_card_id: int) -> str:
     token = str(uuid.uuid4())
     # NOTE: tokenが衝突したらリトライする必要がある.
+    result = conn.execute(
+        text(
+            "INSERT INTO `user` (name, token, leader_card_id) VALUES (:name, :token, :leader_card_id)"
+        ),
+        {"name": name, "token": token, "leader_card_id": leader_card_id},
+    )
+    # print(result)
+    return token
+
+
+def create_users(users: list[tuple[str, int]]) -> list[str]:
+    """Create many users with one multi-row INSERT
+
+    `users` is a list of (name, leader_card_id). Returns tokens in order.
+    """
     with engine.begin() as conn:
-        result = conn.execute(
+        tokens = _create_users(conn, users)
+    _wrote(*tokens)
+    return tokens
+
+
+def _create_users(conn, users: list[tuple[str, int]]) -> list[str]:
+    params = [
+        {"name": name, "token": str(uuid.uuid4()), "leader_card_id": leader_card_id}
+        for name, leader_card_id in users
+    ]
+    if params:
+        # executemany. mysqlclient は1つの INSERT ... VALUES (...), (...) にまとめる
+        conn.execute(
             text(
                 "INSERT INTO `user` (name, token, leader_card_id) VALUES (:name, :token, :leader_card_id)"
             ),
-            {"name": name, "token": token, "leader_card_id": leader_card_id},
+            params,
         )
-        # print(result)
-    return token
+    return [p["token"] for p in params]
+
+
+# token -> UserRow. update_user で無効化する
+user_cache = TTLCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
 
 
-def _get_user_by_token(conn, token: str) -> Optional[SafeUser]:
-    # TODO: 実装
+def _load_user(conn, token: str) -> Optional[UserRow]:
     result = conn.execute(
         text("SELECT `id`, `name`, `leader_card_id` FROM `user` WHERE `token`=:token"),
         dict(token=token),
@@ -101,305 +208,1170 @@ def _get_user_by_token(conn, token: str) -> Optional[SafeUser]:
         row = result.one()
     except NoResultFound:
         return None
-    return SafeUser.from_orm(row)
+    user = UserRow(*row)
+    user_cache.set(token, user)
+    return user
 
 
-def get_user_by_token(token: str) -> Optional[SafeUser]:
-    with engine.begin() as conn:
-        return _get_user_by_token(conn, token)
+def _get_user_by_token(conn, token: str) -> Optional[UserRow]:
+    """Look up a user on the caller's connection, using the cache first"""
+    user = user_cache.get(token)
+    if user is None:
+        if replicas is not None and replicas.has_users(conn):
+            user = _load_user(conn, token)
+            if user is None:
+                # レプリカにまだ届いていない
+                user = _load_primary_user(token)
+            return user
+        if not room_shards.has_users(conn):
+            # ルームのシャードには user の中身がない
+            return get_user_by_token(token)
+        user = _load_user(conn, token)
+    return user
+
+
+def get_user_by_token(token: str) -> Optional[UserRow]:
+    user = user_cache.get(token)
+    if user is not None:
+        return user
+    if replicas is not None:
+        read = replicas.engine(token)
+        if read is not engine:
+            with begin_read(read) as conn:
+                user = _load_user(conn, token)
+            if user is not None:
+                return user
+            # 作られたばかりでレプリカにまだ届いていないかもしれない
+    return _load_primary_user(token)
+
+
+def _load_primary_user(token: str) -> Optional[UserRow]:
+    with begin_read(engine) as conn:
+        return _load_user(conn, token)
 
 
 def update_user(token: str, name: str, leader_card_id: int) -> None:
-    # このコードを実装してもらう
     with engine.begin() as conn:
-        # TODO: 実装
-        conn.execute(
-            text(
-                "UPDATE `user` SET name = :name, leader_card_id = :leader_card_id WHERE token = :token"
-            ),
-            {"name": name, "token": token, "leader_card_id": leader_card_id},
-        )
+        _update_user(conn, token, name, leader_card_id)
+    _user_updated(token)
     return None
 
 
+# 書き込みの後始末 (キャッシュ, 索引, 通知). amodel も同じものを呼ぶ
+
+
+def _user_updated(token: str) -> None:
+    user_cache.pop(token)
+    _wrote(token)
+
+
+def _update_user(conn, token: str, name: str, leader_card_id: int) -> None:
+    conn.execute(
+        text(
+            "UPDATE `user` SET name = :name, leader_card_id = :leader_card_id WHERE token = :token"
+        ),
+        {"name": name, "token": token, "leader_card_id": leader_card_id},
+    )
+
+
+def _wrote(*tokens: str) -> None:
+    # 書いた token の読み込みはしばらく主 DB から (read-your-writes)
+    if replicas is not None:
+        replicas.pin(*tokens)
+
+
+def _read_engine(shard, *keys):
+    """Engine for a read-only transaction on `shard` (see app.replicas)"""
+    # レプリカがあるのは主 DB だけ
+    if replicas is None or shard.index:
+        return shard.engine
+    return replicas.engine(*keys)
+
+
+def _read_async_engine(shard, *keys):
+    if replicas is None or shard.index:
+        return shard.async_engine
+    return replicas.async_engine(*keys)
+
+
+def _room_key(room_id: int) -> tuple:
+    return ("room", room_id)
+
+
+def _lobby_key(live_id: int) -> tuple:
+    return ("lobby", live_id)
+
+
+# ROOM_REGISTRY が有効なときはルームの状態をメモリで持つ
+room_registry: Optional[RoomRegistry] = (
+    RoomRegistry(engine, config.ROOM_FLUSH_INTERVAL, config.ROOM_FLUSH_BATCH)
+    if config.ROOM_REGISTRY
+    else None
+)
+
+# /room/matchmake 用の, 空きのあるルームの索引. create/join/start/leave で更新する
+open_rooms = OpenRoomIndex()
+DEFAULT_MAX_USER_COUNT = 4  # room.max_user_count の既定値
+
+
+# ルームの状態遷移を他のワーカーに配る. 受け取った側はキャッシュと索引を合わせる
+room_events = create_event_bus(config.EVENT_BUS, config.EVENT_BUS_DIR)
+
+
+def _emit(kind: str, room_id: int, live_id: Optional[int], user_id=None) -> None:
+    room_events.publish(RoomEvent(kind, room_id, live_id, user_id))
+
+
+def _token_user_id(token: str) -> Optional[int]:
+    # 状態遷移の中で必ずキャッシュに載っている
+    user = user_cache.get(token)
+    return user.id if user is not None else None
+
+
+# 他のワーカーで起きた遷移で古くなるもの
+_LOBBY_EVENTS = frozenset(
+    (
+        events.CREATED,
+        events.JOINED,
+        events.LEFT,
+        events.STARTED,
+        events.DISSOLVED,
+        events.DELETED,
+    )
+)
+
+
+def _on_room_event(event: RoomEvent) -> None:
+    """Apply a transition made by another worker to this one's caches"""
+    if event.origin == room_events.origin:
+        return
+    room_id = event.room_id
+    room_notifier.publish(room_id)
+    if event.kind in _LOBBY_EVENTS:
+        _invalidate_lobby(event.live_id)
+    if event.kind == events.CREATED:
+        open_rooms.add(room_id, event.live_id, 1, DEFAULT_MAX_USER_COUNT)
+    elif event.kind == events.JOINED:
+        open_rooms.update(room_id, 1)
+    elif event.kind == events.LEFT:
+        open_rooms.update(room_id, -1)
+    elif event.kind in (events.STARTED, events.DISSOLVED):
+        open_rooms.remove(room_id)
+    elif event.kind == events.DELETED:
+        open_rooms.remove(room_id)
+        room_notifier.forget(room_id)
+        result_cache.pop(room_id)
+
+
+room_events.subscribe(_on_room_event)
+
+
+def _pin_changed(event: RoomEvent) -> None:
+    """Read a room (and its lobby) that just changed from the primary
+
+    Sees this worker's transitions too, so the writer's next read and
+    those of everyone polling the room do not hit a replica that has not
+    caught up yet.
+    """
+    keys = [_room_key(event.room_id)]
+    if event.kind in _LOBBY_EVENTS and event.live_id is not None:
+        keys += [_lobby_key(event.live_id), _lobby_key(0)]
+    replicas.pin(*keys)
+
+
+if replicas is not None:
+    room_events.subscribe(_pin_changed)
+
+
+def _now() -> int:
+    # room.updated_at (最後に状態が変わった時刻, UNIX 秒). 古いルームの掃除に使う
+    return int(time.time())
+
+
+def _result_row(member) -> ResultRow:
+    return ResultRow(member.user_id, member.judge_count_list, member.score)
+
+
 def create_room(token: str, live_id: int, select_difficulty: LiveDifficulty) -> int:
-    with engine.begin() as conn:
+    if room_registry is not None:
+        User = get_user_by_token(token)
+        room_id = room_registry.create_room(User, live_id, select_difficulty.value)
+    else:
+        with room_shards.place().engine.begin() as conn:
+            room_id = _create_room(conn, token, live_id, select_difficulty)
+    _room_created(token, room_id, live_id)
+    return room_id
+
+
+def _room_created(token: str, room_id: int, live_id: int) -> None:
+    room_notifier.publish(room_id)
+    _invalidate_lobby(live_id)
+    open_rooms.add(room_id, live_id, 1, DEFAULT_MAX_USER_COUNT)
+    _emit(events.CREATED, room_id, live_id, _token_user_id(token))
+
+
+def _create_room(conn, token: str, live_id: int, select_difficulty: LiveDifficulty):
+    res = conn.execute(
+        text("INSERT INTO `room` (live_id, updated_at) VALUES (:live_id, :now)"),
+        {"live_id": live_id, "now": _now()},
+    )
+    room_id = res.lastrowid
+    User = _get_user_by_token(conn, token)
+    res = conn.execute(
+        text(
+            "REPLACE INTO `room_member` (user_id, room_id, name, leader_card_id, select_difficulty, is_me, is_host)\
+             VALUES (:user_id, :room_id, :name, :leader_card_id, :select_difficulty, :is_me, :is_host)"
+        ),
+        {
+            "user_id": User.id,
+            "room_id": room_id,
+            "name": User.name,
+            "leader_card_id": User.leader_card_id,
+            "select_difficulty": select_difficulty.value,
+            "is_me": True,
+            "is_host": True,
+        },
+    )
+    return room_id
+
+
+# ロビー (live_id ごとのルーム一覧) のキャッシュ.
+# 世代番号をキーに含めておき, ルームが変わったら世代を進めて古いページを捨てる
+room_list_cache = TTLCache(config.ROOM_LIST_CACHE_SIZE, config.ROOM_LIST_CACHE_TTL)
+_lobby_generations: dict[int, int] = {}
+
+
+def _room_list_key(live_id: int, cursor: int, limit: int):
+    return (live_id, _lobby_generations.get(live_id, 0), cursor, limit)
+
+
+def lobby_version(live_id: int) -> int:
+    """Changes whenever the room list of `live_id` (0: every live) may have"""
+    return _lobby_generations.get(live_id, 0)
+
+
+def _invalidate_lobby(live_id: Optional[int]) -> None:
+    if live_id is None:
+        return
+    # live_id == 0 は全ルームの一覧なのでいっしょに捨てる
+    for key in (live_id, 0):
+        _lobby_generations[key] = _lobby_generations.get(key, 0) + 1
+
+
+def _page_args(cursor: Optional[int], limit: Optional[int]) -> tuple[int, int]:
+    if limit is None or limit <= 0 or limit > config.ROOM_LIST_PAGE_SIZE:
+        limit = config.ROOM_LIST_PAGE_SIZE
+    return (cursor or 0, limit)
+
+
+def get_room_list(
+    token: str, live_id: int, cursor: Optional[int] = None, limit: Optional[int] = None
+) -> tuple[list[RoomRow], Optional[int]]:
+    """Waiting rooms of `live_id` (all songs for 0), ordered by room_id
+
+    Returns (rooms, next_cursor). Pass next_cursor back as `cursor` to get
+    the next page; it is None on the last page.
+    """
+    cursor, limit = _page_args(cursor, limit)
+    key = _room_list_key(live_id, cursor, limit)
+    page = room_list_cache.get(key)
+    if page is not None:
+        return page
+    if room_registry is not None:
+        rows = room_registry.get_room_list(live_id, cursor, limit + 1)
+    else:
+        rows = _gather_room_list(live_id, cursor, limit + 1)
+    page = _room_list_page(rows, limit)
+    room_list_cache.set(key, page)
+    return page
+
+
+def _room_list_page(rows, limit: int) -> tuple[list[RoomRow], Optional[int]]:
+    page = [RoomRow(*row) for row in rows[:limit]]
+    next_cursor = page[-1].room_id if len(rows) > limit else None
+    return (page, next_cursor)
+
+
+def _gather_room_list(live_id: int, cursor: int, limit: int) -> list:
+    """_get_room_list over every shard"""
+    pages = []
+    for shard in room_shards:
+        with begin_read(_read_engine(shard, _lobby_key(live_id))) as conn:
+            pages.append(_get_room_list(conn, live_id, cursor, limit))
+    return _merge_room_lists(pages, limit)
+
+
+def _merge_room_lists(pages: list, limit: int) -> list:
+    # 各シャードの先頭 limit 件から全体の先頭 limit 件を選ぶ
+    if len(pages) == 1:
+        return pages[0]
+    rows = [row for page in pages for row in page]
+    rows.sort(key=lambda row: row[0])
+    return rows[:limit]
+
+
+def _get_room_list(conn, live_id: int, cursor: int, limit: int):
+    # (live_id, room_status) のインデックスを使う. room_id は InnoDB の
+    # セカンダリインデックスに含まれるのでカーソルとソートもインデックスで済む
+    if live_id == 0:
         res = conn.execute(
-            text("INSERT INTO `room` (live_id) VALUES (:live_id)"),
-            {"live_id": live_id},
+            text(
+                "SELECT room_id, live_id, joined_user_count, max_user_count FROM room\
+                 WHERE room_status = 1 AND room_id > :cursor ORDER BY room_id LIMIT :limit"
+            ),
+            {"cursor": cursor, "limit": limit},
         )
-        room_id = res.lastrowid
-        User = get_user_by_token(token)
+    else:
         res = conn.execute(
             text(
-                "REPLACE INTO `room_member` (user_id, room_id, name, leader_card_id, select_difficulty, is_me, is_host)\
-                 VALUES (:user_id, :room_id, :name, :leader_card_id, :select_difficulty, :is_me, :is_host)"
+                "SELECT room_id, live_id, joined_user_count, max_user_count FROM room\
+                 WHERE live_id = :live_id AND room_status = 1 AND room_id > :cursor\
+                 ORDER BY room_id LIMIT :limit"
             ),
-            {
-                "user_id": User.id,
-                "room_id": room_id,
-                "name": User.name,
-                "leader_card_id": User.leader_card_id,
-                "select_difficulty": select_difficulty.value,
-                "is_me": True,
-                "is_host": True,
-            },
+            {"live_id": live_id, "cursor": cursor, "limit": limit},
         )
+    return res.all()
 
-        return room_id
 
+def count_rooms() -> dict[int, int]:
+    """Number of rooms per room_status, for monitoring"""
+    if room_registry is not None:
+        return room_registry.count_by_status()
+    counts: dict[int, int] = {}
+    for shard in room_shards:
+        with begin_read(shard.engine) as conn:
+            for status, n in _count_rooms(conn).items():
+                counts[status] = counts.get(status, 0) + n
+    return counts
 
-def get_room_list(token: str, live_id: int):
-    with engine.begin() as conn:
-        if live_id == 0:
-            res = conn.execute(
-                text(
-                    "SELECT room_id, live_id, joined_user_count, max_user_count FROM room WHERE room_status = 1"
-                ),
-            )
-        else:
-            res = conn.execute(
-                text(
-                    "SELECT room_id, live_id, joined_user_count, max_user_count FROM room WHERE live_id= :live_id AND room_status = 1"
-                ),
-                {"live_id": live_id},
-            )
-        print("here")
-        print(res)
-        try:
-            res = res.all()
-            return res
-        except:
-            return []
+
+def _count_rooms(conn) -> dict[int, int]:
+    # room_status のインデックスだけで数えられる
+    res = conn.execute(
+        text("SELECT room_status, COUNT(*) FROM room GROUP BY room_status")
+    )
+    return {status: n for status, n in res}
 
 
 def join_room(token: str, room_id: int, select_difficulty: LiveDifficulty):
-    with engine.begin() as conn:
-        res = conn.execute(
-            text(
-                "SELECT joined_user_count, max_user_count, room_status FROM room WHERE room_id=:room_id"
-            ),
-            {"room_id": room_id},
+    result = _join(token, room_id, select_difficulty)
+    _join_finished(room_id, result)
+    return result
+
+
+def _join_finished(room_id: int, result: JoinRoomResult) -> None:
+    # matchmake は reserve() で席を数え済みなので使わない
+    if result == JoinRoomResult.Ok:
+        open_rooms.update(room_id, 1)
+    else:
+        open_rooms.remove(room_id)
+
+
+def _join(token: str, room_id: int, select_difficulty: LiveDifficulty):
+    """join_room without touching open_rooms"""
+    if room_registry is not None:
+        User = get_user_by_token(token)
+        result, live_id = room_registry.join_room(
+            User, room_id, select_difficulty.value
         )
+        result = JoinRoomResult(result)
+    else:
         try:
-            joined_user_count, max_user_count, room_status = res.one()
-            # ゲーム中/解散済みを確認
-            if room_status == 2:
-                return 4
-            elif room_status == 3:
-                return 3
-
-            User = get_user_by_token(token)
-            if joined_user_count < max_user_count:  # 定員より少なければ
-                res = conn.execute(
-                    text(
-                        "UPDATE room\
-                        SET joined_user_count = :joined_user_count \
-                        WHERE room_id = :room_id"
-                    ),
-                    {"joined_user_count": joined_user_count, "room_id": room_id},
-                )
-                res = conn.execute(
-                    text(
-                        "REPLACE INTO `room_member` (user_id, room_id, name, leader_card_id, select_difficulty, is_me, is_host)\
-                        VALUES (:user_id, :room_id, :name, :leader_card_id, :select_difficulty, :is_me, :is_host)"
-                    ),
-                    {
-                        "user_id": User.id,
-                        "room_id": room_id,
-                        "name": User.name,
-                        "leader_card_id": User.leader_card_id,
-                        "select_difficulty": select_difficulty.value,
-                        "is_me": True,
-                        "is_host": False,
-                    },
-                )
-                return JoinRoomResult(1)
-            else:
-                return JoinRoomResult(2)
-        except:
-            return JoinRoomResult(4)
+            with room_shards.for_room(room_id).engine.begin() as conn:
+                result, live_id = _join_room(conn, token, room_id, select_difficulty)
+        except IntegrityError:
+            # すでにメンバー (join のリトライなど). 人数の加算はロールバック済み
+            return JoinRoomResult.Ok
+    if result == JoinRoomResult.Ok:
+        _room_joined(token, room_id, live_id)
+    return result
 
 
-def wait_room(token: str, room_id: int):
-    with engine.begin() as conn:
-        User = get_user_by_token(token)
+def _room_joined(token: str, room_id: int, live_id: int) -> None:
+    room_notifier.publish(room_id)
+    _invalidate_lobby(live_id)
+    _emit(events.JOINED, room_id, live_id, _token_user_id(token))
+
+
+def _join_room(conn, token: str, room_id: int, select_difficulty: LiveDifficulty):
+    """Returns (JoinRoomResult, live_id)
+
+    The seat is taken by a single guarded UPDATE before anything is read,
+    so concurrent joins can never overfill the room. Raises IntegrityError
+    if the user is already a member; the caller must let the transaction
+    roll back.
+    """
+    res = conn.execute(
+        text(
+            "UPDATE room SET joined_user_count = joined_user_count + 1, updated_at = :now\
+             WHERE room_id = :room_id AND room_status = 1\
+             AND joined_user_count < max_user_count"
+        ),
+        {"room_id": room_id, "now": _now()},
+    )
+    if res.rowcount != 1:
+        # 満員か, 開始/解散済みか, ルームがない
         res = conn.execute(
-            text("SELECT room_status FROM room WHERE room_id=:room_id"),
+            text("SELECT room_status, live_id FROM room WHERE room_id=:room_id"),
             {"room_id": room_id},
         )
-        status = res.one()[0]
+        row = res.one_or_none()
+        if row is None:
+            return (JoinRoomResult.Disbanned, None)
+        room_status, live_id = row
+        if room_status != 1:
+            return (_join_error(room_status), live_id)
+        # 満員でも自分がすでにメンバーなら join のリトライ
+        User = _get_user_by_token(conn, token)
         res = conn.execute(
             text(
-                "SELECT user_id, name, leader_card_id, select_difficulty, is_me, is_host\
-                 FROM room_member WHERE room_id=:room_id"
+                "SELECT 1 FROM room_member WHERE room_id=:room_id AND user_id=:user_id"
             ),
-            {"room_id": room_id},
+            {"room_id": room_id, "user_id": User.id},
         )
-        room_user_list = []
-        room_user_list_nonarranged = res.all()
-        for room_user in room_user_list_nonarranged:
-            # is_meチェック
-            if room_user[0] != User.id:
-                room_user = list(room_user)
-                room_user[4] = 0
-            room_user_list.append(
-                RoomUser(
-                    user_id=room_user[0],
-                    name=room_user[1],
-                    leader_card_id=room_user[2],
-                    select_difficulty=room_user[3],
-                    is_me=room_user[4],
-                    is_host=room_user[5],
-                )
-            )
-    return (status, room_user_list)
+        if res.first() is not None:
+            return (JoinRoomResult.Ok, live_id)
+        return (JoinRoomResult.RoomFull, live_id)
 
+    # 席を取った行は UPDATE でロック済み
+    live_id = conn.execute(
+        text("SELECT live_id FROM room WHERE room_id=:room_id"),
+        {"room_id": room_id},
+    ).scalar()
+    User = _get_user_by_token(conn, token)
+    conn.execute(
+        text(
+            "INSERT INTO `room_member` (user_id, room_id, name, leader_card_id, select_difficulty, is_me, is_host)\
+            VALUES (:user_id, :room_id, :name, :leader_card_id, :select_difficulty, :is_me, :is_host)"
+        ),
+        {
+            "user_id": User.id,
+            "room_id": room_id,
+            "name": User.name,
+            "leader_card_id": User.leader_card_id,
+            "select_difficulty": select_difficulty.value,
+            "is_me": True,
+            "is_host": False,
+        },
+    )
+    return (JoinRoomResult.Ok, live_id)
 
-def start_room(token: str, room_id: int):
-    # TODO
-    # オーナーかどうかのチェック
-    with engine.begin() as conn:
+
+def matchmake(
+    token: str, live_id: int, select_difficulty: LiveDifficulty
+) -> tuple[int, bool]:
+    """Join the fullest waiting room of `live_id`, or create one
+
+    Returns (room_id, created). Candidates come from open_rooms; a failed
+    join drops the room from the index and the next one is tried.
+    """
+    attempts = 0
+    refilled = False
+    while attempts < config.MATCHMAKE_ATTEMPTS:
+        room_id = open_rooms.reserve(live_id)
+        if room_id is None:
+            if refilled:
+                break
+            # 他のワーカーが作ったルームを拾う
+            _refill_open_rooms(_open_room_rows(live_id))
+            refilled = True
+            continue
+        attempts += 1
+        result = _join(token, room_id, select_difficulty)
+        if result == JoinRoomResult.Ok:
+            return (room_id, False)
+        open_rooms.remove(room_id)
+    return (create_room(token, live_id, select_difficulty), True)
+
+
+def _open_room_rows(live_id: int):
+    if room_registry is not None:
+        return room_registry.get_room_list(live_id, 0, config.ROOM_LIST_PAGE_SIZE)
+    return _gather_room_list(live_id, 0, config.ROOM_LIST_PAGE_SIZE)
+
+
+def _refill_open_rooms(rows) -> None:
+    for room_id, live_id, joined_user_count, max_user_count in rows:
+        if room_id not in open_rooms:
+            open_rooms.add(room_id, live_id, joined_user_count, max_user_count)
+
+
+def _join_error(room_status: int) -> JoinRoomResult:
+    # ゲーム中/解散済み
+    if room_status == 3:
+        return JoinRoomResult.Disbanned
+    return JoinRoomResult.OtherError
+
+
+def wait_room(token: str, room_id: int) -> tuple[int, list[MemberRow]]:
+    """Returns (WaitRoomStatus value, member rows)"""
+    if room_registry is not None:
         User = get_user_by_token(token)
-        res = conn.execute(
-            text(
-                "SELECT is_host\
-                FROM room_member WHERE room_id = :room_id AND user_id=:user_id"
-            ),
-            {"room_id": room_id, "user_id": User.id},
-        )
-        # もしホストでないならば
-        is_host = res.one()[0]
-        if is_host == False:
-            return
-        res = conn.execute(
-            text("UPDATE room SET room_status = 2 WHERE room_id=:room_id"),
-            {"room_id": room_id},
+        status, members = room_registry.wait_room(room_id)
+        return (status, _member_rows(members, User.id))
+    shard = room_shards.for_room(room_id)
+    with begin_read(_read_engine(shard, token, _room_key(room_id))) as conn:
+        return _wait_room(conn, token, room_id)
+
+
+def _wait_room(conn, token: str, room_id: int):
+    status, rows = _wait_room_rows(conn, token, room_id)
+    if status is None:  # 最後の一人が抜けて削除済み
+        return (WaitRoomStatus.Dissolution.value, [])
+    return (status, rows)
+
+
+def _member_rows(members, user_id: int) -> list[MemberRow]:
+    return [
+        MemberRow(
+            m.user_id,
+            m.name,
+            m.leader_card_id,
+            m.select_difficulty,
+            m.user_id == user_id,
+            m.is_host,
         )
-        return
+        for m in members
+    ]
+
+
+def _wait_room_rows(conn, token: str, room_id: int):
+    """Returns (room_status or None if the room is gone, member rows)"""
+    User = _get_user_by_token(conn, token)
+    res = conn.execute(
+        text("SELECT room_status FROM room WHERE room_id=:room_id"),
+        {"room_id": room_id},
+    )
+    row = res.one_or_none()
+    if row is None:
+        return (None, [])
+    status = row[0]
+    res = conn.execute(
+        text(
+            "SELECT user_id, name, leader_card_id, select_difficulty, is_me, is_host\
+             FROM room_member WHERE room_id=:room_id"
+        ),
+        {"room_id": room_id},
+    )
+    # is_meチェック
+    rows = [
+        MemberRow(r[0], r[1], r[2], r[3], r[0] == User.id and bool(r[4]), bool(r[5]))
+        for r in res.all()
+    ]
+    return (status, rows)
+
+
+def start_room(token: str, room_id: int):
+    if room_registry is not None:
+        User = get_user_by_token(token)
+        live_id = room_registry.start_room(User, room_id)
+    else:
+        with room_shards.for_room(room_id).engine.begin() as conn:
+            live_id = _start_room(conn, token, room_id)
+    if live_id is not None:
+        _room_started(room_id, live_id)
+    return
+
+
+def _room_started(room_id: int, live_id: int) -> None:
+    room_notifier.publish(room_id)
+    _invalidate_lobby(live_id)
+    open_rooms.remove(room_id)
+    _emit(events.STARTED, room_id, live_id)
+
+
+def _start_room(conn, token: str, room_id: int) -> Optional[int]:
+    """Returns the live_id of the room if it was started"""
+    # オーナーかどうかのチェック
+    User = _get_user_by_token(conn, token)
+    res = conn.execute(
+        text(
+            "SELECT m.is_host, r.live_id\
+            FROM room_member m JOIN room r ON r.room_id = m.room_id\
+            WHERE m.room_id = :room_id AND m.user_id=:user_id"
+        ),
+        {"room_id": room_id, "user_id": User.id},
+    )
+    # もしホストでないならば
+    is_host, live_id = res.one()
+    if is_host == False:
+        return None
+    res = conn.execute(
+        text(
+            "UPDATE room SET room_status = 2, updated_at = :now WHERE room_id=:room_id"
+        ),
+        {"room_id": room_id, "now": _now()},
+    )
+    return live_id
+
+
+# 確定したリザルト. room_id -> list[ResultRow]
+# 最後のスコアが届いたときに作り, /room/result はここから返す
+result_cache = TTLCache(config.RESULT_CACHE_SIZE, config.RESULT_CACHE_TTL)
 
 
 def end_room(token: str, room_id: int, judge_count_list: list[int], score: int):
-    with engine.begin() as conn:
+    if score_buffer is not None:
+        if score_buffer.submit(room_id, token, judge_count_list, score):
+            score_buffer.flush()
+        return
+    if room_registry is not None:
         User = get_user_by_token(token)
-        res = conn.execute(
-            text(
-                "UPDATE room_member \
-                SET score = :score, \
-                score_perfect= :score_perfect, \
-                score_great= :score_great, \
-                score_good= :score_good, \
-                score_bad= :score_bad, \
-                score_miss= :score_miss \
-                WHERE user_id=:user_id"
-            ),
-            {
-                "user_id": User.id,
-                "score": score,
-                "score_perfect": judge_count_list[0],
-                "score_great": judge_count_list[1],
-                "score_good": judge_count_list[2],
-                "score_bad": judge_count_list[3],
-                "score_miss": judge_count_list[4],
-            },
+        members, dissolved = room_registry.end_room(
+            User, room_id, judge_count_list, score
         )
+        _store_result(room_id, _result_rows(members), dissolved)
         return
+    with room_shards.for_room(room_id).engine.begin() as conn:
+        result_user_list, dissolved = _end_room(
+            conn, token, room_id, judge_count_list, score
+        )
+    _store_result(room_id, result_user_list, dissolved)
+    return
 
 
-def result_room(token: str, room_id: int):
-    # TODO
-    with engine.begin() as conn:
-        User = get_user_by_token(token)
-        res = conn.execute(
+def _end_room(conn, token: str, room_id: int, judge_count_list: list[int], score: int):
+    """Store the score and finalize the result if it was the last one
+
+    Returns the same as _result_room.
+    """
+    User = _get_user_by_token(conn, token)
+    res = conn.execute(
+        text(
+            "UPDATE room_member \
+            SET score = :score, \
+            score_perfect= :score_perfect, \
+            score_great= :score_great, \
+            score_good= :score_good, \
+            score_bad= :score_bad, \
+            score_miss= :score_miss \
+            WHERE room_id=:room_id AND user_id=:user_id"
+        ),
+        {
+            "room_id": room_id,
+            "user_id": User.id,
+            "score": score,
+            "score_perfect": judge_count_list[0],
+            "score_great": judge_count_list[1],
+            "score_good": judge_count_list[2],
+            "score_bad": judge_count_list[3],
+            "score_miss": judge_count_list[4],
+        },
+    )
+    _record_scores(conn, [{"room_id": room_id, "user_id": User.id, "score": score}])
+    return _result_room(conn, room_id)
+
+
+def _record_scores(conn, params: list[dict]) -> None:
+    # スコアの履歴. ルームのメンバーでなければ何も入らない
+    now = _now()
+    conn.execute(
+        text(
+            "INSERT INTO live_score (live_id, user_id, name, leader_card_id, room_id, score, created_at)\
+             SELECT r.live_id, m.user_id, m.name, m.leader_card_id, m.room_id, :score, :now\
+             FROM room_member m JOIN room r ON r.room_id = m.room_id\
+             WHERE m.room_id = :room_id AND m.user_id = :user_id"
+        ),
+        [
+            {
+                "room_id": p["room_id"],
+                "user_id": p["user_id"],
+                "score": p["score"],
+                "now": now,
+            }
+            for p in params
+        ],
+    )
+
+
+def end_rooms(entries: list[tuple[int, str, list[int], int]]) -> int:
+    """Store many scores at once
+
+    `entries` is a list of (room_id, token, judge_count_list, score).
+    Entries with an unknown token are skipped. Returns the number stored.
+    """
+    if room_registry is not None:
+        # キャッシュにないユーザーは 1 回の SELECT で読む
+        users = _get_users_by_tokens(None, [entry[1] for entry in entries])
+        stored = 0
+        for room_id, token, judge_count_list, score in entries:
+            User = users.get(token)
+            if User is None:
+                continue
+            members, dissolved = room_registry.end_room(
+                User, room_id, judge_count_list, score
+            )
+            _store_result(room_id, _result_rows(members), dissolved)
+            stored += 1
+        return stored
+    stored = 0
+    results = {}
+    for shard, shard_entries in _entries_by_shard(entries):
+        with shard.engine.begin() as conn:
+            n, shard_results = _end_rooms(conn, shard_entries)
+        stored += n
+        results.update(shard_results)
+    _store_results(results)
+    return stored
+
+
+# SCORE_BUFFER: /room/end はここに積み, まとめて end_rooms で書く
+score_buffer: Optional[ScoreBuffer] = (
+    ScoreBuffer(
+        end_rooms,
+        config.SCORE_FLUSH_INTERVAL,
+        config.SCORE_BUFFER_MAX,
+        BAD_ENTRY_ERRORS + (DataError, IntegrityError),
+    )
+    if config.SCORE_BUFFER
+    else None
+)
+
+
+def _flush_scores(room_id: int) -> None:
+    # まだ書いていないスコアがあるルームは, 読む前に書く
+    if score_buffer is not None and score_buffer.has_pending(room_id):
+        score_buffer.flush()
+
+
+def _entries_by_shard(entries):
+    """[(shard, entries of its rooms), ...] for end_rooms"""
+    by_shard: dict[int, list] = {}
+    for entry in entries:
+        by_shard.setdefault(room_shards.for_room(entry[0]).index, []).append(entry)
+    return [(room_shards.shards[i], e) for i, e in sorted(by_shard.items())]
+
+
+def _get_users_by_tokens(conn, tokens) -> dict[str, UserRow]:
+    """Cached users, reading the rest on `conn` (or a new connection if None)"""
+    users = {}
+    missing = []
+    for token in set(tokens):
+        user = user_cache.get(token)
+        if user is None:
+            missing.append(token)
+        else:
+            users[token] = user
+    if missing:
+        if conn is not None and room_shards.has_users(conn):
+            users.update(_load_users(conn, missing))
+        else:
+            with begin_read(engine) as user_conn:
+                users.update(_load_users(user_conn, missing))
+    return users
+
+
+def _load_users(conn, tokens) -> dict[str, UserRow]:
+    res = conn.execute(
+        text(
+            "SELECT `id`, `name`, `leader_card_id`, `token` FROM `user` WHERE `token` IN :tokens"
+        ).bindparams(bindparam("tokens", expanding=True)),
+        {"tokens": tokens},
+    )
+    users = {}
+    for row in res:
+        user = UserRow(row[0], row[1], row[2])
+        user_cache.set(row.token, user)
+        users[row.token] = user
+    return users
+
+
+def _end_rooms(conn, entries):
+    """Returns (number of stored scores, {room_id: result list or None})"""
+    users = _get_users_by_tokens(conn, [entry[1] for entry in entries])
+    params = [
+        {
+            "room_id": room_id,
+            "user_id": users[token].id,
+            "score": score,
+            "score_perfect": judge_count_list[0],
+            "score_great": judge_count_list[1],
+            "score_good": judge_count_list[2],
+            "score_bad": judge_count_list[3],
+            "score_miss": judge_count_list[4],
+        }
+        for room_id, token, judge_count_list, score in entries
+        if token in users
+    ]
+    if not params:
+        return (0, {})
+    conn.execute(
+        text(
+            "UPDATE room_member \
+            SET score = :score, \
+            score_perfect= :score_perfect, \
+            score_great= :score_great, \
+            score_good= :score_good, \
+            score_bad= :score_bad, \
+            score_miss= :score_miss \
+            WHERE room_id=:room_id AND user_id=:user_id"
+        ),
+        params,
+    )
+    _record_scores(conn, params)
+    # 書いたルームのリザルトが揃ったかをまとめて確認する
+    room_ids = sorted({p["room_id"] for p in params})
+    res = conn.execute(
+        text(
+            "SELECT room_id, user_id, score_perfect, score_great, score_good, score_bad, score_miss, score\
+            FROM room_member WHERE room_id IN :room_ids"
+        ).bindparams(bindparam("room_ids", expanding=True)),
+        {"room_ids": room_ids},
+    )
+    results: dict[int, Optional[list[ResultRow]]] = {}
+    for row in res:
+        room_id = row[0]
+        if room_id in results and results[room_id] is None:
+            continue
+        if None in row:  # スコアが未送信の人がいる
+            results[room_id] = None
+            continue
+        results.setdefault(room_id, []).append(
+            ResultRow(row[1], tuple(row[2:7]), row[7])
+        )
+    finished = [room_id for room_id, result in results.items() if result is not None]
+    if finished:
+        conn.execute(
             text(
-                "SELECT user_id, score_perfect, score_great, score_good, score_bad, score_miss, score\
-                FROM room_member WHERE room_id = :room_id"
-            ),
-            {"room_id": room_id},
+                "UPDATE room SET room_status = 3, updated_at = :now\
+                 WHERE room_id IN :room_ids AND room_status != 3"
+            ).bindparams(bindparam("room_ids", expanding=True)),
+            {"room_ids": finished, "now": _now()},
         )
-        result_user_list_nonarranged = res.all()
-        result_user_list = []
-        can_return_result = True  # スコアを返却できるか
+    return (len(params), results)
 
-        for score_list in result_user_list_nonarranged:
-            if None in score_list:  # スコアが未送信の人がいないかチェック
-                can_return_result = False
-                break
-            result_user_list.append(
-                ResultUser(
-                    user_id=score_list[0],
-                    judge_count_list=score_list[1:6],
-                    score=score_list[6],
-                )
-            )
 
-        res = conn.execute(
-            text("UPDATE room SET room_status = 3 WHERE room_id = :room_id"),
-            {"room_id": room_id},
+def _result_rows(members) -> Optional[list[ResultRow]]:
+    if members is None:
+        return None
+    return [_result_row(m) for m in members]
+
+
+def _store_result(
+    room_id: int, result_user_list: Optional[list[ResultRow]], dissolved: bool
+) -> None:
+    if result_user_list is not None:
+        result_cache.set(room_id, result_user_list)
+    if dissolved:
+        room_notifier.publish(room_id)
+        _emit(events.RESULT_READY, room_id, None)
+
+
+def _store_results(results: dict[int, Optional[list[ResultRow]]]) -> None:
+    """_store_result for what _end_rooms returns (None: scores still missing)"""
+    for room_id, result_user_list in results.items():
+        _store_result(room_id, result_user_list, result_user_list is not None)
+
+
+def result_room(token: str, room_id: int):
+    _flush_scores(room_id)
+    result_user_list = result_cache.get(room_id)
+    if result_user_list is not None:
+        return result_user_list
+    # 他のワーカーで確定した, あるいはキャッシュから追い出された
+    if room_registry is not None:
+        members, dissolved = room_registry.result_room(room_id)
+        result_user_list = _result_rows(members)
+    else:
+        shard = room_shards.for_room(room_id)
+        result_user_list, dissolved = None, False
+        read = _read_engine(shard, _room_key(room_id))
+        ready = True
+        if read is not shard.engine:
+            # 揃うまではレプリカで見る. 遅れていても「まだ」と答えるだけで,
+            # 揃っていたら主 DB で読み直して確定させる
+            with begin_read(read) as conn:
+                ready = _read_results(conn, room_id) is not None
+        if ready:
+            with shard.engine.begin() as conn:
+                result_user_list, dissolved = _result_room(conn, room_id)
+    _store_result(room_id, result_user_list, dissolved)
+    return result_user_list or []
+
+
+def _result_room(conn, room_id: int):
+    """Returns (result list or None while scores are missing, dissolved now)
+
+    Once every member has a score the room is marked dissolved.
+    """
+    result_user_list = _read_results(conn, room_id)
+    if result_user_list is None:
+        return (None, False)
+    res = conn.execute(
+        text(
+            "UPDATE room SET room_status = 3, updated_at = :now\
+             WHERE room_id = :room_id AND room_status != 3"
+        ),
+        {"room_id": room_id, "now": _now()},
+    )
+    return (result_user_list, res.rowcount > 0)
+
+
+def _read_results(conn, room_id: int) -> Optional[list[ResultRow]]:
+    """The results of a room, None while scores are missing"""
+    res = conn.execute(
+        text(
+            "SELECT user_id, score_perfect, score_great, score_good, score_bad, score_miss, score\
+            FROM room_member WHERE room_id = :room_id"
+        ),
+        {"room_id": room_id},
+    )
+    result_user_list_nonarranged = res.all()
+    result_user_list = []
+    can_return_result = True  # スコアを返却できるか
+
+    for score_list in result_user_list_nonarranged:
+        if None in score_list:  # スコアが未送信の人がいないかチェック
+            can_return_result = False
+            break
+        result_user_list.append(
+            ResultRow(score_list[0], tuple(score_list[1:6]), score_list[6])
         )
-        if can_return_result:
-            return result_user_list
-        else:
-            return []
+
+    if not can_return_result:
+        return None
+    return result_user_list
+
+
+# ランキング. live_score を id 順に追いかけてメモリ上で順位を持つ
+leaderboards = Leaderboards(
+    config.RANKING_REFRESH_INTERVAL, config.RANKING_TAIL_OVERLAP
+)
+
+
+def get_ranking(
+    token: str, live_id: int, limit: Optional[int] = None
+) -> tuple[list[RankingRow], Optional[RankingRow]]:
+    """Top `limit` users of `live_id` by best score, and the caller's rank
+
+    Scores recorded by any worker show up within RANKING_REFRESH_INTERVAL.
+    """
+    User = get_user_by_token(token)
+    if leaderboards.needs_refresh():
+        refresh_ranking()
+    return _ranking(live_id, User.id, limit)
+
+
+def refresh_ranking() -> None:
+    """Read new live_score rows; the first call loads the whole table"""
+    last = len(room_shards) - 1
+    for shard in room_shards:
+        with begin_read(shard.engine) as conn:
+            rows = _score_rows(conn, leaderboards.since_id(shard.index))
+        leaderboards.apply(rows, shard.index, done=shard.index == last)
+
+
+def _score_rows(conn, since_id: int):
+    # 主キーの範囲で読む. 最初の1回 (since_id = 0) だけ全件
+    res = conn.execute(
+        text(
+            "SELECT id, live_id, user_id, name, leader_card_id, score FROM live_score\
+             WHERE id > :since_id ORDER BY id"
+        ),
+        {"since_id": since_id},
+    )
+    return res.all()
+
+
+def _ranking(live_id: int, user_id: int, limit: Optional[int]):
+    if limit is None or limit <= 0 or limit > config.RANKING_TOP_K:
+        limit = config.RANKING_TOP_K
+    top, me = leaderboards.ranking(live_id, user_id, limit)
+    return (
+        [_ranking_row(rank, entry) for rank, entry in top],
+        _ranking_row(*me) if me is not None else None,
+    )
+
+
+def _ranking_row(rank: int, entry) -> RankingRow:
+    return RankingRow(
+        rank, entry.user_id, entry.name, entry.leader_card_id, entry.score
+    )
 
 
 def leave_room(token: str, room_id: int):
-    # TODO
-    with engine.begin() as conn:
+    _flush_scores(room_id)
+    if room_registry is not None:
         User = get_user_by_token(token)
+        deleted, live_id, next_host = room_registry.leave_room(User, room_id)
+    else:
+        with room_shards.for_room(room_id).engine.begin() as conn:
+            deleted, live_id, next_host = _leave_room(conn, token, room_id)
+    _room_left(token, room_id, deleted, live_id, next_host)
+    return
+
+
+def _room_left(
+    token: str, room_id: int, deleted: bool, live_id: int, next_host: Optional[int]
+) -> None:
+    room_notifier.publish(room_id)
+    _invalidate_lobby(live_id)
+    if deleted:
+        room_notifier.forget(room_id)
+        result_cache.pop(room_id)
+        open_rooms.remove(room_id)
+        _emit(events.DELETED, room_id, live_id)
+        return
+    open_rooms.update(room_id, -1)
+    _emit(events.LEFT, room_id, live_id, _token_user_id(token))
+    if next_host is not None:
+        _emit(events.HOST_CHANGED, room_id, live_id, next_host)
+
+
+def _leave_room(conn, token: str, room_id: int) -> tuple[bool, int, Optional[int]]:
+    """Returns (whether the room was deleted, live_id, the new host or None)"""
+    User = _get_user_by_token(conn, token)
+    res = conn.execute(
+        text(
+            "SELECT m.is_host, r.live_id\
+            FROM room_member m JOIN room r ON r.room_id = m.room_id\
+            WHERE m.user_id=:user_id AND m.room_id=:room_id"
+        ),
+        {"user_id": User.id, "room_id": room_id},
+    )
+    is_host, live_id = res.one()
+    res = conn.execute(
+        text("DELETE from room_member WHERE user_id=:user_id AND room_id=:room_id"),
+        {"user_id": User.id, "room_id": room_id},
+    )
+    res = conn.execute(
+        text("SELECT count(user_id) from room_member WHERE room_id = :room_id"),
+        {"room_id": room_id},
+    )
+    joined_user_count = res.one()[0]
+    if joined_user_count == 0:
         res = conn.execute(
-            text(
-                "SELECT is_host from room_member WHERE user_id=:user_id AND room_id=:room_id"
-            ),
-            {"user_id": User.id, "room_id": room_id},
+            # text("UPDATE room\
+            #    SET joined_user_count = :joined_user_count, \
+            #        room_status = 3\
+            #    WHERE room_id = :room_id"),
+            text("DELETE from room WHERE room_id = :room_id"),
+            {"joined_user_count": joined_user_count, "room_id": room_id},
         )
-        is_host = res.one()[0]
+        return (True, live_id, None)
+    res = conn.execute(
+        text(
+            "UPDATE room\
+            SET joined_user_count = :joined_user_count, updated_at = :now \
+            WHERE room_id = :room_id"
+        ),
+        {"joined_user_count": joined_user_count, "room_id": room_id, "now": _now()},
+    )
+    next_host_user_id = None
+    if is_host:
         res = conn.execute(
-            text("DELETE from room_member WHERE user_id=:user_id AND room_id=:room_id"),
-            {"user_id": User.id, "room_id": room_id},
+            text("SELECT user_id from room_member WHERE room_id = :room_id"),
+            {"room_id": room_id},
         )
+        # オーナー変更
+        next_host_user_id = res.all()[0][0]
         res = conn.execute(
-            text("SELECT count(user_id) from room_member WHERE room_id = :room_id"),
-            {"room_id": room_id},
+            text(
+                "UPDATE room_member\
+                SET is_host = 1 \
+                WHERE room_id = :room_id AND user_id = :user_id"
+            ),
+            {
+                "room_id": room_id,
+                "user_id": next_host_user_id,
+            },
         )
-        joined_user_count = res.one()[0]
-        if joined_user_count == 0:
-            res = conn.execute(
-                # text("UPDATE room\
-                #    SET joined_user_count = :joined_user_count, \
-                #        room_status = 3\
-                #    WHERE room_id = :room_id"),
-                text("DELETE from room WHERE room_id = :room_id"),
-                {"joined_user_count": joined_user_count, "room_id": room_id},
-            )
+    return (False, live_id, next_host_user_id)
+
+
+# 古いルームの掃除 (app.reaper から定期的に呼ぶ)
+# (理由, room_status, TTL の設定名). 待機中と終了済みは削除, ライブ中は解散させる
+_REAP_RULES = (
+    ("expired", 1, "ROOM_WAITING_TTL"),
+    ("dissolved", 2, "ROOM_LIVE_TTL"),
+    ("deleted", 3, "ROOM_FINISHED_TTL"),
+)
+
+
+def reap_rooms(now: Optional[int] = None) -> dict[str, int]:
+    """Expire idle waiting rooms, dissolve stuck live rooms, delete finished ones
+
+    Works in transactions of at most ROOM_REAPER_BATCH rooms. Returns the
+    number of rooms reaped per reason.
+    """
+    if now is None:
+        now = _now()
+    batch = config.ROOM_REAPER_BATCH
+    counts = {}
+    for reason, status, ttl in _REAP_RULES:
+        older_than = now - getattr(config, ttl)
+        reaped = 0
+        while True:
+            if room_registry is not None:
+                rooms = room_registry.reap(status, older_than, batch)
+                if status == 3 and len(rooms) < batch:
+                    # 起動前に終わったルームはメモリにない
+                    with engine.begin() as conn:
+                        rooms += _reap_rooms(conn, status, older_than, batch, now)
+            else:
+                rooms = []
+                for shard in room_shards:
+                    with shard.engine.begin() as conn:
+                        rooms += _reap_rooms(conn, status, older_than, batch, now)
+            _forget_rooms(rooms, deleted=status != 2)
+            reaped += len(rooms)
+            if len(rooms) < batch:
+                break
+        counts[reason] = reaped
+    return counts
+
+
+def _reap_rooms(
+    conn, status: int, older_than: int, limit: int, now: int
+) -> list[tuple[int, int]]:
+    """Returns (room_id, live_id) of the rooms reaped"""
+    # (room_status, updated_at) のインデックスを使う
+    res = conn.execute(
+        text(
+            "SELECT room_id, live_id FROM room\
+             WHERE room_status = :status AND updated_at < :older_than LIMIT :limit"
+        ),
+        {"status": status, "older_than": older_than, "limit": limit},
+    )
+    reaped = []
+    # SELECT の後に動いたルームは条件で外れるので, 変わった行だけを返す
+    for room_id, live_id in res.all():
+        params = {
+            "room_id": room_id,
+            "status": status,
+            "older_than": older_than,
+            "now": now,
+        }
+        if status == 2:
+            stmt = "UPDATE room SET room_status = 3, updated_at = :now\
+                 WHERE room_id = :room_id AND room_status = :status\
+                 AND updated_at < :older_than"
         else:
-            res = conn.execute(
-                text(
-                    "UPDATE room\
-                    SET joined_user_count = :joined_user_count \
-                    WHERE room_id = :room_id"
-                ),
-                {"joined_user_count": joined_user_count, "room_id": room_id},
-            )
-            if is_host:
-                res = conn.execute(
-                    text("SELECT user_id from room_member WHERE room_id = :room_id"),
-                    {"room_id": room_id},
-                )
-                # オーナー変更
-                next_host_user_id = res.all()[0][0]
-                res = conn.execute(
-                    text(
-                        "UPDATE room_member\
-                        SET is_host = 1 \
-                        WHERE room_id = :room_id AND user_id = :user_id"
-                    ),
-                    {
-                        "room_id": room_id,
-                        "user_id": next_host_user_id,
-                    },
-                )
-        return
+            stmt = "DELETE FROM room WHERE room_id = :room_id\
+                 AND room_status = :status AND updated_at < :older_than"
+        if conn.execute(text(stmt), params).rowcount == 1:
+            reaped.append((room_id, live_id))
+    if reaped and status != 2:
+        conn.execute(
+            text("DELETE FROM room_member WHERE room_id IN :room_ids").bindparams(
+                bindparam("room_ids", expanding=True)
+            ),
+            {"room_ids": [room_id for room_id, _ in reaped]},
+        )
+    return reaped
+
+
+def _forget_rooms(rooms: list[tuple[int, int]], deleted: bool) -> None:
+    for live_id in {live_id for _, live_id in rooms}:
+        _invalidate_lobby(live_id)
+    kind = events.DELETED if deleted else events.DISSOLVED
+    for room_id, live_id in rooms:
+        room_notifier.publish(room_id)
+        open_rooms.remove(room_id)
+        if deleted:
+            room_notifier.forget(room_id)
+            result_cache.pop(room_id)
+        _emit(kind, room_id, live_id)
 
 
 """
@@ -0,0 +1,75 @@
+import asyncio
+import threading
+
+
+class RoomNotifier:
+    """ルームの状態が変わったことを待っているクライアントに知らせる
+
+    ルームごとに単調増加するバージョンを持ち, model の状態遷移ごとに
+    publish() で進める. 待つ側は最後に見たバージョンを渡して wait() する.
+    バージョンはこのプロセスの中だけで有効.
+
+    バージョンはプロセス全体の通し番号から取るので, forget() で 0 に戻った
+    ルームが後でまた publish() されても, 前に返した値には戻らない (ETag).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._versions: dict[int, int] = {}
+        self._waiters: dict[
+            int, list[tuple[asyncio.AbstractEventLoop, asyncio.Event]]
+        ] = {}
+
+    def version(self, room_id: int) -> int:
+        return self._versions.get(room_id, 0)
+
+    def publish(self, room_id: int) -> None:
+        """Bump the room version and wake everyone waiting on it
+
+        Safe to call from worker threads.
+        """
+        with self._lock:
+            self._seq += 1
+            self._versions[room_id] = self._seq
+            waiters = self._waiters.pop(room_id, [])
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # 待っていたループがもう閉じている
+                pass
+
+    def forget(self, room_id: int) -> None:
+        """Drop the version of a deleted room"""
+        with self._lock:
+            self._versions.pop(room_id, None)
+
+    async def wait(self, room_id: int, version: int, timeout: float) -> int:
+        """Wait until the room version differs from `version` or timeout
+
+        Returns the version at the time of return.
+        """
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = (loop, event)
+        with self._lock:
+            current = self._versions.get(room_id, 0)
+            if current != version:
+                return current
+            self._waiters.setdefault(room_id, []).append(waiter)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(room_id)
+                if waiters and waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self._waiters[room_id]
+        return self.version(room_id)
+
+
+room_notifier = RoomNotifier()
@@ -0,0 +1,52 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+from . import metrics, model
+
+logger = logging.getLogger(__name__)
+
+
+class RoomReaper:
+    """Runs model.reap_rooms() every `interval` seconds on a daemon thread
+
+    Every worker may run one; the deletes are guarded by room_status and
+    updated_at, so concurrent passes do not step on each other.
+    """
+
+    def __init__(self, interval: float = 30.0):
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="room-reaper", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                # DB が一時的に落ちていても次の周期でやり直す
+                logger.exception("room reaper pass failed")
+
+    def run_once(self, now: Optional[int] = None) -> dict[str, int]:
+        start = time.perf_counter()
+        counts = model.reap_rooms(now)
+        metrics.reaper_seconds.observe((), time.perf_counter() - start)
+        for reason, n in counts.items():
+            metrics.rooms_reaped.inc((reason,), n)
+        return counts
@@ -0,0 +1,462 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy import bindparam, text
+
+logger = logging.getLogger(__name__)
+
+# room_status
+WAITING = 1
+LIVE_START = 2
+DISSOLUTION = 3
+
+# JoinRoomResult
+JOIN_OK = 1
+JOIN_ROOM_FULL = 2
+JOIN_DISBANNED = 3
+JOIN_OTHER_ERROR = 4
+
+
+class Member:
+    __slots__ = (
+        "user_id",
+        "name",
+        "leader_card_id",
+        "select_difficulty",
+        "is_host",
+        "score",
+        "judge_count_list",
+    )
+
+    def __init__(self, user_id, name, leader_card_id, select_difficulty, is_host):
+        self.user_id = user_id
+        self.name = name
+        self.leader_card_id = leader_card_id
+        self.select_difficulty = select_difficulty
+        self.is_host = is_host
+        self.score: Optional[int] = None
+        self.judge_count_list: Optional[tuple[int, ...]] = None
+
+
+class Room:
+    __slots__ = (
+        "room_id",
+        "live_id",
+        "max_user_count",
+        "status",
+        "updated_at",
+        "members",
+    )
+
+    def __init__(self, room_id, live_id, max_user_count=4, status=WAITING):
+        self.room_id = room_id
+        self.live_id = live_id
+        self.max_user_count = max_user_count
+        self.status = status
+        self.updated_at = int(time.time())
+        # 参加順を保つ (ホスト交代のときに先頭を選ぶ)
+        self.members: dict[int, Member] = {}
+
+
+class RoomRegistry:
+    """In-memory, authoritative state of live rooms
+
+    Room operations are served from memory and written back to the `room`
+    and `room_member` tables by a background thread every `flush_interval`
+    seconds, `batch_size` rooms per transaction. stop() does a final flush.
+
+    The registry owns room ids, so only one process may run it against a
+    database at a time.
+    """
+
+    def __init__(self, engine, flush_interval: float = 0.5, batch_size: int = 500):
+        self.engine = engine
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._rooms: dict[int, Room] = {}
+        self._next_room_id = 1
+        self._loaded = False
+        self._dirty: set[int] = set()
+        # live_score にまだ書いていないスコア (行の dict)
+        self._scores: list[dict] = []
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # 起動と書き戻し
+
+    def load(self) -> None:
+        """Load waiting and live rooms from the database"""
+        with self.engine.begin() as conn:
+            max_id = conn.execute(text("SELECT MAX(room_id) FROM room")).scalar()
+            rooms = conn.execute(
+                text(
+                    "SELECT room_id, live_id, max_user_count, room_status, updated_at"
+                    " FROM room WHERE room_status IN (1, 2) ORDER BY room_id"
+                )
+            ).all()
+            members = conn.execute(
+                text(
+                    "SELECT m.room_id, m.user_id, m.name, m.leader_card_id,"
+                    " m.select_difficulty, m.is_host, m.score, m.score_perfect,"
+                    " m.score_great, m.score_good, m.score_bad, m.score_miss"
+                    " FROM room_member m JOIN room r ON r.room_id = m.room_id"
+                    " WHERE r.room_status IN (1, 2)"
+                    " ORDER BY m.room_id, m.is_host DESC, m.user_id"
+                )
+            ).all()
+        with self._lock:
+            for room_id, live_id, max_user_count, status, updated_at in rooms:
+                room = Room(room_id, live_id, max_user_count, status)
+                room.updated_at = updated_at
+                self._rooms[room_id] = room
+            for row in members:
+                member = Member(row[1], row[2], row[3], row[4], bool(row[5]))
+                if row[6] is not None:
+                    member.score = row[6]
+                    member.judge_count_list = tuple(row[7:12])
+                self._rooms[row[0]].members[member.user_id] = member
+            self._next_room_id = max(self._next_room_id, (max_id or 0) + 1)
+            self._loaded = True
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        # 2 つのスレッドが読み込むと, 後の load() が間に作られたルームを上書きする
+        with self._load_lock:
+            if not self._loaded:
+                self.load()
+
+    def start(self) -> None:
+        self._ensure_loaded()
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="room-registry-flush", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the flush thread and write out everything still pending"""
+        if self._thread is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                # 書けなかったルームは _dirty に戻っている. 次の周期で書き直す
+                logger.exception("writing rooms back failed")
+
+    def _touch(self, room_id: int) -> None:
+        room = self._rooms.get(room_id)
+        if room is not None:
+            room.updated_at = int(time.time())
+        self._dirty.add(room_id)
+        if len(self._dirty) >= self.batch_size:
+            self._wakeup.set()
+
+    def flush(self) -> int:
+        """Write dirty rooms to the database. Returns the number of rooms"""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self) -> int:
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            scores, self._scores = self._scores, []
+            snapshot = []
+            for room_id in dirty:
+                room = self._rooms.get(room_id)
+                if room is None:
+                    snapshot.append((room_id, None, ()))
+                    continue
+                room_row = {
+                    "room_id": room.room_id,
+                    "live_id": room.live_id,
+                    "joined_user_count": len(room.members),
+                    "max_user_count": room.max_user_count,
+                    "room_status": room.status,
+                    "updated_at": room.updated_at,
+                }
+                member_rows = [_member_row(room_id, m) for m in room.members.values()]
+                snapshot.append((room_id, room_row, member_rows))
+        try:
+            for i in range(0, len(snapshot), self.batch_size):
+                self._write(snapshot[i : i + self.batch_size])
+        except Exception:
+            # 次のフラッシュで書き直す
+            with self._lock:
+                self._dirty.update(dirty)
+                self._scores[:0] = scores
+            raise
+        try:
+            if scores:
+                self._write_scores(scores)
+        except Exception:
+            with self._lock:
+                self._scores[:0] = scores
+            raise
+        return len(snapshot)
+
+    def _write_scores(self, scores: list[dict]) -> None:
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    "INSERT INTO live_score (live_id, user_id, name, leader_card_id, room_id, score, created_at)"
+                    " VALUES (:live_id, :user_id, :name, :leader_card_id, :room_id, :score, :created_at)"
+                ),
+                scores,
+            )
+
+    def _write(self, batch) -> None:
+        room_ids = [room_id for room_id, _, _ in batch]
+        room_rows = [room_row for _, room_row, _ in batch if room_row is not None]
+        member_rows = [row for _, _, rows in batch for row in rows]
+        deleted = [room_id for room_id, room_row, _ in batch if room_row is None]
+        with self.engine.begin() as conn:
+            conn.execute(
+                text("DELETE FROM room_member WHERE room_id IN :room_ids").bindparams(
+                    bindparam("room_ids", expanding=True)
+                ),
+                {"room_ids": room_ids},
+            )
+            if deleted:
+                conn.execute(
+                    text("DELETE FROM room WHERE room_id IN :room_ids").bindparams(
+                        bindparam("room_ids", expanding=True)
+                    ),
+                    {"room_ids": deleted},
+                )
+            if room_rows:
+                conn.execute(
+                    text(
+                        "REPLACE INTO room (room_id, live_id, joined_user_count, max_user_count, room_status, updated_at)"
+                        " VALUES (:room_id, :live_id, :joined_user_count, :max_user_count, :room_status, :updated_at)"
+                    ),
+                    room_rows,
+                )
+            if member_rows:
+                conn.execute(
+                    text(
+                        "INSERT INTO room_member (user_id, room_id, name, leader_card_id, select_difficulty, is_me, is_host,"
+                        " score, score_perfect, score_great, score_good, score_bad, score_miss)"
+                        " VALUES (:user_id, :room_id, :name, :leader_card_id, :select_difficulty, :is_me, :is_host,"
+                        " :score, :score_perfect, :score_great, :score_good, :score_bad, :score_miss)"
+                    ),
+                    member_rows,
+                )
+
+    # ルーム操作
+    # user は id, name, leader_card_id を持つもの (model.UserRow)
+
+    def create_room(self, user, live_id: int, select_difficulty: int) -> int:
+        self._ensure_loaded()
+        with self._lock:
+            room_id = self._next_room_id
+            self._next_room_id += 1
+            room = Room(room_id, live_id)
+            room.members[user.id] = Member(
+                user.id, user.name, user.leader_card_id, select_difficulty, True
+            )
+            self._rooms[room_id] = room
+            self._touch(room_id)
+        return room_id
+
+    def count_by_status(self) -> dict[int, int]:
+        self._ensure_loaded()
+        counts: dict[int, int] = {}
+        with self._lock:
+            for r in self._rooms.values():
+                counts[r.status] = counts.get(r.status, 0) + 1
+        return counts
+
+    def get_room_list(
+        self, live_id: int, cursor: int = 0, limit: Optional[int] = None
+    ) -> list[tuple[int, int, int, int]]:
+        """(room_id, live_id, joined_user_count, max_user_count) of waiting rooms
+
+        Ordered by room_id, starting after `cursor`.
+        """
+        self._ensure_loaded()
+        rows = []
+        with self._lock:
+            # dict は挿入順 = room_id 順 (load() も room_id 順に読む)
+            for r in self._rooms.values():
+                if r.room_id <= cursor or r.status != WAITING:
+                    continue
+                if live_id != 0 and r.live_id != live_id:
+                    continue
+                rows.append((r.room_id, r.live_id, len(r.members), r.max_user_count))
+                if limit is not None and len(rows) >= limit:
+                    break
+        return rows
+
+    def join_room(
+        self, user, room_id: int, select_difficulty: int
+    ) -> tuple[int, Optional[int]]:
+        """Returns (JoinRoomResult value, live_id)"""
+        self._ensure_loaded()
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None or room.status == DISSOLUTION:
+                return (JOIN_DISBANNED, None)
+            if room.status != WAITING:
+                return (JOIN_OTHER_ERROR, room.live_id)
+            if user.id in room.members:
+                # join のリトライや自分のルームへのマッチング. ホストやスコアはそのまま
+                return (JOIN_OK, room.live_id)
+            if len(room.members) >= room.max_user_count:
+                return (JOIN_ROOM_FULL, room.live_id)
+            room.members[user.id] = Member(
+                user.id, user.name, user.leader_card_id, select_difficulty, False
+            )
+            self._touch(room_id)
+        return (JOIN_OK, room.live_id)
+
+    def wait_room(self, room_id: int) -> tuple[int, list[Member]]:
+        self._ensure_loaded()
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None:
+                return (DISSOLUTION, [])
+            return (room.status, list(room.members.values()))
+
+    def start_room(self, user, room_id: int) -> Optional[int]:
+        """Returns the live_id of the room if it was started"""
+        self._ensure_loaded()
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None or room.status != WAITING:
+                return None
+            member = room.members.get(user.id)
+            if member is None or not member.is_host:
+                return None
+            room.status = LIVE_START
+            self._touch(room_id)
+        return room.live_id
+
+    def end_room(
+        self, user, room_id: int, judge_count_list: list[int], score: int
+    ) -> tuple[Optional[list[Member]], bool]:
+        """Store a score; same return value as result_room
+
+        Once every score is in the room is dissolved and the result is final.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            room = self._rooms.get(room_id)
+            member = room.members.get(user.id) if room is not None else None
+            if member is None:
+                return (None, False)
+            member.score = score
+            member.judge_count_list = tuple(judge_count_list[:5])
+            self._scores.append(
+                {
+                    "live_id": room.live_id,
+                    "user_id": member.user_id,
+                    "name": member.name,
+                    "leader_card_id": member.leader_card_id,
+                    "room_id": room_id,
+                    "score": score,
+                    "created_at": int(time.time()),
+                }
+            )
+            self._touch(room_id)
+            return self._final_result(room)
+
+    def result_room(self, room_id: int) -> tuple[Optional[list[Member]], bool]:
+        """Returns (members or None while scores are missing, dissolved now)"""
+        self._ensure_loaded()
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None:
+                return (None, False)
+            return self._final_result(room)
+
+    def _final_result(self, room: Room) -> tuple[Optional[list[Member]], bool]:
+        members = list(room.members.values())
+        if any(m.score is None for m in members):
+            return (None, False)
+        dissolved = room.status != DISSOLUTION
+        if dissolved:
+            room.status = DISSOLUTION
+            self._touch(room.room_id)
+        return (members, dissolved)
+
+    def leave_room(
+        self, user, room_id: int
+    ) -> tuple[bool, Optional[int], Optional[int]]:
+        """Returns (whether the room was deleted, live_id, the new host or None)"""
+        self._ensure_loaded()
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None:
+                return (False, None, None)
+            member = room.members.pop(user.id, None)
+            if member is None:
+                return (False, room.live_id, None)
+            self._touch(room_id)
+            if not room.members:
+                del self._rooms[room_id]
+                return (True, room.live_id, None)
+            if member.is_host:
+                # オーナー変更
+                next_host = next(iter(room.members.values()))
+                next_host.is_host = True
+                return (False, room.live_id, next_host.user_id)
+            return (False, room.live_id, None)
+
+    def reap(self, status: int, older_than: int, limit: int) -> list[tuple[int, int]]:
+        """Drop up to `limit` rooms in `status` not updated since `older_than`
+
+        Waiting and finished rooms are deleted, live rooms are dissolved.
+        Returns (room_id, live_id) of the rooms reaped.
+        """
+        self._ensure_loaded()
+        reaped = []
+        with self._lock:
+            for room in list(self._rooms.values()):
+                if room.status != status or room.updated_at >= older_than:
+                    continue
+                if status == LIVE_START:
+                    room.status = DISSOLUTION
+                else:
+                    del self._rooms[room.room_id]
+                self._touch(room.room_id)
+                reaped.append((room.room_id, room.live_id))
+                if len(reaped) >= limit:
+                    break
+        return reaped
+
+
+def _member_row(room_id: int, m: Member) -> dict:
+    judge = m.judge_count_list or [None] * 5
+    return {
+        "user_id": m.user_id,
+        "room_id": room_id,
+        "name": m.name,
+        "leader_card_id": m.leader_card_id,
+        "select_difficulty": m.select_difficulty,
+        "is_me": True,
+        "is_host": m.is_host,
+        "score": m.score,
+        "score_perfect": judge[0],
+        "score_great": judge[1],
+        "score_good": judge[2],
+        "score_bad": judge[3],
+        "score_miss": judge[4],
+    }
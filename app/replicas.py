@@ -0,0 +1,183 @@
+"""Read replicas of the main database
+
+Reads that dominate the traffic (the lobby, /room/wait, /room/result and
+token lookups) can go to read-only copies of the main database while every
+write stays on the primary. `ReplicaSet.engine(*keys)` picks where one
+read-only transaction goes:
+
+  * the primary if any of `keys` is pinned. model pins a token when it
+    writes, and a room and its lobby whenever a room event (this worker's
+    or another's) says they changed, so for `pin_seconds` afterwards the
+    writer and everyone polling that room read what was just written;
+  * otherwise the next replica, round-robin, whose lag is at most
+    `max_lag`;
+  * the primary when every replica lags or the lag is not known.
+
+Lag is measured with a heartbeat: every `check_interval` seconds the
+primary's `replica_heartbeat` row gets the current time, and a replica's
+lag is how old the row it has is. A replica that cannot be read counts as
+lagging. Stand-in replicas for tests and local runs are SQLite files: the
+primary's own file is a replica with no lag, and a copy of it lags until
+it is copied again.
+
+Only the main database (room shard 0 and `user`) has replicas.
+"""
+
+import itertools
+import logging
+import math
+import threading
+import time
+from typing import Hashable, Optional
+
+from sqlalchemy import text
+
+from .cache import TTLCache
+from .storage import Storage, begin_read
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_ID = 1
+
+
+class ReplicaSet:
+    def __init__(
+        self,
+        primary: Storage,
+        replicas: list[Storage],
+        pin_seconds: float = 2.0,
+        max_lag: float = 1.0,
+        check_interval: float = 0.5,
+        max_pins: int = 100000,
+    ):
+        self.primary = primary
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        # 計った遅延は次の計測まで check_interval だけ古くなりうる.
+        # それより短く固定すると, 固定が外れた直後にまだ届いていない読み込みがある
+        self.pin_seconds = max(pin_seconds, max_lag + check_interval)
+        self._pins = TTLCache(max_pins, self.pin_seconds)
+        self.lags = [math.inf] * len(replicas)
+        self._checked_at = -math.inf
+        self._next = itertools.count()
+        self._engines = set()
+        for storage in replicas:
+            self._engines.add(storage.engine)
+            if storage.async_engine is not None:
+                self._engines.add(storage.async_engine.sync_engine)
+        self.primary_reads = 0
+        self.replica_reads = 0
+        self.pinned_reads = 0
+        self.lagging_reads = 0  # 使えるレプリカがなく主 DB へ回した読み込み
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self.replicas)
+
+    def pin(self, *keys: Hashable) -> None:
+        """Send reads naming any of `keys` to the primary for a while"""
+        for key in keys:
+            self._pins.set(key, True)
+
+    def pinned(self, *keys: Hashable) -> bool:
+        return any(self._pins.get(key) for key in keys)
+
+    def _pick(self, keys) -> Optional[Storage]:
+        """The replica for a read, None for the primary"""
+        if self.pinned(*keys):
+            self.pinned_reads += 1
+            return None
+        # 計測が止まっていたら遅延は分からない
+        if time.monotonic() - self._checked_at > self.max_lag + self.check_interval:
+            self.lagging_reads += 1
+            return None
+        n = len(self.replicas)
+        start = next(self._next)
+        for i in range(n):
+            index = (start + i) % n
+            if self.lags[index] <= self.max_lag:
+                self.replica_reads += 1
+                return self.replicas[index]
+        self.lagging_reads += 1
+        return None
+
+    def engine(self, *keys: Hashable):
+        """Engine for a read-only transaction about `keys`"""
+        storage = self._pick(keys)
+        if storage is None:
+            self.primary_reads += 1
+            return self.primary.engine
+        return storage.engine
+
+    def async_engine(self, *keys: Hashable):
+        storage = self._pick(keys)
+        if storage is None:
+            self.primary_reads += 1
+            return self.primary.async_engine
+        return storage.async_engine
+
+    def has_users(self, conn) -> bool:
+        """Whether `conn` is on a replica (which has the `user` table)"""
+        return conn.engine in self._engines
+
+    def check(self) -> list[float]:
+        """Write the heartbeat and measure the lag of every replica"""
+        with self.primary.engine.begin() as conn:
+            conn.execute(
+                text("REPLACE INTO replica_heartbeat (id, ts) VALUES (:id, :ts)"),
+                {"id": HEARTBEAT_ID, "ts": time.time()},
+            )
+        lags = []
+        for storage in self.replicas:
+            try:
+                with begin_read(storage.engine) as conn:
+                    ts = conn.execute(
+                        text("SELECT ts FROM replica_heartbeat WHERE id = :id"),
+                        {"id": HEARTBEAT_ID},
+                    ).scalar()
+            except Exception:
+                logger.exception("reading the heartbeat of %s failed", storage.name)
+                ts = None
+            lags.append(math.inf if ts is None else max(0.0, time.time() - ts))
+        self.lags = lags
+        self._checked_at = time.monotonic()
+        return lags
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        try:
+            self.check()
+        except Exception:
+            logger.exception("checking the replicas failed")
+        self._thread = threading.Thread(
+            target=self._run, name="replica-heartbeat", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("checking the replicas failed")
+
+    def status(self) -> dict:
+        return {
+            "replicas": len(self.replicas),
+            "lags": [lag if math.isfinite(lag) else None for lag in self.lags],
+            "pins": len(self._pins),
+            "primary_reads": self.primary_reads,
+            "replica_reads": self.replica_reads,
+            "pinned_reads": self.pinned_reads,
+            "lagging_reads": self.lagging_reads,
+        }
@@ -0,0 +1,162 @@
+import logging
+import threading
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# (room_id, token, judge_count_list, score). model.end_rooms の引数と同じ形
+Entry = tuple[int, str, list[int], int]
+
+# 書き直しても通らない, エントリ自体が壊れているときのエラー
+BAD_ENTRY_ERRORS: tuple[type[Exception], ...] = (LookupError, TypeError, ValueError)
+
+
+class ScoreBuffer:
+    """Write-behind queue for /room/end
+
+    submit() only queues the score; a background thread hands everything
+    queued to `write` (model.end_rooms) every `flush_interval` seconds, so
+    the scores of a whole song end land in a few batched transactions. A
+    second submission of the same (room, token) before the flush replaces
+    the first.
+
+    Readers that need the scores of a room call flush() first when
+    has_pending() says so; flush() returns only after every score submitted
+    before the call is written, including a batch another thread is writing.
+    When `max_pending` scores are queued submit() returns True and the
+    caller is expected to flush() itself, which slows submitters down to
+    the speed of the database.
+
+    A failed batch goes back to the queue and flush() raises. If it failed
+    with one of `bad_entry_errors`, the entries are written one at a time
+    instead and the ones that still fail that way are logged and dropped,
+    so one broken score cannot hold back every later one.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[list[Entry]], int],
+        flush_interval: float = 0.05,
+        max_pending: int = 2000,
+        bad_entry_errors: tuple[type[Exception], ...] = BAD_ENTRY_ERRORS,
+    ):
+        self.write = write
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.bad_entry_errors = bad_entry_errors
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: dict[tuple[int, str], Entry] = {}
+        # room_id -> キューにあるか書き込み中のスコアの数
+        self._rooms: dict[int, int] = {}
+        self._stopping = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def submit(
+        self, room_id: int, token: str, judge_count_list: list[int], score: int
+    ) -> bool:
+        """Queue a score. Returns True if the caller should flush() now"""
+        key = (room_id, token)
+        with self._lock:
+            if key not in self._pending:
+                self._rooms[room_id] = self._rooms.get(room_id, 0) + 1
+            self._pending[key] = (room_id, token, list(judge_count_list), score)
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wakeup.set()
+        return full
+
+    def has_pending(self, room_id: int) -> bool:
+        return room_id in self._rooms
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="score-buffer-flush", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the flush thread and write out everything still queued"""
+        if self._thread is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("score flush failed; will retry")
+
+    def flush(self) -> int:
+        """Write every queued score. Returns the number written"""
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending.values())
+                self._pending = {}
+            if not batch:
+                return 0
+            try:
+                stored = self.write(batch)
+            except self.bad_entry_errors:
+                return self._write_each(batch)
+            except Exception:
+                self._requeue(batch)
+                raise
+            self._done(batch)
+            return stored
+
+    def _write_each(self, batch: list[Entry]) -> int:
+        """Write `batch` entry by entry, dropping the broken ones"""
+        stored = 0
+        error: Optional[Exception] = None
+        for i, entry in enumerate(batch):
+            try:
+                stored += self.write([entry])
+            except self.bad_entry_errors:
+                logger.exception("dropping score of room %d", entry[0])
+                self.dropped += 1
+            except Exception as e:
+                # データベースが落ちたなど. 残りは次の flush で書く
+                self._requeue(batch[i:])
+                error = e
+                break
+            self._done([entry])
+        if error is not None:
+            raise error
+        return stored
+
+    def _requeue(self, batch: list[Entry]) -> None:
+        # 書き込み中に同じ (room, token) が来ていればそちらを残す
+        with self._lock:
+            for entry in batch:
+                key = (entry[0], entry[1])
+                if key in self._pending:
+                    self._release(entry[0])
+                else:
+                    self._pending[key] = entry
+
+    def _done(self, batch: list[Entry]) -> None:
+        with self._lock:
+            for entry in batch:
+                self._release(entry[0])
+
+    def _release(self, room_id: int) -> None:
+        n = self._rooms[room_id] - 1
+        if n:
+            self._rooms[room_id] = n
+        else:
+            del self._rooms[room_id]
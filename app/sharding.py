@@ -0,0 +1,85 @@
+"""Room shards
+
+Rooms, their members and their scores live on one of several databases.
+The shard is encoded in the room_id: shard `i` hands out ids from
+`i * SHARD_STRIDE + 1`, so `room_id // SHARD_STRIDE` finds it again with no
+lookup, and ids stay ordered shard by shard for cursor paging.
+
+Shard 0 is the main database, which also holds the `user` table. Rooms
+created before sharding was turned on all have ids below SHARD_STRIDE and
+stay where they are.
+"""
+
+import itertools
+import threading
+from typing import Iterator
+
+from .storage import Storage
+
+# 1 シャードあたり 2^32 個の ID
+SHARD_STRIDE = 1 << 32
+
+
+def shard_of(room_id: int) -> int:
+    return room_id // SHARD_STRIDE
+
+
+class Shard:
+    __slots__ = ("index", "storage")
+
+    def __init__(self, index: int, storage: Storage):
+        self.index = index
+        self.storage = storage
+
+    @property
+    def engine(self):
+        return self.storage.engine
+
+    @property
+    def async_engine(self):
+        return self.storage.async_engine
+
+    def __repr__(self) -> str:
+        return f"Shard({self.index}, {self.storage.name})"
+
+
+class ShardSet:
+    """The room shards; the first storage is the main database
+
+    New rooms go round-robin over the shards so room writes spread evenly
+    whatever the song. Every other operation goes to the shard of its
+    room_id; listings read every shard and merge (see model).
+    """
+
+    def __init__(self, storages: list[Storage]):
+        self.shards = [Shard(i, storage) for i, storage in enumerate(storages)]
+        for shard in self.shards[1:]:
+            shard.storage.start_ids_at("room", shard.index * SHARD_STRIDE)
+        main = self.shards[0].storage
+        self._user_engines = {main.engine}
+        if main.async_engine is not None:
+            self._user_engines.add(main.async_engine.sync_engine)
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self.shards)
+
+    def __iter__(self) -> Iterator[Shard]:
+        return iter(self.shards)
+
+    def for_room(self, room_id: int) -> Shard:
+        index = shard_of(room_id)
+        if index >= len(self.shards):
+            # 知らないシャードの ID は主 DB で「ない」ルームとして扱う
+            index = 0
+        return self.shards[index]
+
+    def place(self) -> Shard:
+        """The shard for a new room"""
+        with self._lock:
+            return self.shards[next(self._next) % len(self.shards)]
+
+    def has_users(self, conn) -> bool:
+        """Whether `conn` is on the main database, where `user` lives"""
+        return conn.engine in self._user_engines
@@ -0,0 +1,232 @@
+"""Storage backends
+
+The model layer only talks to `Storage.engine` / `Storage.async_engine`;
+a backend decides how those engines are built and how the schema gets
+there. The SQL in model.py sticks to what both MySQL and SQLite accept
+(backtick quoting, REPLACE INTO, lastrowid).
+
+    mysql://...            MySQLStorage (schema.sql is applied by hand)
+    sqlite:///path/to.db   SQLiteStorage, file in WAL mode
+    sqlite://              SQLiteStorage, in-memory (one connection)
+
+Read-only transactions are started with `begin_read()` /
+`begin_read_async()` instead of `engine.begin()`, so a backend can start
+them without taking a write lock.
+"""
+
+import os
+import re
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "schema.sql")
+
+# 読み込みだけのトランザクションに付ける実行オプション
+READ_ONLY = "gameserver_read_only"
+
+
+@contextmanager
+def begin_read(engine: Engine):
+    """engine.begin() for a transaction that only reads"""
+    with engine.connect() as conn:
+        conn = conn.execution_options(**{READ_ONLY: True})
+        with conn.begin():
+            yield conn
+
+
+@asynccontextmanager
+async def begin_read_async(engine: AsyncEngine):
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(**{READ_ONLY: True})
+        async with conn.begin():
+            yield conn
+
+
+class Storage(ABC):
+    """Builds the engines for one database"""
+
+    name: str
+    engine: Engine
+    async_engine: Optional[AsyncEngine] = None
+
+    def bootstrap(self) -> None:
+        """Create the tables if the backend can do it by itself"""
+
+    @abstractmethod
+    def start_ids_at(self, table: str, start: int) -> None:
+        """Make the AUTO_INCREMENT ids of `table` greater than `start`"""
+
+
+class MySQLStorage(Storage):
+    name = "mysql"
+
+    def __init__(
+        self,
+        uri: str,
+        async_uri: Optional[str],
+        poolclass,
+        async_poolclass,
+        **engine_args,
+    ):
+        self.engine = create_engine(uri, poolclass=poolclass, **engine_args)
+        if async_uri is not None:
+            self.async_engine = create_async_engine(
+                async_uri, poolclass=async_poolclass, **engine_args
+            )
+
+    def start_ids_at(self, table: str, start: int) -> None:
+        # すでに大きい ID があれば MySQL は下げない
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql(f"ALTER TABLE `{table}` AUTO_INCREMENT = {start + 1}")
+
+
+class SQLiteStorage(Storage):
+    """Embedded SQLite, for tests, benchmarks and profiling without a server
+
+    A file database runs in WAL mode so readers do not block the writer.
+    Write transactions start with BEGIN IMMEDIATE: the model does
+    read-then-write in one transaction, and a deferred transaction that
+    upgrades to a writer fails with SQLITE_BUSY instead of waiting.
+    Transactions from begin_read() start deferred and never take the write
+    lock.
+
+    An in-memory database lives in a single connection, so the pool is
+    one connection wide and there is no async engine.
+    """
+
+    name = "sqlite"
+
+    def __init__(
+        self,
+        uri: str,
+        poolclass,
+        async_poolclass,
+        use_async: bool = False,
+        busy_timeout: float = 30.0,
+        **engine_args,
+    ):
+        url = make_url(uri)
+        self.database = url.database or ""
+        self.memory = self.database in ("", ":memory:")
+        self.busy_timeout = busy_timeout
+        engine_args.pop("pool_pre_ping", None)
+        if self.memory:
+            if use_async:
+                raise ValueError("in-memory SQLite cannot be used with DB_ASYNC")
+            # 接続ごとに別のデータベースになるので1本だけにする
+            engine_args.update(pool_size=1, max_overflow=0, pool_recycle=-1)
+        self.engine = create_engine(
+            url.set(drivername="sqlite"),
+            poolclass=poolclass,
+            connect_args={"check_same_thread": False},
+            **engine_args,
+        )
+        self._setup(self.engine)
+        if use_async:
+            self.async_engine = create_async_engine(
+                url.set(drivername="sqlite+aiosqlite"),
+                poolclass=async_poolclass,
+                **engine_args,
+            )
+            self._setup(self.async_engine.sync_engine)
+
+    def _setup(self, engine: Engine) -> None:
+        @event.listens_for(engine, "connect")
+        def on_connect(dbapi_conn, record):
+            # トランザクションは begin イベントで自分で始める
+            dbapi_conn.isolation_level = None
+            cursor = dbapi_conn.cursor()
+            cursor.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout * 1000)}")
+            if not self.memory:
+                cursor.execute("PRAGMA journal_mode = WAL")
+                cursor.execute("PRAGMA synchronous = NORMAL")
+            cursor.close()
+
+        @event.listens_for(engine, "begin")
+        def on_begin(conn):
+            if conn.get_execution_options().get(READ_ONLY):
+                conn.exec_driver_sql("BEGIN")
+            else:
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    def bootstrap(self) -> None:
+        """Apply schema.sql unless the tables are already there"""
+        with self.engine.begin() as conn:
+            for stmt in sqlite_schema():
+                conn.exec_driver_sql(stmt)
+
+    def start_ids_at(self, table: str, start: int) -> None:
+        # AUTOINCREMENT の最後の値は sqlite_sequence にある
+        params = {"table": table, "start": start}
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    "INSERT INTO sqlite_sequence (name, seq) SELECT :table, :start\
+                     WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :table)"
+                ),
+                params,
+            )
+            conn.execute(
+                text("UPDATE sqlite_sequence SET seq = :start\
+                     WHERE name = :table AND seq < :start"),
+                params,
+            )
+
+
+def sqlite_schema(path: str = SCHEMA_PATH) -> list[str]:
+    """schema.sql rewritten for SQLite, idempotent (no DROP TABLE)"""
+    with open(path) as f:
+        sql = f.read()
+    statements = []
+    for stmt in sql.split(";"):
+        stmt = stmt.strip()
+        if not stmt or stmt.upper().startswith("DROP"):
+            continue
+        table = re.search(r"CREATE TABLE `(\w+)`", stmt).group(1)
+        stmt = stmt.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1)
+        # SQLite の自動採番は INTEGER PRIMARY KEY だけ
+        auto = re.search(r"`(\w+)` bigint NOT NULL AUTO_INCREMENT", stmt)
+        if auto:
+            stmt = stmt.replace(
+                auto.group(0), f"`{auto.group(1)}` INTEGER PRIMARY KEY AUTOINCREMENT"
+            )
+            stmt = re.sub(r",\s*PRIMARY KEY \(`\w+`\)", "", stmt)
+        stmt = re.sub(r"UNIQUE KEY `\w+` (\([^)]*\))", r"UNIQUE \1", stmt)
+        indexes = re.findall(r",\s*KEY `(\w+)` (\([^)]*\))", stmt)
+        stmt = re.sub(r",\s*KEY `\w+` \([^)]*\)", "", stmt)
+        statements.append(stmt)
+        for name, columns in indexes:
+            statements.append(
+                f"CREATE INDEX IF NOT EXISTS `{name}` ON `{table}` {columns}"
+            )
+    return statements
+
+
+def create_storage(
+    uri: str,
+    async_uri: Optional[str],
+    use_async: bool,
+    poolclass,
+    async_poolclass,
+    **engine_args,
+) -> Storage:
+    """Pick the backend from the scheme of `uri` and bootstrap it"""
+    if uri.startswith("sqlite"):
+        storage: Storage = SQLiteStorage(
+            uri, poolclass, async_poolclass, use_async=use_async, **engine_args
+        )
+    else:
+        storage = MySQLStorage(
+            uri,
+            async_uri if use_async else None,
+            poolclass,
+            async_poolclass,
+            **engine_args,
+        )
+    storage.bootstrap()
+    return storage
@@ -0,0 +1,211 @@
+"""Opt-in request trace for capacity planning (TRACE_FILE)
+
+`TraceMiddleware` hands every HTTP request to a `TraceRecorder`, which
+appends one JSON line per request to the trace file:
+
+    {"ts": 1760000000.123, "method": "POST", "route": "/room/wait",
+     "path": "/room/wait", "query": "", "token": "3f9c0a...", "status": 200,
+     "latency": 0.0021, "body": {"room_id": 12}}
+
+`token` is a keyed hash of the bearer token (also of `user_token` in
+/room/end_batch bodies), so a trace can leave the server without the
+tokens but requests of one user still line up. Responses of /room/create
+and /room/matchmake add the `room_id` they returned, which is what
+bench.replay needs to map rooms onto the ones it creates.
+
+The request itself only appends a tuple to a list; hashing, JSON and the
+file write happen on a background thread every `flush_interval` seconds.
+When `max_pending` entries are waiting the rest are dropped (`dropped`)
+instead of slowing requests down.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from .metrics import route_template
+
+logger = logging.getLogger(__name__)
+
+# 記録しないもの. ストリームは latency がストリームの長さになる
+SKIP_ROUTES = frozenset(
+    ("/", "/metrics", "/debug/pool", "/room/events/{room_id}", "unmatched")
+)
+# レスポンスの room_id も残す. 再生時に新しいルームへ対応付ける
+ROOM_ID_ROUTES = frozenset(("/room/create", "/room/matchmake"))
+
+
+class TraceRecorder:
+    def __init__(
+        self,
+        path: str,
+        key: str = "",
+        flush_interval: float = 0.5,
+        max_pending: int = 50000,
+        max_body: int = 65536,
+    ):
+        # ワーカーごとに別のファイルにするなら "{pid}" を入れる
+        self.path = path.format(pid=os.getpid())
+        # 同じ key なら別のワーカー, 別の日でも同じ token が同じ値になる
+        self.key = key.encode() if key else os.urandom(16)
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_body = max_body
+        self.written = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: list[tuple] = []
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, entry: tuple) -> None:
+        """Queue (ts, method, route, path, query, headers, body, status,
+        latency, response body or None); called on every request"""
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self._pending.append(entry)
+
+    def anonymize(self, token: str) -> str:
+        return hashlib.blake2b(token.encode(), key=self.key, digest_size=8).hexdigest()
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="trace-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("writing the request trace failed")
+
+    def flush(self) -> int:
+        """Append everything queued to the trace file. Returns lines written"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            data = "".join(self._line(entry) for entry in batch)
+            # 追記のみ. 1 回の write にまとめる
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(data)
+            self.written += len(batch)
+            return len(batch)
+
+    def _line(self, entry: tuple) -> str:
+        ts, method, route, path, query, headers, body, status, latency, resp = entry
+        record = {
+            "ts": round(ts, 6),
+            "method": method,
+            "route": route,
+            "path": path,
+            "query": query.decode("latin-1"),
+            "token": self._token(headers),
+            "status": status,
+            "latency": round(latency, 6),
+            "body": self._body(body),
+        }
+        if resp is not None:
+            try:
+                record["room_id"] = json.loads(resp)["room_id"]
+            except (ValueError, KeyError, TypeError):
+                pass
+        return json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n"
+
+    def _token(self, headers) -> Optional[str]:
+        for name, value in headers:
+            if name == b"authorization":
+                scheme, _, token = value.decode("latin-1").partition(" ")
+                if scheme.lower() == "bearer" and token:
+                    return self.anonymize(token)
+        return None
+
+    def _body(self, body: bytes):
+        if not body:
+            return None
+        if len(body) > self.max_body:
+            return {"truncated": len(body)}
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return None
+        # /room/end_batch は body に token がある
+        if isinstance(data, dict) and isinstance(data.get("results"), list):
+            for item in data["results"]:
+                if isinstance(item, dict) and isinstance(item.get("user_token"), str):
+                    item["user_token"] = self.anonymize(item["user_token"])
+        return data
+
+
+class TraceMiddleware:
+    """ASGI middleware feeding HTTP requests to a TraceRecorder"""
+
+    def __init__(self, app, recorder: TraceRecorder):
+        self.app = app
+        self.recorder = recorder
+        self._routes: dict = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        chunks = []
+        resp_chunks = [] if scope["path"] in ROOM_ID_ROUTES else None
+        status = 500
+
+        async def receive_wrapper():
+            message = await receive()
+            if message["type"] == "http.request":
+                chunks.append(message.get("body", b""))
+            return message
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body" and resp_chunks is not None:
+                resp_chunks.append(message.get("body", b""))
+            await send(message)
+
+        ts = time.time()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            latency = time.perf_counter() - start
+            route = route_template(scope, self._routes)
+            if route not in SKIP_ROUTES:
+                self.recorder.add(
+                    (
+                        ts,
+                        scope["method"],
+                        route,
+                        scope["path"],
+                        scope.get("query_string", b""),
+                        scope["headers"],
+                        b"".join(chunks),
+                        status,
+                        latency,
+                        b"".join(resp_chunks) if resp_chunks else None,
+                    )
+                )
@@ -0,0 +1,110 @@
+"""Compare the sync (threadpool) and async database paths
+
+    python -m bench.bench_async --concurrency 64 --requests 5000
+
+Every client polls /room/wait on a shared room with one token, so poll
+admission (POLL_ADMISSION) is turned off. Each mode runs in its own
+process because DB_ASYNC is read when app.db is imported. Uses the
+database configured in app/config.py.
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+
+def run(mode: str, concurrency: int, requests: int) -> dict:
+    from app import config
+
+    config.DB_ASYNC = mode == "async"
+    # 1 つの token で叩き続けるので, 入場制限があると 30 回目から 429 になる
+    config.POLL_ADMISSION = False
+
+    import httpx
+
+    from app.api import app
+
+    from .replay import close_app_engines
+
+    async def main():
+        async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+            res = await client.post(
+                "/user/create", json={"user_name": "bench", "leader_card_id": 1}
+            )
+            headers = {"Authorization": f"bearer {res.json()['user_token']}"}
+            res = await client.post(
+                "/room/create",
+                headers=headers,
+                json={"live_id": 1, "select_difficulty": 1},
+            )
+            room_id = res.json()["room_id"]
+
+            latencies = []
+
+            async def worker(n):
+                for _ in range(n):
+                    start = time.perf_counter()
+                    res = await client.post(
+                        "/room/wait", headers=headers, json={"room_id": room_id}
+                    )
+                    latencies.append(time.perf_counter() - start)
+                    assert res.status_code == 200
+
+            per_worker = requests // concurrency
+            start = time.perf_counter()
+            await asyncio.gather(*(worker(per_worker) for _ in range(concurrency)))
+            elapsed = time.perf_counter() - start
+            await client.post("/room/leave", headers=headers, json={"room_id": room_id})
+        # aiosqlite の接続スレッドが残るとプロセスが終わらない
+        await close_app_engines()
+
+        latencies.sort()
+        return {
+            "mode": mode,
+            "concurrency": concurrency,
+            "requests": len(latencies),
+            "rps": len(latencies) / elapsed,
+            "p50_ms": statistics.median(latencies) * 1000,
+            "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        }
+
+    return asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["sync", "async"])
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run(args.mode, args.concurrency, args.requests)))
+        return
+
+    for mode in ("sync", "async"):
+        out = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "bench.bench_async",
+                "--mode",
+                mode,
+                "--concurrency",
+                str(args.concurrency),
+                "--requests",
+                str(args.requests),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        print(out.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    main()
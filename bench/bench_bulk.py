@@ -0,0 +1,77 @@
+"""Per-row vs batched user creation and score submission
+
+    python -m bench.bench_bulk --users 2000
+
+Calls app.model directly against the database configured in
+app/config.py and prints one JSON line per case.
+"""
+
+import argparse
+import json
+import time
+
+from app import model
+from app.model import LiveDifficulty
+
+
+def _timed(name: str, n: int, fn) -> None:
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(
+        json.dumps(
+            {"case": name, "rows": n, "seconds": elapsed, "rows_per_sec": n / elapsed}
+        )
+    )
+
+
+def _rooms(tokens: list[str]) -> list[tuple[int, str]]:
+    """Put the users into started 4-player rooms; returns (room_id, token)"""
+    seats = []
+    for i in range(0, len(tokens) - 3, 4):
+        room_id = model.create_room(tokens[i], 9999, LiveDifficulty.normal)
+        for token in tokens[i + 1 : i + 4]:
+            model.join_room(token, room_id, LiveDifficulty.normal)
+        model.start_room(tokens[i], room_id)
+        seats += [(room_id, token) for token in tokens[i : i + 4]]
+    return seats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=2000)
+    args = parser.parse_args()
+    n = args.users
+
+    tokens = []
+    _timed(
+        "create_user",
+        n,
+        lambda: tokens.extend(model.create_user(f"bench{i}", 1) for i in range(n)),
+    )
+    batch_tokens = []
+    _timed(
+        "create_users",
+        n,
+        lambda: batch_tokens.extend(
+            model.create_users([(f"bench{i}", 1) for i in range(n)])
+        ),
+    )
+
+    judge = [1, 2, 3, 4, 5]
+    seats = _rooms(tokens)
+    _timed(
+        "end_room",
+        len(seats),
+        lambda: [model.end_room(t, room_id, judge, 1000) for room_id, t in seats],
+    )
+    seats = _rooms(batch_tokens)
+    _timed(
+        "end_rooms",
+        len(seats),
+        lambda: model.end_rooms([(room_id, t, judge, 1000) for room_id, t in seats]),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""join_room throughput with 1 thread vs many
+
+    python -m bench.bench_join --users 400 --threads 16
+
+Fills 4-player rooms by calling app.model.join_room from a thread pool,
+once serially and once with --threads workers, against the database
+configured in app/config.py. Prints one JSON line per case.
+"""
+
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import model
+from app.model import JoinRoomResult, LiveDifficulty
+
+
+def _join_many_rooms(tokens: list[str], threads: int) -> dict:
+    """Fill len(tokens) // 4 rooms concurrently"""
+    hosts = tokens[: len(tokens) // 4]
+    room_ids = [model.create_room(t, 3002, LiveDifficulty.normal) for t in hosts]
+    jobs = [
+        (token, room_ids[i % len(room_ids)])
+        for i, token in enumerate(tokens[len(hosts) :])
+    ]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        results = list(
+            pool.map(
+                lambda job: model.join_room(job[0], job[1], LiveDifficulty.normal),
+                jobs,
+            )
+        )
+    elapsed = time.perf_counter() - start
+    for token, room_id in zip(hosts, room_ids):
+        model.start_room(token, room_id)
+    return {
+        "case": "join_room",
+        "threads": threads,
+        "joins": len(jobs),
+        "ok": results.count(JoinRoomResult.Ok),
+        "seconds": elapsed,
+        "joins_per_sec": len(jobs) / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=400)
+    parser.add_argument("--threads", type=int, default=16)
+    args = parser.parse_args()
+
+    tokens = model.create_users([(f"join{i}", 1) for i in range(args.users)])
+    for threads in (1, args.threads):
+        print(json.dumps(_join_many_rooms(tokens, threads)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""pydantic response_model vs FAST_JSON for /room/wait and /room/list
+
+    python -m bench.bench_json
+    DATABASE_URI=sqlite:// python -m bench.bench_json --requests 2000
+
+"encode" cases only build and serialize a response body, the way each
+path does: pydantic models + response_model validation + JSONResponse, or
+plain dicts + ORJSONResponse. "http" cases run whole requests against the
+in-process app with FAST_JSON off and on, and with poll admission off
+(every request uses one token). One JSON line per case.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+from fastapi.routing import serialize_response
+
+from app import api, config
+from app.model import RoomInfo, RoomUser
+
+from .replay import close_app_engines
+
+MEMBERS = [(i, f"player{i}", 1000 + i, 1, i == 0, i == 0) for i in range(4)]
+ROOMS = [(i, 1, 3, 4) for i in range(1, 101)]
+
+
+def _field(path: str):
+    for route in api.app.routes:
+        if getattr(route, "path", None) == path:
+            return route.secure_cloned_response_field
+    raise KeyError(path)
+
+
+async def _pydantic_wait(field):
+    users = [
+        RoomUser(
+            user_id=m[0],
+            name=m[1],
+            leader_card_id=m[2],
+            select_difficulty=m[3],
+            is_me=m[4],
+            is_host=m[5],
+        )
+        for m in MEMBERS
+    ]
+    content = await serialize_response(
+        field=field,
+        response_content=api.RoomWaitResponse(status=1, room_user_list=users),
+    )
+    return api.JSONResponse(content).body
+
+
+async def _fast_wait(field):
+    content = {"status": 1, "room_user_list": api._room_user_dicts(MEMBERS)}
+    return api._fast_response(content).body
+
+
+async def _pydantic_list(field):
+    rooms = [
+        RoomInfo(
+            room_id=r[0], live_id=r[1], joined_user_count=r[2], max_user_count=r[3]
+        )
+        for r in ROOMS
+    ]
+    content = await serialize_response(
+        field=field,
+        response_content=api.RoomListResponse(room_info_list=rooms, next_cursor=None),
+    )
+    return api.JSONResponse(content).body
+
+
+async def _fast_list(field):
+    content = {
+        "room_info_list": [
+            {
+                "room_id": r[0],
+                "live_id": r[1],
+                "joined_user_count": r[2],
+                "max_user_count": r[3],
+            }
+            for r in ROOMS
+        ],
+        "next_cursor": None,
+    }
+    return api._fast_response(content).body
+
+
+async def _encode(name: str, fn, field, n: int) -> None:
+    assert json.loads(await fn(field))  # 両方とも同じ JSON になること
+    start = time.perf_counter()
+    for _ in range(n):
+        await fn(field)
+    elapsed = time.perf_counter() - start
+    _report(name, n, elapsed)
+
+
+async def _http(n: int) -> None:
+    config.POLL_ADMISSION = False
+    async with httpx.AsyncClient(app=api.app, base_url="http://bench") as client:
+        res = await client.post(
+            "/user/create", json={"user_name": "bench_json", "leader_card_id": 1}
+        )
+        headers = {"Authorization": f"bearer {res.json()['user_token']}"}
+        res = await client.post(
+            "/room/create",
+            headers=headers,
+            json={"live_id": 8001, "select_difficulty": 1},
+        )
+        room_id = res.json()["room_id"]
+        for fast in (False, True):
+            config.FAST_JSON = fast
+            mode = "fast" if fast else "pydantic"
+            for path, body in (
+                ("/room/wait", {"room_id": room_id}),
+                ("/room/list", {"live_id": 8001}),
+            ):
+                start = time.perf_counter()
+                for _ in range(n):
+                    res = await client.post(path, headers=headers, json=body)
+                    assert res.status_code == 200
+                _report(f"http {path} {mode}", n, time.perf_counter() - start)
+
+
+def _report(name: str, n: int, elapsed: float) -> None:
+    print(json.dumps({"case": name, "n": n, "us_per_op": elapsed / n * 1e6}))
+
+
+async def main_async(args) -> None:
+    wait_field = _field("/room/wait")
+    list_field = _field("/room/list")
+    await _encode("encode wait pydantic", _pydantic_wait, wait_field, args.encodes)
+    await _encode("encode wait fast", _fast_wait, wait_field, args.encodes)
+    await _encode("encode list(100) pydantic", _pydantic_list, list_field, args.encodes)
+    await _encode("encode list(100) fast", _fast_list, list_field, args.encodes)
+    await _http(args.requests)
+    await close_app_engines()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--encodes", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
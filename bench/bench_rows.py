@@ -0,0 +1,180 @@
+"""Row records vs pydantic models in the model layer, for /room/wait and /room/result
+
+    python -m bench.bench_rows
+    DATABASE_URI=sqlite:// python -m bench.bench_rows --calls 20000
+
+A 4-member room, per call. "build" cases turn raw database rows into what
+the model returns: one pydantic model per member (before) or a NamedTuple
+(now). "response" cases add what the endpoint does with that: a
+RoomWaitResponse / RoomResultResponse, or the plain dicts of FAST_JSON.
+"model" cases call model.wait_room / model.result_room on a real room in
+the configured database.
+
+One JSON line per case: time per call, objects and bytes each result keeps
+alive (what the result cache holds), and the peak bytes allocated while
+making one.
+"""
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+from app import api, model
+from app.model import (
+    LiveDifficulty,
+    MemberRow,
+    ResultRow,
+    ResultUser,
+    RoomUser,
+    SafeUser,
+    UserRow,
+)
+
+# room_member から読んだままの行
+MEMBER_ROWS = [(i, f"player{i}", 1000 + i, 1, i == 0, i == 0) for i in range(4)]
+SCORE_ROWS = [(i, 100 + i, 20, 5, 1, 0, 1000 * i) for i in range(4)]
+USER_ROW = (1, "player1", 1001)
+
+
+class _OrmRow:
+    # SafeUser.from_orm に渡していた sqlalchemy の Row の代わり
+    id, name, leader_card_id = USER_ROW
+
+
+def _pydantic_members():
+    return [
+        RoomUser(
+            user_id=r[0],
+            name=r[1],
+            leader_card_id=r[2],
+            select_difficulty=r[3],
+            is_me=r[4],
+            is_host=r[5],
+        )
+        for r in MEMBER_ROWS
+    ]
+
+
+def _row_members():
+    return [MemberRow(*r) for r in MEMBER_ROWS]
+
+
+def _pydantic_results():
+    return [
+        ResultUser(user_id=r[0], judge_count_list=r[1:6], score=r[6])
+        for r in SCORE_ROWS
+    ]
+
+
+def _row_results():
+    return [ResultRow(r[0], tuple(r[1:6]), r[6]) for r in SCORE_ROWS]
+
+
+CASES = [
+    ("build user pydantic", lambda: SafeUser.from_orm(_OrmRow)),
+    ("build user row", lambda: UserRow(*USER_ROW)),
+    ("build wait pydantic", _pydantic_members),
+    ("build wait rows", _row_members),
+    ("build result pydantic", _pydantic_results),
+    ("build result rows", _row_results),
+    (
+        "response wait pydantic",
+        lambda: api.RoomWaitResponse(status=1, room_user_list=_pydantic_members()),
+    ),
+    (
+        "response wait rows",
+        lambda: api.RoomWaitResponse(status=1, room_user_list=_row_members()),
+    ),
+    ("response wait rows fast", lambda: api._room_user_dicts(_row_members())),
+    (
+        "response result pydantic",
+        lambda: api.RoomResultResponse(result_user_list=_pydantic_results()),
+    ),
+    (
+        "response result rows",
+        lambda: api.RoomResultResponse(result_user_list=_row_results()),
+    ),
+    ("response result rows fast", lambda: api._result_user_dicts(_row_results())),
+]
+
+
+def _room() -> tuple[str, int]:
+    """A finished 4-member room; returns (a member's token, room_id)"""
+    tokens = model.create_users([(f"bench_rows_{i}", 1000 + i) for i in range(4)])
+    room_id = model.create_room(tokens[0], 9998, LiveDifficulty.normal)
+    for token in tokens[1:]:
+        model.join_room(token, room_id, LiveDifficulty.normal)
+    model.start_room(tokens[0], room_id)
+    for i, token in enumerate(tokens):
+        model.end_room(token, room_id, [i, 0, 0, 0, 0], 1000 * i)
+    model.result_room(tokens[0], room_id)  # スコアを書き切って結果をキャッシュに載せる
+    return tokens[1], room_id
+
+
+def _measure(name: str, fn, calls: int, kept: int) -> None:
+    fn()
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    us_per_call = (time.perf_counter() - start) / calls * 1e6
+
+    # 結果を持ち続けたときの大きさ
+    results = [None] * kept
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(kept):
+        results[i] = fn()
+    bytes_kept = (tracemalloc.get_traced_memory()[0] - before) / kept
+    blocks_kept = (sys.getallocatedblocks() - blocks) / kept
+    # 1 回の呼び出しで一時的に使う量
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    del results
+
+    print(
+        json.dumps(
+            {
+                "case": name,
+                "calls": calls,
+                "us_per_call": round(us_per_call, 2),
+                "blocks_kept": round(blocks_kept, 1),
+                "bytes_kept": round(bytes_kept),
+                "peak_bytes": peak,
+            }
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=50000)
+    parser.add_argument("--kept", type=int, default=1000)
+    parser.add_argument("--model-calls", type=int, default=2000)
+    args = parser.parse_args()
+
+    for name, fn in CASES:
+        _measure(name, fn, args.calls, args.kept)
+
+    token, room_id = _room()
+    _measure(
+        "model wait_room",
+        lambda: model.wait_room(token, room_id),
+        args.model_calls,
+        args.kept // 10,
+    )
+    _measure(
+        "model result_room",
+        lambda: model.result_room(token, room_id),
+        args.calls,
+        args.kept,
+    )
+
+
+if __name__ == "__main__":
+    main()
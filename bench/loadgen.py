@@ -0,0 +1,296 @@
+"""Multiplayer load generator
+
+Simulates `--players` clients, grouped into rooms of four, each running
+the full lifecycle: create/list/join -> poll /room/wait -> start -> play ->
+end -> poll /room/result -> leave.
+
+    python -m bench.loadgen --players 400                 # in-process app
+    python -m bench.loadgen --players 4000 --url http://127.0.0.1:8000
+
+Prints a JSON report with per-endpoint latency percentiles, throughput
+and error counts. In-process runs also report SQL statements per request.
+Polls follow the server's next_poll_delay_ms and Retry-After, like a well
+behaved client; 429s are reported as "throttled", not as errors. Polls
+also send the last ETag as If-None-Match; 304s are "not_modified".
+"""
+
+import argparse
+import asyncio
+import contextvars
+import json
+import random
+import sys
+import time
+from collections import defaultdict
+from typing import Optional
+
+import httpx
+from sqlalchemy import event
+
+from .replay import USER_BATCH, close_app_engines
+
+ROOM_SIZE = 4
+LIVE_ID = 1
+
+_route: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "loadgen_route", default=None
+)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.statements: dict[str, int] = defaultdict(int)
+        self.timeouts: dict[str, int] = defaultdict(int)  # 待ちきれなかったポーリング
+        self.throttled: dict[str, int] = defaultdict(int)  # 429
+        self.not_modified: dict[str, int] = defaultdict(int)  # 304
+
+    def on_statement(self, *args) -> None:
+        route = _route.get()
+        if route is not None:
+            self.statements[route] += 1
+
+    def report(self, elapsed: float, sql: bool) -> dict:
+        endpoints = {}
+        for route, values in sorted(self.latencies.items()):
+            values.sort()
+            n = len(values)
+            endpoints[route] = {
+                "count": n,
+                "errors": self.errors[route],
+                "poll_timeouts": self.timeouts[route],
+                "throttled": self.throttled[route],
+                "not_modified": self.not_modified[route],
+                "rps": n / elapsed,
+                "p50_ms": _percentile(values, 0.50) * 1000,
+                "p95_ms": _percentile(values, 0.95) * 1000,
+                "p99_ms": _percentile(values, 0.99) * 1000,
+                "sql_per_request": self.statements[route] / n if sql else None,
+            }
+        total = sum(len(v) for v in self.latencies.values())
+        return {
+            "elapsed_sec": elapsed,
+            "requests": total,
+            "rps": total / elapsed,
+            "errors": sum(self.errors.values()),
+            "endpoints": endpoints,
+        }
+
+
+def _percentile(values: list[float], q: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class _RouteTag:
+    """ASGI wrapper that tags SQL statements with the request path"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        token = _route.set(scope.get("path"))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _route.reset(token)
+
+
+class Player:
+    def __init__(self, client: httpx.AsyncClient, rec: Recorder, token: str, args):
+        self.client = client
+        self.rec = rec
+        self.headers = {"Authorization": f"bearer {token}"}
+        self.args = args
+        self.retry_after = 0.0  # 最後の 429 の Retry-After
+        # ポーリングの最後の (ETag, レスポンス). 304 ならこれを使う
+        self.seen: dict[str, tuple[str, dict]] = {}
+
+    async def post(
+        self, path: str, body: dict, conditional: bool = False
+    ) -> Optional[dict]:
+        headers = self.headers
+        seen = self.seen.get(path) if conditional else None
+        if seen is not None:
+            headers = {**headers, "If-None-Match": seen[0]}
+        start = time.perf_counter()
+        try:
+            res = await self.client.post(path, json=body, headers=headers)
+            ok = res.status_code in (200, 304)
+        except httpx.HTTPError:
+            res, ok = None, False
+        self.rec.latencies[path].append(time.perf_counter() - start)
+        if res is not None and res.status_code == 429:
+            self.rec.throttled[path] += 1
+            self.retry_after = float(res.headers.get("Retry-After", 1))
+            return None
+        if not ok:
+            self.rec.errors[path] += 1
+            return None
+        if res.status_code == 304:
+            self.rec.not_modified[path] += 1
+            delay_ms = int(res.headers.get("X-Next-Poll-Delay-Ms", 0))
+            return {**seen[1], "next_poll_delay_ms": delay_ms}
+        data = res.json()
+        if conditional and "ETag" in res.headers:
+            self.seen[path] = (res.headers["ETag"], data)
+        return data
+
+    async def poll(self, path: str, body: dict, done, interval: float):
+        # クライアントごとにずらして一斉に叩かないようにする
+        await asyncio.sleep(random.uniform(0, interval))
+        deadline = time.monotonic() + self.args.poll_timeout
+        while time.monotonic() < deadline:
+            data = await self.post(path, body, conditional=True)
+            if data is not None and done(data):
+                return data
+            # サーバーの指示より速くは叩かない
+            delay = interval
+            if data is not None:
+                delay = max(delay, data.get("next_poll_delay_ms", 0) / 1000)
+            elif self.retry_after:
+                delay = max(delay, self.retry_after)
+                self.retry_after = 0.0
+            await asyncio.sleep(delay)
+        self.rec.timeouts[path] += 1
+        return None
+
+    async def host(self, room_ready: asyncio.Future):
+        data = await self.post(
+            "/room/create", {"live_id": LIVE_ID, "select_difficulty": 1}
+        )
+        if data is None:
+            room_ready.set_result(None)
+            return
+        room_id = data["room_id"]
+        room_ready.set_result(room_id)
+        await self.poll(
+            "/room/wait",
+            {"room_id": room_id},
+            lambda d: len(d["room_user_list"]) >= ROOM_SIZE,
+            self.args.wait_interval,
+        )
+        await self.post("/room/start", {"room_id": room_id})
+        await self.play(room_id)
+
+    async def guest(self, room_ready: asyncio.Future):
+        room_id = await room_ready
+        if room_id is None:
+            return
+        await self.post("/room/list", {"live_id": LIVE_ID})
+        await self.post("/room/join", {"room_id": room_id, "select_difficulty": 1})
+        await self.poll(
+            "/room/wait",
+            {"room_id": room_id},
+            lambda d: d["status"] != 1,
+            self.args.wait_interval,
+        )
+        await self.play(room_id)
+
+    async def play(self, room_id: int):
+        await asyncio.sleep(self.args.live_seconds)
+        await self.post(
+            "/room/end",
+            {
+                "room_id": room_id,
+                "judge_count_list": [random.randint(0, 100) for _ in range(5)],
+                "score": random.randint(0, 1_000_000),
+            },
+        )
+        await self.poll(
+            "/room/result",
+            {"room_id": room_id},
+            lambda d: len(d["result_user_list"]) > 0,
+            self.args.result_interval,
+        )
+        await self.post("/room/leave", {"room_id": room_id})
+
+
+async def run(args) -> dict:
+    rec = Recorder()
+    sql = args.url is None
+    if sql:
+        from app import db
+        from app.api import app
+
+        event.listen(db.engine, "before_cursor_execute", rec.on_statement)
+        if db.async_engine is not None:
+            event.listen(
+                db.async_engine.sync_engine, "before_cursor_execute", rec.on_statement
+            )
+        client = httpx.AsyncClient(app=_RouteTag(app), base_url="http://loadgen")
+    else:
+        client = httpx.AsyncClient(
+            base_url=args.url,
+            limits=httpx.Limits(max_connections=args.connections),
+            timeout=60,
+        )
+
+    async with client:
+        players = args.players - args.players % ROOM_SIZE
+        tokens = []
+        # /user/create_batch は BATCH_MAX_SIZE 人まで
+        for i in range(0, players, USER_BATCH):
+            res = await client.post(
+                "/user/create_batch",
+                json={
+                    "users": [
+                        {"user_name": f"loadgen{j}", "leader_card_id": 1}
+                        for j in range(i, min(i + USER_BATCH, players))
+                    ]
+                },
+            )
+            res.raise_for_status()
+            tokens += res.json()["user_tokens"]
+
+        tasks = []
+        start = time.perf_counter()
+        for i in range(0, players, ROOM_SIZE):
+            room_ready = asyncio.get_running_loop().create_future()
+            group = [Player(client, rec, t, args) for t in tokens[i : i + ROOM_SIZE]]
+            tasks.append(asyncio.ensure_future(group[0].host(room_ready)))
+            tasks += [asyncio.ensure_future(p.guest(room_ready)) for p in group[1:]]
+            # 部屋ごとに開始をずらす
+            await asyncio.sleep(args.ramp_up / (players / ROOM_SIZE))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    if sql:
+        await close_app_engines()
+
+    report = rec.report(elapsed, sql)
+    report["config"] = {
+        "players": players,
+        "url": args.url,
+        "wait_interval": args.wait_interval,
+        "result_interval": args.result_interval,
+        "live_seconds": args.live_seconds,
+        "ramp_up": args.ramp_up,
+        "poll_timeout": args.poll_timeout,
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--players", type=int, default=400)
+    parser.add_argument("--url", help="server to load; default is the in-process app")
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--wait-interval", type=float, default=1.0)
+    parser.add_argument("--result-interval", type=float, default=1.0)
+    parser.add_argument("--live-seconds", type=float, default=5.0)
+    parser.add_argument("--ramp-up", type=float, default=5.0)
+    parser.add_argument("--poll-timeout", type=float, default=120.0)
+    parser.add_argument("--out", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
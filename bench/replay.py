@@ -0,0 +1,302 @@
+"""Re-drive a request trace (TRACE_FILE) against a server
+
+    python -m bench.replay trace.jsonl                    # in-process app, 1x
+    python -m bench.replay trace.jsonl --speed 3 --url http://127.0.0.1:8000
+
+Requests are sent at their recorded offsets divided by `--speed`, without
+waiting for earlier ones, like the clients did. Every anonymized token in
+the trace gets a freshly created user. The room a /room/create or
+/room/matchmake returned in the trace is mapped to the one it returns in
+the replay (the first request that returned it wins), and later requests
+naming that room wait for the mapping. A long-poll `version` is replaced
+by the last X-Room-Version the replay saw for that user and room.
+
+Prints a JSON report comparing recorded and replayed latency per route.
+`lag_ms` is how late requests were sent; if it grows, the replayer
+itself could not keep up and the latencies say little about the server.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import defaultdict
+from typing import Optional
+from urllib.parse import parse_qsl
+
+import httpx
+
+ROOM_ROUTES = ("/room/create", "/room/matchmake")
+USER_BATCH = 1000  # config.BATCH_MAX_SIZE の既定値
+
+
+def load(path: str) -> list[dict]:
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # 書きかけの最後の行など
+                continue
+    entries.sort(key=lambda e: e["ts"])
+    return entries
+
+
+def _percentile(values: list[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class Replay:
+    def __init__(self, client: httpx.AsyncClient, entries: list[dict], speed: float):
+        self.client = client
+        self.entries = entries
+        self.speed = speed
+        self.tokens: dict[str, str] = {}  # 匿名化した token -> 作ったユーザーの token
+        # トレースの room_id -> 再生の room_id
+        self.rooms: dict[int, asyncio.Future] = {}
+        self.versions: dict[tuple, str] = {}  # (token, room_id) -> X-Room-Version
+        self.recorded: dict[str, list[float]] = defaultdict(list)
+        self.replayed: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.throttled: dict[str, int] = defaultdict(int)
+        self.mismatched: dict[str, int] = defaultdict(int)  # 記録と違うステータス
+        self.lag: list[float] = []
+
+    async def setup(self) -> None:
+        anon = []
+        for entry in self.entries:
+            for token in _tokens(entry):
+                if token not in self.tokens:
+                    self.tokens[token] = ""
+                    anon.append(token)
+        for i in range(0, len(anon), USER_BATCH):
+            chunk = anon[i : i + USER_BATCH]
+            res = await self.client.post(
+                "/user/create_batch",
+                json={
+                    "users": [
+                        {"user_name": f"replay{i + j}", "leader_card_id": 1}
+                        for j in range(len(chunk))
+                    ]
+                },
+            )
+            res.raise_for_status()
+            self.tokens.update(zip(chunk, res.json()["user_tokens"]))
+        loop = asyncio.get_running_loop()
+        for entry in self.entries:
+            room_id = entry.get("room_id")
+            if entry["route"] in ROOM_ROUTES and room_id is not None:
+                self.rooms.setdefault(room_id, loop.create_future())
+
+    async def run(self) -> float:
+        """Send every entry on schedule; returns the elapsed seconds"""
+        if not self.entries:
+            return 0.0
+        t0 = self.entries[0]["ts"]
+        start = time.perf_counter()
+        tasks = []
+        claimed: set[int] = set()
+        for entry in self.entries:
+            due = (entry["ts"] - t0) / self.speed
+            delay = due - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.lag.append(max(0.0, time.perf_counter() - start - due))
+            # 同じ room_id を返した最初のリクエストが対応を決める
+            room_id = entry.get("room_id")
+            owner = (
+                entry["route"] in ROOM_ROUTES
+                and room_id is not None
+                and room_id not in claimed
+            )
+            if owner:
+                claimed.add(room_id)
+            tasks.append(asyncio.ensure_future(self.send(entry, owner)))
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - start
+
+    async def send(self, entry: dict, owner: bool = False) -> None:
+        route = entry["route"]
+        token = self.tokens.get(entry.get("token"))
+        headers = {"Authorization": f"bearer {token}"} if token else {}
+        new_room_id = None
+        try:
+            body = await self._map_body(entry.get("body"))
+            params = await self._map_query(entry.get("query", ""), token, body)
+            start = time.perf_counter()
+            try:
+                res = await self.client.request(
+                    entry["method"],
+                    entry["path"],
+                    params=params,
+                    json=body,
+                    headers=headers,
+                )
+            except httpx.HTTPError:
+                self.errors[route] += 1
+                return
+            self.recorded[route].append(entry["latency"])
+            self.replayed[route].append(time.perf_counter() - start)
+            if res.status_code == 429:
+                self.throttled[route] += 1
+            elif res.status_code >= 500:
+                self.errors[route] += 1
+            if res.status_code != entry["status"]:
+                self.mismatched[route] += 1
+            if res.status_code == 200:
+                if route == "/room/wait" and isinstance(body, dict):
+                    version = res.headers.get("X-Room-Version")
+                    if version is not None:
+                        self.versions[(token, body.get("room_id"))] = version
+                if owner:
+                    new_room_id = res.json().get("room_id")
+        finally:
+            if owner:
+                # 失敗したらトレースの room_id のまま送る
+                future = self.rooms[entry["room_id"]]
+                if not future.done():
+                    future.set_result(new_room_id)
+
+    async def _room(self, room_id):
+        future = self.rooms.get(room_id)
+        if future is None:
+            return room_id
+        mapped = await future
+        return room_id if mapped is None else mapped
+
+    async def _map_body(self, body):
+        if not isinstance(body, dict):
+            return body
+        body = dict(body)
+        if "room_id" in body:
+            body["room_id"] = await self._room(body["room_id"])
+        if isinstance(body.get("results"), list):
+            results = []
+            for item in body["results"]:
+                item = dict(item)
+                item["user_token"] = self.tokens.get(item.get("user_token"), "")
+                item["room_id"] = await self._room(item.get("room_id"))
+                results.append(item)
+            body["results"] = results
+        return body
+
+    async def _map_query(self, query: str, token: Optional[str], body) -> dict:
+        params = dict(parse_qsl(query))
+        if "version" in params:
+            room_id = body.get("room_id") if isinstance(body, dict) else None
+            version = self.versions.get((token, room_id))
+            if version is None:
+                # まだこの部屋を見ていない. ロングポーリングなしの 1 回にする
+                del params["version"]
+            else:
+                params["version"] = version
+        return params
+
+    def report(self, elapsed: float) -> dict:
+        routes = {}
+        for route in sorted(set(self.recorded) | set(self.errors)):
+            recorded = sorted(self.recorded[route])
+            replayed = sorted(self.replayed[route])
+            row = {"count": len(replayed), "errors": self.errors[route]}
+            row["throttled"] = self.throttled[route]
+            row["status_mismatch"] = self.mismatched[route]
+            for q, name in ((0.50, "p50"), (0.95, "p95"), (0.99, "p99")):
+                rec = _percentile(recorded, q)
+                rep = _percentile(replayed, q)
+                row[f"recorded_{name}_ms"] = _ms(rec)
+                row[f"replay_{name}_ms"] = _ms(rep)
+                row[f"{name}_ratio"] = rep / rec if rec and rep is not None else None
+            routes[route] = row
+        duration = self.entries[-1]["ts"] - self.entries[0]["ts"] if self.entries else 0
+        lag = sorted(self.lag)
+        return {
+            "requests": len(self.entries),
+            "users": len(self.tokens),
+            "trace_sec": duration,
+            "elapsed_sec": elapsed,
+            "speed": self.speed,
+            "achieved_speed": duration / elapsed if elapsed else None,
+            "rps": len(self.entries) / elapsed if elapsed else None,
+            "errors": sum(self.errors.values()),
+            "lag_ms": {
+                "p50": _ms(_percentile(lag, 0.50)),
+                "p99": _ms(_percentile(lag, 0.99)),
+                "max": _ms(lag[-1] if lag else None),
+            },
+            "routes": routes,
+        }
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else seconds * 1000
+
+
+async def close_app_engines() -> None:
+    """Close the in-process app's async connections opened on this loop"""
+    from app import db
+
+    storages = [shard.storage for shard in db.room_shards]
+    if db.replicas is not None:
+        storages += db.replicas.replicas
+    for storage in storages:
+        if storage.async_engine is not None:
+            await storage.async_engine.dispose()
+
+
+def _tokens(entry: dict):
+    if entry.get("token"):
+        yield entry["token"]
+    body = entry.get("body")
+    if isinstance(body, dict) and isinstance(body.get("results"), list):
+        for item in body["results"]:
+            if isinstance(item, dict) and item.get("user_token"):
+                yield item["user_token"]
+
+
+async def run(args) -> dict:
+    entries = load(args.trace)
+    if args.url is None:
+        from app.api import app
+
+        client = httpx.AsyncClient(app=app, base_url="http://replay", timeout=None)
+    else:
+        client = httpx.AsyncClient(
+            base_url=args.url,
+            limits=httpx.Limits(max_connections=args.connections),
+            timeout=60,
+        )
+    async with client:
+        replay = Replay(client, entries, args.speed)
+        await replay.setup()
+        elapsed = await replay.run()
+    if args.url is None:
+        await close_app_engines()
+    report = replay.report(elapsed)
+    report["config"] = {"trace": args.trace, "url": args.url}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace", help="a TRACE_FILE written by the server")
+    parser.add_argument("--speed", type=float, default=1.0, help="2 = twice as fast")
+    parser.add_argument("--url", help="server to replay against; default in-process")
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--out", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+-- /room/list: WHERE live_id = ? AND room_status = 1 AND room_id > ? ORDER BY room_id
+-- (live_id = 0 のときは room_status だけで絞る)
+ALTER TABLE `room`
+  ADD KEY `live_id_room_status` (`live_id`, `room_status`),
+  ADD KEY `room_status` (`room_status`);
@@ -0,0 +1,9 @@
+-- room.updated_at: 最後に状態が変わった時刻 (UNIX 秒). app.reaper が
+-- WHERE room_status = ? AND updated_at < ? で古いルームを探す.
+-- `room_status` (001) は /room/list (live_id = 0) の room_id 順のソートに使うので残す
+ALTER TABLE `room`
+  ADD COLUMN `updated_at` bigint NOT NULL DEFAULT 0,
+  ADD KEY `room_status_updated_at` (`room_status`, `updated_at`);
+
+-- 既存のルームは今から数える
+UPDATE `room` SET `updated_at` = UNIX_TIMESTAMP();
@@ -0,0 +1,14 @@
+-- スコアの履歴. room_member と違ってルームを消しても残る.
+-- ランキング (app.leaderboard) は起動時に全件読み, 以降は id で追いかける
+CREATE TABLE `live_score` (
+  `id` bigint NOT NULL AUTO_INCREMENT,
+  `live_id` int NOT NULL,
+  `user_id` bigint NOT NULL,
+  `name` varchar(255) DEFAULT NULL,
+  `leader_card_id` int DEFAULT NULL,
+  `room_id` bigint NOT NULL,
+  `score` int NOT NULL,
+  `created_at` bigint NOT NULL,
+  PRIMARY KEY (`id`),
+  KEY `live_id_user_id` (`live_id`, `user_id`)
+);
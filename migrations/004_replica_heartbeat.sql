@@ -0,0 +1,6 @@
+-- レプリカの遅延の計測 (app.replicas). 主 DB に時刻を書き, レプリカで読む
+CREATE TABLE `replica_heartbeat` (
+  `id` int NOT NULL,
+  `ts` double NOT NULL,
+  PRIMARY KEY (`id`)
+);
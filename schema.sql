@@ -16,7 +16,11 @@ CREATE TABLE `room` (
   `joined_user_count` int DEFAULT 1,
   `max_user_count` int DEFAULT 4,
   `room_status` int DEFAULT 1,
-  PRIMARY KEY (`room_id`)
+  `updated_at` bigint NOT NULL DEFAULT 0,
+  PRIMARY KEY (`room_id`),
+  KEY `live_id_room_status` (`live_id`, `room_status`),
+  KEY `room_status` (`room_status`),
+  KEY `room_status_updated_at` (`room_status`, `updated_at`)
 );
 
 DROP TABLE IF EXISTS `room_member`;
@@ -35,4 +39,24 @@ CREATE TABLE `room_member` (
   `score_bad` int DEFAULT NULL,
   `score_miss` int DEFAULT NULL,
   PRIMARY KEY (`room_id`, `user_id`)
-);
\ No newline at end of file
+);
+
+DROP TABLE IF EXISTS `live_score`;
+CREATE TABLE `live_score` (
+  `id` bigint NOT NULL AUTO_INCREMENT,
+  `live_id` int NOT NULL,
+  `user_id` bigint NOT NULL,
+  `name` varchar(255) DEFAULT NULL,
+  `leader_card_id` int DEFAULT NULL,
+  `room_id` bigint NOT NULL,
+  `score` int NOT NULL,
+  `created_at` bigint NOT NULL,
+  PRIMARY KEY (`id`),
+  KEY `live_id_user_id` (`live_id`, `user_id`)
+);
+DROP TABLE IF EXISTS `replica_heartbeat`;
+CREATE TABLE `replica_heartbeat` (
+  `id` int NOT NULL,
+  `ts` double NOT NULL,
+  PRIMARY KEY (`id`)
+);
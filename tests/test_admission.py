@@ -0,0 +1,69 @@
+from fastapi.testclient import TestClient
+
+from app import api, config, metrics
+from app.admission import AdmissionController, PollRates
+from app.api import app
+
+client = TestClient(app)
+
+
+def test_poll_rates():
+    rates = PollRates(rate=2.0, burst=3)
+    assert [rates.hit("a", now=100.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert rates.hit("a", now=100.0) == 0.5
+    assert rates.hit("b", now=100.0) == 0.0  # トークンごと
+    assert rates.hit("a", now=100.5) == 0.0
+
+
+def test_poll_rates_stay_bounded():
+    rates = PollRates(rate=1.0, burst=1, max_tokens=100)
+    for i in range(1000):
+        rates.hit(f"token{i}", now=float(i))
+    assert len(rates) <= 100
+
+
+def test_overload_and_delay():
+    admission = AdmissionController(rate=100, burst=100, max_inflight=2)
+    assert admission.next_poll_delay(1.0, 4.0, 10.0) == 1.0
+    with admission.track():
+        assert admission.next_poll_delay(1.0, 4.0, 10.0) == 3.0
+        with admission.track():
+            assert admission.admit("x") == (1.0, "overload")
+            assert admission.next_poll_delay(1.0, 4.0, 10.0) == 5.0
+            assert admission.next_poll_delay(0.0, 4.0, 10.0) == 0.0
+    assert admission.admit("x") == (0.0, None)
+
+
+def _token(name):
+    res = client.post("/user/create", json={"user_name": name, "leader_card_id": 1})
+    return {"Authorization": f"bearer {res.json()['user_token']}"}
+
+
+def test_wait_and_result_pacing(monkeypatch):
+    monkeypatch.setattr(api, "poll_admission", AdmissionController(1.0, 2, 100))
+    headers = _token("admission_host")
+    res = client.post(
+        "/room/create", headers=headers, json={"live_id": 9301, "select_difficulty": 1}
+    )
+    room_id = res.json()["room_id"]
+
+    res = client.post("/room/wait", headers=headers, json={"room_id": room_id})
+    assert res.json()["next_poll_delay_ms"] == int(config.WAIT_POLL_INTERVAL * 1000)
+    res = client.post("/room/result", headers=headers, json={"room_id": room_id})
+    assert res.json() == {
+        "result_user_list": [],
+        "next_poll_delay_ms": int(config.RESULT_POLL_INTERVAL * 1000),
+    }
+
+    # burst を使い切ったら model に届く前に断る
+    before = metrics.polls_rejected.get(("/room/wait", "rate"))
+    res = client.post("/room/wait", headers=headers, json={"room_id": room_id})
+    assert res.status_code == 429
+    assert res.headers["Retry-After"] == "1"
+    assert metrics.polls_rejected.get(("/room/wait", "rate")) == before + 1
+
+    # 他のトークンは別枠
+    res = client.post(
+        "/room/wait", headers=_token("admission_guest"), json={"room_id": room_id}
+    )
+    assert res.status_code == 200
@@ -0,0 +1,118 @@
+import socket
+import time
+
+from app import events, model
+from app.events import LocalEventBus, RoomEvent, UnixSocketEventBus
+from app.model import LiveDifficulty, create_user
+
+
+def _wait_for(received, n, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while len(received) < n and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return received
+
+
+def test_local_bus():
+    bus = LocalEventBus()
+    received = []
+
+    def broken(event):
+        raise RuntimeError("ignored")
+
+    bus.subscribe(broken)
+    bus.subscribe(received.append)
+    bus.publish(RoomEvent(events.JOINED, 1, 2, 3))
+    assert [(e.kind, e.room_id, e.live_id, e.user_id) for e in received] == [
+        (events.JOINED, 1, 2, 3)
+    ]
+    assert received[0].origin == bus.origin
+
+
+def test_unix_socket_bus(tmp_path):
+    # 落ちたワーカーが残したソケット
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    stale.bind(str(tmp_path / "dead.sock"))
+    stale.close()
+
+    a = UnixSocketEventBus(str(tmp_path))
+    b = UnixSocketEventBus(str(tmp_path))
+    a.start()
+    b.start()
+    try:
+        from_a, from_b = [], []
+        a.subscribe(from_a.append)
+        b.subscribe(from_b.append)
+        a.publish(RoomEvent(events.HOST_CHANGED, 10, 20, 30))
+        _wait_for(from_b, 1)
+        assert [
+            (e.kind, e.room_id, e.live_id, e.user_id, e.origin) for e in from_b
+        ] == [(events.HOST_CHANGED, 10, 20, 30, a.origin)]
+        # 自分のイベントはその場で届く
+        assert [e.origin for e in from_a] == [a.origin]
+        assert not (tmp_path / "dead.sock").exists()
+
+        b.publish(RoomEvent(events.DELETED, 10, 20))
+        _wait_for(from_a, 2)
+        assert [e.kind for e in from_a] == [events.HOST_CHANGED, events.DELETED]
+    finally:
+        a.stop()
+        b.stop()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_transitions_are_published():
+    host, guest = [create_user(f"events_{i}", 1000) for i in range(2)]
+    normal = LiveDifficulty.normal
+    received = []
+    model.room_events.subscribe(received.append)
+    try:
+        room_id = model.create_room(host, 9101, normal)
+        model.join_room(guest, room_id, normal)
+        model.leave_room(host, room_id)
+        model.leave_room(guest, room_id)
+    finally:
+        model.room_events.unsubscribe(received.append)
+    host_id = model.get_user_by_token(host).id
+    guest_id = model.get_user_by_token(guest).id
+    assert [(e.kind, e.room_id, e.user_id) for e in received] == [
+        (events.CREATED, room_id, host_id),
+        (events.JOINED, room_id, guest_id),
+        (events.LEFT, room_id, host_id),
+        (events.HOST_CHANGED, room_id, guest_id),
+        (events.DELETED, room_id, None),
+    ]
+    assert {e.live_id for e in received} == {9101}
+
+
+def test_remote_events_update_caches():
+    live_id = 9102
+    room_id = 990001  # 他のワーカーが作ったルーム
+
+    def remote(kind, user_id=None):
+        model._on_room_event(RoomEvent(kind, room_id, live_id, user_id, "other"))
+
+    version = model.room_notifier.version(room_id)
+    generation = model._lobby_generations.get(live_id, 0)
+    remote(events.CREATED, 1)
+    assert model.open_rooms.free_slots(room_id) == model.DEFAULT_MAX_USER_COUNT - 1
+    assert model.room_notifier.version(room_id) > version
+    assert model._lobby_generations[live_id] == generation + 1
+
+    remote(events.JOINED, 2)
+    assert model.open_rooms.free_slots(room_id) == model.DEFAULT_MAX_USER_COUNT - 2
+    remote(events.LEFT, 2)
+    assert model.open_rooms.free_slots(room_id) == model.DEFAULT_MAX_USER_COUNT - 1
+
+    # 自分の出したイベントは二重に反映しない
+    model._on_room_event(
+        RoomEvent(events.JOINED, room_id, live_id, 2, model.room_events.origin)
+    )
+    assert model.open_rooms.free_slots(room_id) == model.DEFAULT_MAX_USER_COUNT - 1
+
+    remote(events.STARTED)
+    assert room_id not in model.open_rooms
+    model.result_cache.set(room_id, [])
+    remote(events.DELETED)
+    assert model.result_cache.get(room_id) is None
+    assert model.room_notifier.version(room_id) == 0
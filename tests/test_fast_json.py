@@ -0,0 +1,85 @@
+from fastapi.testclient import TestClient
+
+from app import config
+from app.api import app
+
+client = TestClient(app)
+
+
+def _headers(token):
+    return {"Authorization": f"bearer {token}"}
+
+
+def _both(monkeypatch, path, headers, body):
+    monkeypatch.setattr(config, "FAST_JSON", False)
+    slow = client.post(path, headers=headers, json=body)
+    monkeypatch.setattr(config, "FAST_JSON", True)
+    fast = client.post(path, headers=headers, json=body)
+    assert slow.status_code == fast.status_code == 200
+    return slow, fast
+
+
+def test_fast_json_same_payload(monkeypatch):
+    tokens = [
+        client.post(
+            "/user/create", json={"user_name": f"fast_{i}", "leader_card_id": 10 + i}
+        ).json()["user_token"]
+        for i in range(3)
+    ]
+    room_id = client.post(
+        "/room/create",
+        headers=_headers(tokens[0]),
+        json={"live_id": 6001, "select_difficulty": 2},
+    ).json()["room_id"]
+    for token in tokens[1:]:
+        client.post(
+            "/room/join",
+            headers=_headers(token),
+            json={"room_id": room_id, "select_difficulty": 1},
+        )
+
+    slow, fast = _both(
+        monkeypatch, "/room/wait", _headers(tokens[1]), {"room_id": room_id}
+    )
+    assert fast.json() == slow.json()
+    assert fast.headers["X-Room-Version"] == slow.headers["X-Room-Version"]
+    assert [u["is_me"] for u in fast.json()["room_user_list"]] == [False, True, False]
+
+    slow, fast = _both(
+        monkeypatch, "/room/list", _headers(tokens[0]), {"live_id": 6001}
+    )
+    assert fast.json() == slow.json()
+    assert fast.json()["room_info_list"][0]["joined_user_count"] == 3
+
+    # 削除済みのルーム
+    slow, fast = _both(monkeypatch, "/room/wait", _headers(tokens[0]), {"room_id": -1})
+    assert (
+        fast.json()
+        == slow.json()
+        == {"status": 3, "room_user_list": [], "next_poll_delay_ms": 0}
+    )
+
+    client.post("/room/start", headers=_headers(tokens[0]), json={"room_id": room_id})
+    for i, token in enumerate(tokens):
+        client.post(
+            "/room/end",
+            headers=_headers(token),
+            json={"room_id": room_id, "score": 100 * i, "judge_count_list": [i] * 5},
+        )
+    slow, fast = _both(
+        monkeypatch, "/room/result", _headers(tokens[0]), {"room_id": room_id}
+    )
+    assert fast.json() == slow.json()
+    results = sorted(fast.json()["result_user_list"], key=lambda r: r["score"])
+    assert [r["judge_count_list"] for r in results] == [[i] * 5 for i in range(3)]
+
+
+def test_fast_json_keeps_schema():
+    schema = app.openapi()["paths"]
+    for path, model in (
+        ("/room/wait", "RoomWaitResponse"),
+        ("/room/list", "RoomListResponse"),
+        ("/room/result", "RoomResultResponse"),
+    ):
+        content = schema[path]["post"]["responses"]["200"]["content"]
+        assert content["application/json"]["schema"]["$ref"].endswith(model)
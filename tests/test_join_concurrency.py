@@ -0,0 +1,69 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import text
+
+from app import model
+from app.model import JoinRoomResult, LiveDifficulty
+
+N_USERS = 40
+THREADS = 16
+
+tokens = [model.create_user(f"join_user_{i}", 1000) for i in range(N_USERS)]
+
+
+def _room_counts(room_id):
+    if model.room_registry is not None:
+        model.room_registry.flush()
+    with model.room_shards.for_room(room_id).engine.begin() as conn:
+        joined_user_count = conn.execute(
+            text("SELECT joined_user_count FROM room WHERE room_id=:room_id"),
+            {"room_id": room_id},
+        ).scalar()
+        members = conn.execute(
+            text("SELECT count(*) FROM room_member WHERE room_id=:room_id"),
+            {"room_id": room_id},
+        ).scalar()
+    return joined_user_count, members
+
+
+def test_concurrent_join_never_overfills():
+    room_id = model.create_room(tokens[0], 3001, LiveDifficulty.normal)
+
+    with ThreadPoolExecutor(THREADS) as pool:
+        results = list(
+            pool.map(
+                lambda token: model.join_room(token, room_id, LiveDifficulty.hard),
+                tokens[1:],
+            )
+        )
+
+    assert results.count(JoinRoomResult.Ok) == 3
+    assert results.count(JoinRoomResult.RoomFull) == N_USERS - 4
+    assert _room_counts(room_id) == (4, 4)
+
+    # 同じユーザーの join のリトライは人数を増やさない
+    winner = tokens[1 + results.index(JoinRoomResult.Ok)]
+    assert model.join_room(winner, room_id, LiveDifficulty.hard) == JoinRoomResult.Ok
+    assert _room_counts(room_id) == (4, 4)
+
+
+def test_join_many_rooms_concurrently():
+    hosts = tokens[: N_USERS // 4]
+    room_ids = [model.create_room(t, 3002, LiveDifficulty.normal) for t in hosts]
+    jobs = [
+        (token, room_ids[i % len(room_ids)])
+        for i, token in enumerate(tokens[N_USERS // 4 :])
+    ]
+    with ThreadPoolExecutor(THREADS) as pool:
+        results = list(
+            pool.map(
+                lambda job: model.join_room(job[0], job[1], LiveDifficulty.normal),
+                jobs,
+            )
+        )
+    for room_id in room_ids:
+        joined_user_count, members = _room_counts(room_id)
+        assert joined_user_count == members <= 4
+    assert results.count(JoinRoomResult.Ok) == 3 * len(room_ids)
+    for token, room_id in zip(hosts, room_ids):
+        model.start_room(token, room_id)
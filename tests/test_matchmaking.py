@@ -0,0 +1,109 @@
+from fastapi.testclient import TestClient
+
+from app.api import app
+from app.matchmaking import OpenRoomIndex
+
+client = TestClient(app)
+
+
+def _headers(token):
+    return {"Authorization": f"bearer {token}"}
+
+
+def _users(n):
+    return [
+        client.post(
+            "/user/create", json={"user_name": f"mm_{i}", "leader_card_id": 1000}
+        ).json()["user_token"]
+        for i in range(n)
+    ]
+
+
+def _matchmake(token, live_id):
+    response = client.post(
+        "/room/matchmake",
+        headers=_headers(token),
+        json={"live_id": live_id, "select_difficulty": 1},
+    )
+    assert response.status_code == 200
+    body = response.json()
+    return body["room_id"], body["created"]
+
+
+def test_open_room_index():
+    index = OpenRoomIndex()
+    index.add(1, 10, 1, 4)
+    index.add(2, 10, 3, 4)
+    index.add(3, 10, 4, 4)
+    index.add(4, 20, 1, 4)
+    # 一番埋まっているルームから
+    assert index.reserve(10) == 2
+    assert index.free_slots(2) == 0
+    assert index.reserve(10) == 1
+    assert index.free_slots(1) == 2
+    index.update(3, -1)  # 満員のルームから1人抜けた
+    assert index.reserve(10) == 3
+    index.remove(1)
+    assert index.reserve(10) is None
+    assert not index.has_open(10)
+    assert index.has_open(20)
+
+
+def test_matchmake():
+    live_id = 4001
+    tokens = _users(6)
+    room_id, created = _matchmake(tokens[0], live_id)
+    assert created
+    for token in tokens[1:4]:
+        assert _matchmake(token, live_id) == (room_id, False)
+
+    # 満員なので新しいルーム
+    room_id2, created = _matchmake(tokens[4], live_id)
+    assert created and room_id2 != room_id
+
+    response = client.post(
+        "/room/wait", headers=_headers(tokens[0]), json={"room_id": room_id}
+    )
+    assert len(response.json()["room_user_list"]) == 4
+
+    # 開始したルームには入らない
+    client.post("/room/leave", headers=_headers(tokens[3]), json={"room_id": room_id})
+    client.post("/room/start", headers=_headers(tokens[0]), json={"room_id": room_id})
+    assert _matchmake(tokens[5], live_id) == (room_id2, False)
+
+
+def test_matchmake_prefers_fullest():
+    live_id = 4002
+    tokens = _users(5)
+    room_a, _ = _matchmake(tokens[0], live_id)
+    # 2つ目のルームは手で作る
+    room_b = client.post(
+        "/room/create",
+        headers=_headers(tokens[1]),
+        json={"live_id": live_id, "select_difficulty": 1},
+    ).json()["room_id"]
+    client.post(
+        "/room/join",
+        headers=_headers(tokens[2]),
+        json={"room_id": room_b, "select_difficulty": 1},
+    )
+    assert _matchmake(tokens[3], live_id) == (room_b, False)
+
+
+def test_matchmake_stale_index():
+    # 他のワーカーでルームが埋まっていても, 失敗したルームを捨てて次に進む
+    from app import model
+
+    live_id = 4003
+    tokens = _users(6)
+    room_id, _ = _matchmake(tokens[0], live_id)
+    model.open_rooms.remove(room_id)
+    for token in tokens[1:4]:
+        client.post(
+            "/room/join",
+            headers=_headers(token),
+            json={"room_id": room_id, "select_difficulty": 1},
+        )
+    model.open_rooms.add(room_id, live_id, 1, 4)
+    room_id2, created = _matchmake(tokens[4], live_id)
+    assert created and room_id2 != room_id
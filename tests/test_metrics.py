@@ -0,0 +1,81 @@
+from fastapi.testclient import TestClient
+
+from app import metrics, model
+from app.api import app
+from app.cache import TTLCache
+
+client = TestClient(app)
+
+
+def test_metrics():
+    token = client.post(
+        "/user/create", json={"user_name": "metrics", "leader_card_id": 1000}
+    ).json()["user_token"]
+    headers = {"Authorization": f"bearer {token}"}
+    room_id = client.post(
+        "/room/create", headers=headers, json={"live_id": 3001, "select_difficulty": 1}
+    ).json()["room_id"]
+    before = metrics.request_seconds.count(("POST", "/room/wait"))
+    response = client.post("/room/wait", headers=headers, json={"room_id": room_id})
+    assert response.status_code == 200
+    assert metrics.request_seconds.count(("POST", "/room/wait")) == before + 1
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    body = response.text
+    assert (
+        'http_request_duration_seconds_count{method="POST",route="/room/wait"}' in body
+    )
+    assert (
+        'http_requests_total{method="POST",route="/room/create",status="200"}' in body
+    )
+    assert 'db_statements_per_request_bucket{route="/room/create",le="+Inf"}' in body
+    assert 'rooms{status="Waiting"}' in body
+
+
+def test_metrics_cache_stats():
+    token = client.post(
+        "/user/create", json={"user_name": "cache_stats", "leader_card_id": 1000}
+    ).json()["user_token"]
+    headers = {"Authorization": f"bearer {token}"}
+    hits = model.user_cache.hits
+    for _ in range(2):
+        client.get("/user/me", headers=headers)
+    assert model.user_cache.hits > hits
+
+    body = client.get("/metrics").text
+    assert "# TYPE cache_hits_total counter" in body
+    assert f'cache_hits_total{{cache="user"}} {model.user_cache.hits}' in body
+    assert 'cache_misses_total{cache="user"}' in body
+    assert 'cache_evictions_total{cache="room_list"}' in body
+    assert 'cache_entries{cache="result"}' in body
+
+    caches = client.get("/debug/pool").json()["caches"]
+    assert caches["user"] == model.user_cache.stats()
+
+
+def test_cache_counts_evictions():
+    cache = TTLCache(2, 60)
+    for key in "abc":
+        cache.set(key, key)
+    assert cache.get("a") is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_metrics_route_template():
+    # パスパラメータはラベルに入れない
+    client.get("/room/events/12345")
+    assert metrics.request_seconds.count(("GET", "/room/events/{room_id}")) >= 1
+
+
+def test_histogram_render():
+    h = metrics.Histogram("t", "test", ("route",), (0.1, 1))
+    h.observe(("/a",), 0.05)
+    h.observe(("/a",), 0.5)
+    h.observe(("/a",), 5)
+    lines = list(h.render())
+    assert 't_bucket{route="/a",le="0.1"} 1' in lines
+    assert 't_bucket{route="/a",le="1"} 2' in lines
+    assert 't_bucket{route="/a",le="+Inf"} 3' in lines
+    assert 't_count{route="/a"} 3' in lines
@@ -0,0 +1,238 @@
+"""SQL budget per endpoint: statements, round trips and connections
+
+Every endpoint in app.api has an entry in BUDGETS. test_query_budget
+calls each one once with the caches emptied (the first call of a user
+after the caches expired, the most a request normally costs) and fails
+when any count is over its budget, listing the statements the request ran
+with the ones past the budget marked "+".
+
+round_trips are statements plus COMMIT/ROLLBACK, including the rollback
+the pool does when a connection is returned; BEGIN is not counted, as
+MySQL starts transactions implicitly. connections are pool checkouts.
+
+Budgets are for a single database. With ROOM_SHARD_URIS, Budget.scaled()
+adds the connection a room on another shard needs to read the user from
+the main database, and multiplies the budgets of endpoints that ask every
+shard. With ROOM_REGISTRY or
+SCORE_BUFFER the counts are lower and the same budgets still hold.
+"""
+
+import threading
+from typing import NamedTuple
+
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from app import db, model
+from app.api import app
+
+client = TestClient(app)
+
+
+class Budget(NamedTuple):
+    statements: int
+    round_trips: int
+    connections: int
+    # "room": ルームのシャードで動く. "all": 全シャードに同じ問い合わせをする
+    shards: str = ""
+
+    def scaled(self, n: int) -> "Budget":
+        """This budget with `n` room shards"""
+        if n == 1 or not self.shards:
+            return self
+        if self.shards == "all":
+            return Budget(
+                self.statements * n, self.round_trips * n, self.connections * n
+            )
+        # 主 DB でないシャードでは, ユーザーを主 DB から別の接続で読む
+        return Budget(self.statements, self.round_trips + 2, self.connections + 1)
+
+
+BUDGETS = {
+    "/": Budget(0, 0, 0),
+    "/debug/pool": Budget(0, 0, 0),
+    "/metrics": Budget(1, 3, 1, "all"),  # ルーム数のゲージ
+    "/user/create": Budget(1, 3, 1),
+    "/user/create_batch": Budget(1, 3, 1),
+    "/user/me": Budget(1, 3, 1),
+    "/user/update": Budget(1, 3, 1),
+    "/room/create": Budget(3, 5, 1, "room"),
+    "/room/list": Budget(1, 3, 1, "all"),
+    "/room/join": Budget(4, 6, 1, "room"),
+    # 空きのあるルームに入れたとき. 入れなければ join を繰り返して作る
+    "/room/matchmake": Budget(4, 6, 1, "room"),
+    "/room/wait": Budget(3, 5, 1, "room"),
+    "/room/start": Budget(3, 5, 1, "room"),
+    "/room/end": Budget(4, 6, 1, "room"),
+    "/room/end_batch": Budget(5, 7, 1, "room"),
+    "/room/result": Budget(2, 4, 1, "room"),
+    "/room/leave": Budget(7, 9, 1, "room"),
+    # ユーザーと, ランキングの差分の読み直し
+    "/live/{live_id}/ranking": Budget(2, 6, 2, "all"),
+}
+# ストリームは 1 リクエストの中で何度も読む
+STREAMS = {"/room/ws/{room_id}", "/room/events/{room_id}"}
+
+
+class QueryLog:
+    """Statements, commits/rollbacks and checkouts on every engine of the app"""
+
+    def __init__(self):
+        self.statements: list[str] = []
+        self.ends = 0  # COMMIT, ROLLBACK
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._engines = []
+        storages = [shard.storage for shard in db.room_shards]
+        if db.replicas is not None:
+            storages += db.replicas.replicas
+        for storage in storages:
+            self._engines.append(storage.engine)
+            if storage.async_engine is not None:
+                self._engines.append(storage.async_engine.sync_engine)
+
+    @property
+    def round_trips(self) -> int:
+        return len(self.statements) + self.ends
+
+    def clear(self) -> None:
+        with self._lock:
+            self.statements = []
+            self.ends = 0
+            self.connections = 0
+
+    def _statement(self, conn, cursor, statement, parameters, context, executemany):
+        # SQLite の BEGIN / BEGIN IMMEDIATE (app.storage). MySQL では送らないので数えない
+        if statement.startswith("BEGIN"):
+            return
+        with self._lock:
+            self.statements.append(" ".join(statement.split()))
+
+    def _end(self, *args) -> None:
+        with self._lock:
+            self.ends += 1
+
+    def _checkout(self, *args) -> None:
+        with self._lock:
+            self.connections += 1
+
+    def _listeners(self):
+        for engine in self._engines:
+            yield engine, "before_cursor_execute", self._statement
+            yield engine, "commit", self._end
+            yield engine, "rollback", self._end
+            yield engine.pool, "reset", self._end
+            yield engine.pool, "checkout", self._checkout
+
+    def __enter__(self) -> "QueryLog":
+        for target, name, fn in self._listeners():
+            event.listen(target, name, fn)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        for target, name, fn in self._listeners():
+            event.remove(target, name, fn)
+
+    def over(self, budget: Budget) -> list[str]:
+        """What is over `budget`, empty if nothing"""
+        return [
+            f"{name}: {used} > {limit}"
+            for name, used, limit in (
+                ("statements", len(self.statements), budget.statements),
+                ("round_trips", self.round_trips, budget.round_trips),
+                ("connections", self.connections, budget.connections),
+            )
+            if used > limit
+        ]
+
+    def diff(self, budget: Budget) -> str:
+        return "\n".join(
+            ("+ " if i >= budget.statements else "  ") + statement
+            for i, statement in enumerate(self.statements)
+        )
+
+
+def _clear_caches():
+    model.user_cache.clear()
+    model.room_list_cache.clear()
+    model.result_cache.clear()
+
+
+def _headers(token):
+    return {"Authorization": f"bearer {token}"}
+
+
+class _Calls:
+    """Calls endpoints one by one and collects the ones over budget"""
+
+    def __init__(self, log: QueryLog):
+        self.log = log
+        self.failures: list[str] = []
+
+    def __call__(self, route, token=None, body=None, method="POST", path=None):
+        # SCORE_BUFFER で後回しになった /room/end の書き込みは先に済ませる
+        if model.score_buffer is not None:
+            model.score_buffer.flush()
+        _clear_caches()
+        self.log.clear()
+        res = client.request(
+            method,
+            path or route,
+            json=body,
+            headers=_headers(token) if token else {},
+        )
+        assert res.status_code == 200, (route, res.text)
+        budget = BUDGETS[route].scaled(len(db.room_shards))
+        over = self.log.over(budget)
+        if over:
+            self.failures.append(
+                f"{method} {route}: {', '.join(over)}\n{self.log.diff(budget)}"
+            )
+        return res
+
+
+def test_every_endpoint_has_a_budget():
+    routes = {route.path for route in app.routes} - STREAMS
+    documented = {"/openapi.json", "/docs", "/docs/oauth2-redirect", "/redoc"}
+    assert routes - documented == set(BUDGETS)
+
+
+def test_query_budget():
+    a, b, c = model.create_users([(f"budget_{i}", 1000) for i in range(3)])
+    live_id = 7201
+    judge = [1, 0, 0, 0, 0]
+    if model.room_registry is not None:
+        # 起動時に 1 度だけの読み込みを済ませておく
+        model.room_registry.count_by_status()
+    with QueryLog() as log:
+        call = _Calls(log)
+        call("/", method="GET")
+        call("/debug/pool", method="GET")
+        call("/metrics", method="GET")
+        call("/user/create", body={"user_name": "budget", "leader_card_id": 1})
+        users = [
+            {"user_name": f"budget_batch{i}", "leader_card_id": 1} for i in range(4)
+        ]
+        call("/user/create_batch", body={"users": users})
+        call("/user/me", a, method="GET")
+        call("/user/update", a, {"user_name": "budget_a", "leader_card_id": 2})
+        res = call("/room/create", a, {"live_id": live_id, "select_difficulty": 1})
+        room_id = res.json()["room_id"]
+        call("/room/list", b, {"live_id": live_id})
+        call("/room/join", b, {"room_id": room_id, "select_difficulty": 1})
+        call("/room/matchmake", c, {"live_id": live_id, "select_difficulty": 1})
+        call("/room/wait", a, {"room_id": room_id})
+        call("/room/start", a, {"room_id": room_id})
+        call(
+            "/room/end", a, {"room_id": room_id, "judge_count_list": judge, "score": 1}
+        )
+        results = [
+            {"room_id": room_id, "user_token": t, "judge_count_list": judge, "score": 1}
+            for t in (b, c)
+        ]
+        call("/room/end_batch", body={"results": results})
+        call("/room/result", a, {"room_id": room_id})
+        call("/room/leave", a, {"room_id": room_id})
+        route = "/live/{live_id}/ranking"
+        call(route, b, method="GET", path=f"/live/{live_id}/ranking")
+    assert not call.failures, "over the SQL budget:\n\n" + "\n\n".join(call.failures)
@@ -0,0 +1,111 @@
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from app import model
+from app.api import app
+from app.leaderboard import Leaderboard
+
+client = TestClient(app)
+
+
+def _headers(token):
+    return {"Authorization": f"bearer {token}"}
+
+
+def test_leaderboard():
+    board = Leaderboard()
+    assert board.submit(1, "a", 1, 100)
+    assert board.submit(2, "b", 1, 300)
+    assert board.submit(3, "c", 1, 200)
+    assert not board.submit(2, "b", 1, 250)  # 自己ベストではない
+    assert board.submit(1, "a", 1, 300)
+    assert [(rank, e.user_id, e.score) for rank, e in board.top(10)] == [
+        (1, 1, 300),
+        (1, 2, 300),
+        (3, 3, 200),
+    ]
+    assert board.get(3)[0] == 3
+    assert board.get(4) is None
+    assert len(board.top(2)) == 2
+
+
+def _play(live_id, tokens, scores):
+    room_id = client.post(
+        "/room/create",
+        headers=_headers(tokens[0]),
+        json={"live_id": live_id, "select_difficulty": 1},
+    ).json()["room_id"]
+    for token in tokens[1:]:
+        client.post(
+            "/room/join",
+            headers=_headers(token),
+            json={"room_id": room_id, "select_difficulty": 1},
+        )
+    client.post("/room/start", headers=_headers(tokens[0]), json={"room_id": room_id})
+    for token, score in zip(tokens, scores):
+        client.post(
+            "/room/end",
+            headers=_headers(token),
+            json={"room_id": room_id, "judge_count_list": [0] * 5, "score": score},
+        )
+    for token in tokens:
+        client.post("/room/leave", headers=_headers(token), json={"room_id": room_id})
+
+
+def test_ranking(monkeypatch):
+    monkeypatch.setattr(model.leaderboards, "refresh_interval", 0)
+    tokens = [
+        client.post(
+            "/user/create", json={"user_name": f"rank_{i}", "leader_card_id": i}
+        ).json()["user_token"]
+        for i in range(4)
+    ]
+    _play(7001, tokens[:3], [500, 900, 700])
+    _play(7001, tokens[:2], [1000, 100])  # ルームを消してもスコアは残る
+    _play(7002, tokens[3:], [50])
+    if model.room_registry is not None:
+        model.room_registry.flush()
+
+    response = client.get("/live/7001/ranking", headers=_headers(tokens[2]))
+    assert response.status_code == 200
+    body = response.json()
+    assert [(u["rank"], u["name"], u["score"]) for u in body["ranking"]] == [
+        (1, "rank_0", 1000),
+        (2, "rank_1", 900),
+        (3, "rank_2", 700),
+    ]
+    assert body["me"]["rank"] == 3
+
+    response = client.get("/live/7001/ranking?limit=1", headers=_headers(tokens[3]))
+    body = response.json()
+    assert len(body["ranking"]) == 1
+    assert body["me"] is None
+
+
+def test_ranking_and_metrics_only_read(monkeypatch):
+    monkeypatch.setattr(model.leaderboards, "refresh_interval", 0)
+    token = client.post(
+        "/user/create", json={"user_name": "rank_reader", "leader_card_id": 1}
+    ).json()["user_token"]
+    client.get("/live/7003/ranking", headers=_headers(token))
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engines = []
+    for shard in model.room_shards:
+        engines.append(shard.engine)
+        if shard.async_engine is not None:
+            engines.append(shard.async_engine.sync_engine)
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", record)
+    try:
+        assert client.get("/live/7003/ranking", headers=_headers(token)).is_success
+        assert client.get("/metrics").is_success
+    finally:
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", record)
+    assert statements
+    assert "BEGIN IMMEDIATE" not in statements
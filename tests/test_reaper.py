@@ -0,0 +1,120 @@
+import pytest
+from sqlalchemy import text
+
+from app import db, metrics, model
+from app.model import LiveDifficulty, WaitRoomStatus, create_user
+from app.reaper import RoomReaper
+from app.sharding import ShardSet
+
+
+def _age(room_id):
+    # 最後の更新をずっと昔にする. 溜まっている書き込みが後から上書きしないよう先に書く
+    _flush()
+    if model.room_registry is not None:
+        model.room_registry._rooms[room_id].updated_at = 0
+    with model.room_shards.for_room(room_id).engine.begin() as conn:
+        conn.execute(
+            text("UPDATE room SET updated_at = 0 WHERE room_id = :room_id"),
+            {"room_id": room_id},
+        )
+
+
+def _flush():
+    if model.score_buffer is not None:
+        model.score_buffer.flush()
+    if model.room_registry is not None:
+        model.room_registry.flush()
+
+
+def _room_row(room_id):
+    with model.room_shards.for_room(room_id).engine.begin() as conn:
+        room = conn.execute(
+            text("SELECT room_status FROM room WHERE room_id = :room_id"),
+            {"room_id": room_id},
+        ).one_or_none()
+        members = conn.execute(
+            text("SELECT COUNT(*) FROM room_member WHERE room_id = :room_id"),
+            {"room_id": room_id},
+        ).scalar()
+    return (room[0] if room is not None else None, members)
+
+
+def test_reaper():
+    tokens = [create_user(f"reaper_{i}", 1000) for i in range(3)]
+    normal = LiveDifficulty.normal
+    waiting = model.create_room(tokens[0], 5001, normal)
+    live = model.create_room(tokens[1], 5001, normal)
+    model.start_room(tokens[1], live)
+    finished = model.create_room(tokens[2], 5001, normal)
+    model.start_room(tokens[2], finished)
+    model.end_room(tokens[2], finished, [1, 0, 0, 0, 0], 100)
+    fresh = model.create_room(tokens[0], 5001, normal)
+    for room_id in (waiting, live, finished):
+        _age(room_id)
+    _flush()
+
+    before = metrics.rooms_reaped.get(("expired",))
+    counts = RoomReaper().run_once()
+    assert counts["expired"] >= 1
+    assert counts["dissolved"] >= 1
+    assert counts["deleted"] >= 1
+    assert metrics.rooms_reaped.get(("expired",)) == before + counts["expired"]
+
+    _flush()
+    assert _room_row(waiting) == (None, 0)
+    status, _ = model.wait_room(tokens[0], waiting)
+    assert status == WaitRoomStatus.Dissolution.value
+    assert _room_row(live) == (3, 1)
+    assert _room_row(finished) == (None, 0)
+    assert _room_row(fresh) == (1, 1)
+    rooms, _ = model.get_room_list(tokens[0], 5001)
+    assert [r.room_id for r in rooms] == [fresh]
+
+
+def test_reaper_batches(monkeypatch):
+    monkeypatch.setattr(model.config, "ROOM_REAPER_BATCH", 2)
+    token = create_user("reaper_batch", 1000)
+    rooms = [model.create_room(token, 5002, LiveDifficulty.normal) for _ in range(5)]
+    for room_id in rooms:
+        _age(room_id)
+    _flush()
+    assert model.reap_rooms()["expired"] >= 5
+    _flush()
+    assert all(_room_row(room_id) == (None, 0) for room_id in rooms)
+
+
+class _JoinAfterSelect:
+    """Connection that touches a room right after the reaper's SELECT"""
+
+    def __init__(self, conn, room_id):
+        self.conn = conn
+        self.room_id = room_id
+
+    def execute(self, stmt, params=None):
+        res = self.conn.execute(stmt, params)
+        if self.room_id is not None:
+            room_id, self.room_id = self.room_id, None
+            self.conn.execute(
+                text("UPDATE room SET updated_at = :now WHERE room_id = :room_id"),
+                {"room_id": room_id, "now": model._now()},
+            )
+        return res
+
+
+def test_reap_rooms_returns_only_changed_rooms(monkeypatch):
+    if model.room_registry is not None:
+        pytest.skip("ROOM_REGISTRY reaps rooms in memory")
+    monkeypatch.setattr(model, "room_shards", ShardSet([db.storage]))
+    token = create_user("reaper_race", 1000)
+    rooms = [model.create_room(token, 5003, LiveDifficulty.normal) for _ in range(2)]
+    for room_id in rooms:
+        _age(room_id)
+    now = model._now()
+    with db.engine.begin() as conn:
+        reaped = model._reap_rooms(
+            _JoinAfterSelect(conn, rooms[0]), 1, now - 60, 100, now
+        )
+    assert rooms[0] not in [room_id for room_id, _ in reaped]
+    assert (rooms[1], 5003) in reaped
+    assert _room_row(rooms[0]) == (1, 1)
+    assert _room_row(rooms[1]) == (None, 0)
@@ -0,0 +1,150 @@
+import time
+
+from sqlalchemy import text
+
+from app.db import engine
+from app.model import create_user, get_user_by_token
+from app.registry import DISSOLUTION, JOIN_OK, JOIN_ROOM_FULL, LIVE_START, RoomRegistry
+
+
+def _users(n):
+    return [get_user_by_token(create_user(f"registry_{i}", 1000)) for i in range(n)]
+
+
+def test_registry_lifecycle():
+    registry = RoomRegistry(engine)
+    host, *others = _users(5)
+
+    room_id = registry.create_room(host, 2001, 1)
+    for user in others[:3]:
+        assert registry.join_room(user, room_id, 2) == (JOIN_OK, 2001)
+    assert registry.join_room(others[3], room_id, 1) == (JOIN_ROOM_FULL, 2001)
+    # もういるユーザーの join は何も変えない
+    assert registry.join_room(host, room_id, 3) == (JOIN_OK, 2001)
+    first = registry.wait_room(room_id)[1][0]
+    assert (first.user_id, first.is_host, first.select_difficulty) == (host.id, True, 1)
+    assert (room_id, 2001, 4, 4) in registry.get_room_list(2001)
+
+    # まだ DB には書かれていない
+    with engine.begin() as conn:
+        row = conn.execute(
+            text("SELECT joined_user_count FROM room WHERE room_id=:room_id"),
+            {"room_id": room_id},
+        ).one_or_none()
+    assert row is None
+
+    assert registry.flush() == 1
+    with engine.begin() as conn:
+        row = conn.execute(
+            text(
+                "SELECT joined_user_count, room_status FROM room WHERE room_id=:room_id"
+            ),
+            {"room_id": room_id},
+        ).one()
+        assert tuple(row) == (4, 1)
+        members = conn.execute(
+            text("SELECT user_id FROM room_member WHERE room_id=:room_id"),
+            {"room_id": room_id},
+        ).all()
+        assert len(members) == 4
+
+    registry.start_room(others[0], room_id)  # ホストでなければ無視
+    assert registry.wait_room(room_id)[0] != LIVE_START
+    registry.start_room(host, room_id)
+    assert registry.wait_room(room_id)[0] == LIVE_START
+
+    for i, user in enumerate([host, *others[:3]]):
+        registry.end_room(user, room_id, [i, 0, 0, 0, 0], 100 * i)
+    members, dissolved = registry.result_room(room_id)
+    assert [m.score for m in members] == [0, 100, 200, 300]
+    assert not dissolved  # 最後の end_room で確定済み
+    assert registry.wait_room(room_id)[0] == DISSOLUTION
+
+    registry.leave_room(host, room_id)
+    assert registry.wait_room(room_id)[1][0].is_host
+
+    # 新しいインスタンスが DB から同じ状態を読み直せる
+    registry.stop()
+    with engine.begin() as conn:
+        row = conn.execute(
+            text(
+                "SELECT joined_user_count, room_status FROM room WHERE room_id=:room_id"
+            ),
+            {"room_id": room_id},
+        ).one()
+        assert tuple(row) == (3, DISSOLUTION)
+
+    for user in others[:3]:
+        registry.leave_room(user, room_id)
+    registry.flush()
+    with engine.begin() as conn:
+        row = conn.execute(
+            text("SELECT room_id FROM room WHERE room_id=:room_id"),
+            {"room_id": room_id},
+        ).one_or_none()
+    assert row is None
+
+
+def test_registry_load():
+    host, guest = _users(2)
+    registry = RoomRegistry(engine)
+    room_id = registry.create_room(host, 2002, 1)
+    registry.join_room(guest, room_id, 2)
+    registry.stop()
+
+    reloaded = RoomRegistry(engine)
+    status, members = reloaded.wait_room(room_id)
+    assert status == 1
+    assert [(m.user_id, m.is_host) for m in members] == [
+        (host.id, True),
+        (guest.id, False),
+    ]
+    assert reloaded.create_room(host, 2002, 1) > room_id
+
+
+def test_registry_load_keeps_room_list_order():
+    (host,) = _users(1)
+    registry = RoomRegistry(engine)
+    room_ids = [registry.create_room(host, 2004, 1) for _ in range(4)]
+    registry.stop()
+    # 後のルームほど古くして, updated_at の順に読まれても room_id 順にならないようにする
+    with engine.begin() as conn:
+        for i, room_id in enumerate(room_ids):
+            conn.execute(
+                text("UPDATE room SET updated_at = :t WHERE room_id=:room_id"),
+                {"room_id": room_id, "t": 1000 - i},
+            )
+
+    reloaded = RoomRegistry(engine)
+    first = reloaded.get_room_list(2004, 0, 2)
+    second = reloaded.get_room_list(2004, first[-1][0], 2)
+    assert [row[0] for row in first + second] == room_ids
+
+
+def test_registry_flush_thread_survives_errors(monkeypatch):
+    (host,) = _users(1)
+    registry = RoomRegistry(engine, flush_interval=0.01)
+    write = registry._write
+    calls = []
+
+    def failing_write(batch):
+        calls.append(len(batch))
+        if len(calls) == 1:
+            raise RuntimeError("database went away")
+        write(batch)
+
+    monkeypatch.setattr(registry, "_write", failing_write)
+    registry.start()
+    room_id = registry.create_room(host, 2003, 1)
+    deadline = time.monotonic() + 5
+    while len(calls) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    registry.stop()
+    assert len(calls) >= 2
+    assert room_id not in registry._dirty
+    with engine.begin() as conn:
+        row = conn.execute(
+            text("SELECT live_id FROM room WHERE room_id=:room_id"),
+            {"room_id": room_id},
+        ).one()
+    assert row[0] == 2003
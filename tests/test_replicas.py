@@ -0,0 +1,194 @@
+import sqlite3
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from app import config, db, model
+from app.api import app
+from app.model import JoinRoomResult, LiveDifficulty
+from app.replicas import ReplicaSet
+from app.sharding import ShardSet
+from app.storage import create_storage
+
+client = TestClient(app)
+
+
+def _sqlite(path, use_async=False):
+    return create_storage(
+        f"sqlite:///{path}",
+        None,
+        use_async,
+        QueuePool,
+        AsyncAdaptedQueuePool,
+        future=True,
+    )
+
+
+def _copy(src_conn, path):
+    # レプリケーションの代わりに主 DB を丸ごと写す
+    dst = sqlite3.connect(path)
+    try:
+        src_conn.backup(dst)
+    finally:
+        dst.close()
+
+
+def _lag(storage, seconds):
+    with storage.engine.begin() as conn:
+        conn.execute(text("UPDATE replica_heartbeat SET ts = ts - :s"), {"s": seconds})
+
+
+def test_replica_routing(tmp_path):
+    primary = _sqlite(tmp_path / "primary.db")
+    # 同じファイルを開くのは遅れのないレプリカ, コピーは写すまで遅れる
+    same = _sqlite(tmp_path / "primary.db")
+    copy = _sqlite(tmp_path / "copy.db")
+    replicas = ReplicaSet(primary, [same, copy], max_lag=5.0, check_interval=5.0)
+    try:
+        # 遅延を測るまではレプリカを使わない
+        assert replicas.engine("token") is primary.engine
+        assert replicas.check()[0] < 1.0 and replicas.lags[1] == float("inf")
+        assert {replicas.engine("token") for _ in range(4)} == {same.engine}
+
+        replicas.pin("token")
+        assert replicas.engine("token", ("room", 1)) is primary.engine
+        assert replicas.engine("other") is same.engine
+
+        raw = primary.engine.raw_connection()
+        try:
+            _copy(raw.dbapi_connection, tmp_path / "copy.db")
+        finally:
+            raw.close()
+        replicas.check()
+        engines = [replicas.engine("other") for _ in range(4)]
+        assert set(engines) == {same.engine, copy.engine}
+
+        _lag(copy, 60)
+        assert replicas.check()[1] > 50
+        assert {replicas.engine("other") for _ in range(4)} == {same.engine}
+
+        # 使えるレプリカがなければ主 DB
+        lagging = ReplicaSet(primary, [copy], max_lag=5.0, check_interval=5.0)
+        assert lagging.check()[0] > 50
+        assert lagging.engine("other") is primary.engine
+        assert lagging.status()["lagging_reads"] == 1
+    finally:
+        for storage in (primary, same, copy):
+            storage.engine.dispose()
+
+
+@pytest.fixture
+def replica(tmp_path, monkeypatch):
+    if model.room_registry is not None:
+        pytest.skip("ROOM_REGISTRY keeps rooms in memory")
+    if db.storage.name != "sqlite":
+        pytest.skip("stand-in replicas copy a SQLite main database")
+    path = tmp_path / "replica.db"
+    storage = _sqlite(path, config.DB_ASYNC)
+    replicas = ReplicaSet(db.storage, [storage], max_lag=5.0, check_interval=5.0)
+
+    def replicate():
+        # 写す主 DB に新しいハートビートを入れておく
+        replicas.check()
+        raw = db.engine.raw_connection()
+        try:
+            _copy(raw.dbapi_connection, path)
+        finally:
+            raw.close()
+        replicas.check()
+
+    monkeypatch.setattr(model, "replicas", replicas)
+    monkeypatch.setattr(model, "room_shards", ShardSet([db.storage]))
+    model.room_events.subscribe(model._pin_changed)
+    yield replicas, replicate
+    model.room_events.unsubscribe(model._pin_changed)
+    storage.engine.dispose()
+
+
+def _wait(token, room_id):
+    res = client.post(
+        "/room/wait",
+        headers={"Authorization": f"bearer {token}"},
+        json={"room_id": room_id},
+    )
+    assert res.status_code == 200
+    return [u["user_id"] for u in res.json()["room_user_list"]]
+
+
+def test_read_your_writes(replica):
+    replicas, replicate = replica
+    normal = LiveDifficulty.normal
+    a, b = model.create_users([("replica_a", 1), ("replica_b", 1)])
+    room_id = model.create_room(a, 9501, normal)
+    replicate()
+    assert replicas.pinned(a, ("room", room_id), ("lobby", 9501))
+    replicas._pins.clear()  # 固定の期限が切れたことにする
+
+    assert model.join_room(b, room_id, normal) == JoinRoomResult.Ok
+    # 変わったばかりのルームとロビーは主 DB から
+    assert len(_wait(a, room_id)) == 2
+    assert model.get_room_list(a, 9501)[0][0].joined_user_count == 2
+
+    # 固定が切れると, まだ 1 人のレプリカから
+    replicas._pins.clear()
+    model.room_list_cache.clear()
+    reads = replicas.replica_reads
+    assert len(_wait(a, room_id)) == 1
+    assert model.get_room_list(a, 9501)[0][0].joined_user_count == 1
+    assert replicas.replica_reads > reads
+
+    # 遅れたレプリカは使わない
+    _lag(replicas.replicas[0], 60)
+    replicas.check()
+    assert len(_wait(a, room_id)) == 2
+    replicate()
+    reads = replicas.replica_reads
+    assert len(_wait(a, room_id)) == 2
+    assert replicas.replica_reads > reads
+
+    # 書いた token は自分の書き込みを読む
+    model.update_user(a, "replica_a2", 2)
+    model.user_cache.clear()
+    assert model.get_user_by_token(a).name == "replica_a2"
+    replicas._pins.clear()
+    model.user_cache.clear()
+    assert model.get_user_by_token(a).name == "replica_a"
+    # レプリカにまだいないユーザーは主 DB から
+    c = model.create_user("replica_c", 1)
+    replicas._pins.clear()
+    model.user_cache.clear()
+    assert model.get_user_by_token(c).name == "replica_c"
+
+    # スコアが揃ったかはレプリカで見て, 揃っていたら主 DB で確定する
+    model.start_room(a, room_id)
+    model.end_rooms([(room_id, t, [1, 0, 0, 0, 0], 100) for t in (a, b)])
+    assert replicas.pinned(("room", room_id))
+    replicas._pins.clear()
+    model.result_cache.clear()
+    assert model.result_room(a, room_id) == []
+    replicate()
+    assert [r.score for r in model.result_room(a, room_id)] == [100, 100]
+
+
+def test_result_reads_pinned_room(replica):
+    replicas, replicate = replica
+    normal = LiveDifficulty.normal
+    a, b = model.create_users([("replica_d", 1), ("replica_e", 1)])
+    room_id = model.create_room(a, 9502, normal)
+    assert model.join_room(b, room_id, normal) == JoinRoomResult.Ok
+    model.start_room(a, room_id)
+    replicate()
+
+    # 終わったばかりのルームはレプリカに写る前でも主 DB で結果が出る
+    model.end_rooms([(room_id, t, [1, 0, 0, 0, 0], 200) for t in (a, b)])
+    model.result_cache.clear()
+    reads = replicas.pinned_reads
+    res = client.post(
+        "/room/result",
+        headers={"Authorization": f"bearer {a}"},
+        json={"room_id": room_id},
+    )
+    assert [u["score"] for u in res.json()["result_user_list"]] == [200, 200]
+    assert replicas.pinned_reads > reads
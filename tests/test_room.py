@@ -1,5 +1,9 @@
+import time
+
+import pytest
 from fastapi.testclient import TestClient
 
+from app import amodel, config, model
 from app.api import app
 
 client = TestClient(app)
@@ -65,3 +69,331 @@ def test_room_1():
     )
     assert response.status_code == 200
     print("room/end response:", response.json())
+
+
+def test_room_wait_long_poll():
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(1),
+        json={"live_id": 1002, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+
+    response = client.post(
+        "/room/wait", headers=_auth_header(1), json={"room_id": room_id}
+    )
+    assert response.status_code == 200
+    version = int(response.headers["X-Room-Version"])
+
+    # 古いバージョンを渡すとすぐ返る
+    response = client.post(
+        f"/room/wait?version={version - 1}&timeout=10",
+        headers=_auth_header(1),
+        json={"room_id": room_id},
+    )
+    assert int(response.headers["X-Room-Version"]) == version
+
+    # 変化がなければ timeout で返る
+    response = client.post(
+        f"/room/wait?version={version}&timeout=0.1",
+        headers=_auth_header(1),
+        json={"room_id": room_id},
+    )
+    assert response.status_code == 200
+    assert int(response.headers["X-Room-Version"]) == version
+
+
+def test_room_conditional_polls(monkeypatch):
+    tokens = [
+        client.post(
+            "/user/create", json={"user_name": f"etag_{i}", "leader_card_id": 1}
+        ).json()["user_token"]
+        for i in range(2)
+    ]
+    headers = [{"Authorization": f"bearer {token}"} for token in tokens]
+    list_body = {"live_id": 1009}
+    room_list = client.post("/room/list", headers=headers[1], json=list_body)
+    room_id = client.post(
+        "/room/create",
+        headers=headers[0],
+        json={"live_id": 1009, "select_difficulty": 1},
+    ).json()["room_id"]
+    wait = client.post("/room/wait", headers=headers[0], json={"room_id": room_id})
+    etag = wait.headers["ETag"]
+
+    def poll(path, i, etag, body=None):
+        return client.post(
+            path,
+            headers={**headers[i], "If-None-Match": etag},
+            json=body or {"room_id": room_id},
+        )
+
+    async def no_db(*args):
+        raise AssertionError("read the room for a 304")
+
+    with monkeypatch.context() as m:
+        m.setattr(amodel, "wait_room", no_db)
+        response = poll("/room/wait", 0, etag)
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["X-Room-Version"] == wait.headers["X-Room-Version"]
+    # is_me が違うので他のユーザーには使えない
+    assert poll("/room/wait", 1, etag).status_code == 200
+    # ルームが作られたので一覧は変わっている
+    response = poll("/room/list", 1, room_list.headers["ETag"], list_body)
+    assert response.status_code == 200
+    list_etag = response.headers["ETag"]
+    assert poll("/room/list", 1, list_etag, list_body).status_code == 304
+
+    client.post(
+        "/room/join",
+        headers=headers[1],
+        json={"room_id": room_id, "select_difficulty": 1},
+    )
+    response = poll("/room/wait", 0, etag)
+    assert response.status_code == 200
+    assert len(response.json()["room_user_list"]) == 2
+    assert response.headers["ETag"] != etag
+    assert poll("/room/list", 1, list_etag, list_body).status_code == 200
+
+    client.post("/room/start", headers=headers[0], json={"room_id": room_id})
+    result = poll("/room/result", 0, 'W/"none"')
+    assert result.json()["result_user_list"] == []
+    assert poll("/room/result", 0, result.headers["ETag"]).status_code == 304
+    for token_headers in headers:
+        client.post(
+            "/room/end",
+            headers=token_headers,
+            json={"room_id": room_id, "score": 1, "judge_count_list": [1, 0, 0, 0, 0]},
+        )
+    if model.score_buffer is not None:
+        model.score_buffer.flush()
+    # リザルトが揃ったら古い ETag では 304 にならない
+    response = poll("/room/result", 0, result.headers["ETag"])
+    assert response.status_code == 200
+    assert len(response.json()["result_user_list"]) == 2
+    assert poll("/room/result", 0, response.headers["ETag"]).status_code == 304
+
+
+def test_room_etag_expires_with_any_event_bus(monkeypatch):
+    if model.room_registry is not None:
+        pytest.skip("ROOM_REGISTRY versions every change itself")
+    # ワーカー間のバスでもイベントを取りこぼしうる
+    monkeypatch.setattr(config, "EVENT_BUS", "unix")
+    monkeypatch.setattr(config, "ETAG_MAX_AGE", 0.05)
+    room_id = client.post(
+        "/room/create",
+        headers=_auth_header(0),
+        json={"live_id": 1010, "select_difficulty": 1},
+    ).json()["room_id"]
+    etag = client.post(
+        "/room/wait", headers=_auth_header(0), json={"room_id": room_id}
+    ).headers["ETag"]
+    time.sleep(0.1)
+    response = client.post(
+        "/room/wait",
+        headers={**_auth_header(0), "If-None-Match": etag},
+        json={"room_id": room_id},
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_room_etag_survives_advised_poll_delay():
+    # 既定の設定のまま, next_poll_delay_ms だけ待って次のポーリングをする
+    room_id = client.post(
+        "/room/create",
+        headers=_auth_header(1),
+        json={"live_id": 1011, "select_difficulty": 1},
+    ).json()["room_id"]
+    response = client.post(
+        "/room/wait", headers=_auth_header(1), json={"room_id": room_id}
+    )
+    etag = response.headers["ETag"]
+    delay_ms = response.json()["next_poll_delay_ms"]
+    for _ in range(2):
+        time.sleep(delay_ms / 1000)
+        response = client.post(
+            "/room/wait",
+            headers={**_auth_header(1), "If-None-Match": etag},
+            json={"room_id": room_id},
+        )
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        delay_ms = int(response.headers["X-Next-Poll-Delay-Ms"])
+
+
+def test_room_ws():
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(2),
+        json={"live_id": 1003, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+
+    with client.websocket_connect(f"/room/ws/{room_id}?token={user_tokens[2]}") as ws:
+        data = ws.receive_json()
+        assert data["status"] == 1
+        assert len(data["room_user_list"]) == 1
+
+        response = client.post(
+            "/room/join",
+            headers=_auth_header(3),
+            json={"room_id": room_id, "select_difficulty": 2},
+        )
+        assert response.json()["join_room_result"] == 1
+        data = ws.receive_json()
+        assert len(data["room_user_list"]) == 2
+
+        client.post("/room/start", headers=_auth_header(2), json={"room_id": room_id})
+        data = ws.receive_json()
+        assert data["status"] == 2
+
+
+def test_room_list_pagination():
+    hosts = {}
+    for i in range(3):
+        response = client.post(
+            "/room/create",
+            headers=_auth_header(4 + i),
+            json={"live_id": 1004, "select_difficulty": 1},
+        )
+        hosts[response.json()["room_id"]] = 4 + i
+    # 一覧は room_id 順 (シャードがあると作った順とは限らない)
+    room_ids = sorted(hosts)
+
+    response = client.post(
+        "/room/list", headers=_auth_header(), json={"live_id": 1004, "limit": 2}
+    )
+    data = response.json()
+    assert [r["room_id"] for r in data["room_info_list"]] == room_ids[:2]
+    assert data["next_cursor"] == room_ids[1]
+
+    response = client.post(
+        "/room/list",
+        headers=_auth_header(),
+        json={"live_id": 1004, "limit": 2, "cursor": data["next_cursor"]},
+    )
+    data = response.json()
+    assert [r["room_id"] for r in data["room_info_list"]] == room_ids[2:]
+    assert data["next_cursor"] is None
+
+    # start するとキャッシュが捨てられて一覧から消える
+    client.post(
+        "/room/start",
+        headers=_auth_header(hosts[room_ids[0]]),
+        json={"room_id": room_ids[0]},
+    )
+    response = client.post(
+        "/room/list", headers=_auth_header(), json={"live_id": 1004, "limit": 2}
+    )
+    assert [r["room_id"] for r in response.json()["room_info_list"]] == room_ids[1:]
+
+
+def test_room_result_final():
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(0),
+        json={"live_id": 1005, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+    client.post(
+        "/room/join",
+        headers=_auth_header(1),
+        json={"room_id": room_id, "select_difficulty": 1},
+    )
+    client.post("/room/start", headers=_auth_header(0), json={"room_id": room_id})
+
+    client.post(
+        "/room/end",
+        headers=_auth_header(0),
+        json={"room_id": room_id, "score": 100, "judge_count_list": [1, 0, 0, 0, 0]},
+    )
+    response = client.post(
+        "/room/result", headers=_auth_header(0), json={"room_id": room_id}
+    )
+    assert response.json()["result_user_list"] == []
+
+    client.post(
+        "/room/end",
+        headers=_auth_header(1),
+        json={"room_id": room_id, "score": 200, "judge_count_list": [2, 0, 0, 0, 0]},
+    )
+    # 先に抜けた人がいても確定したリザルトは変わらない
+    client.post("/room/leave", headers=_auth_header(1), json={"room_id": room_id})
+    response = client.post(
+        "/room/result", headers=_auth_header(0), json={"room_id": room_id}
+    )
+    result = {r["user_id"]: r["score"] for r in response.json()["result_user_list"]}
+    assert sorted(result.values()) == [100, 200]
+
+
+def test_room_end_rejects_bad_judge_count_list():
+    response = client.post(
+        "/room/end",
+        headers=_auth_header(0),
+        json={"room_id": 1, "score": 100, "judge_count_list": [1, 0, 0, 0]},
+    )
+    assert response.status_code == 422
+    response = client.post(
+        "/room/end_batch",
+        json={
+            "results": [
+                {
+                    "room_id": 1,
+                    "user_token": "x",
+                    "score": 100,
+                    "judge_count_list": [1, 0, 0, 0, 0, 0],
+                }
+            ]
+        },
+    )
+    assert response.status_code == 422
+
+
+def test_room_end_batch():
+    room_ids = []
+    for i in (0, 2):
+        response = client.post(
+            "/room/create",
+            headers=_auth_header(i),
+            json={"live_id": 1006, "select_difficulty": 1},
+        )
+        room_id = response.json()["room_id"]
+        client.post(
+            "/room/join",
+            headers=_auth_header(i + 1),
+            json={"room_id": room_id, "select_difficulty": 1},
+        )
+        client.post("/room/start", headers=_auth_header(i), json={"room_id": room_id})
+        room_ids.append(room_id)
+
+    response = client.post(
+        "/room/end_batch",
+        json={
+            "results": [
+                {
+                    "room_id": room_ids[i // 2],
+                    "user_token": user_tokens[i],
+                    "judge_count_list": [i, 0, 0, 0, 0],
+                    "score": 100 * i,
+                }
+                for i in range(4)
+            ]
+            + [
+                {
+                    "room_id": room_ids[0],
+                    "user_token": "unknown",
+                    "judge_count_list": [0, 0, 0, 0, 0],
+                    "score": 0,
+                }
+            ]
+        },
+    )
+    assert response.json()["stored"] == 4
+
+    response = client.post(
+        "/room/result", headers=_auth_header(2), json={"room_id": room_ids[1]}
+    )
+    scores = sorted(r["score"] for r in response.json()["result_user_list"])
+    assert scores == [200, 300]
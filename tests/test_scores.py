@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from app import api, model
+from app.model import LiveDifficulty, create_user
+from app.scores import ScoreBuffer
+
+
+def test_coalesce_and_backpressure():
+    written = []
+    buffer = ScoreBuffer(lambda batch: written.append(batch) or len(batch), 60, 2)
+    assert not buffer.submit(1, "a", [1, 0, 0, 0, 0], 10)
+    assert not buffer.submit(1, "a", [2, 0, 0, 0, 0], 20)  # 同じ人の上書き
+    assert buffer.has_pending(1) and not buffer.has_pending(2)
+    assert buffer.submit(2, "b", [3, 0, 0, 0, 0], 30)  # 上限: 呼び出し側で書く
+    assert buffer.flush() == 2
+    assert sorted(written[0]) == [
+        (1, "a", [2, 0, 0, 0, 0], 20),
+        (2, "b", [3, 0, 0, 0, 0], 30),
+    ]
+    assert not buffer.has_pending(1) and len(buffer) == 0
+    assert buffer.flush() == 0
+
+
+def test_failed_flush_keeps_scores():
+    fail = [True]
+    written = []
+
+    def write(batch):
+        if fail[0]:
+            # 書いている間に同じ人が送り直した
+            buffer.submit(1, "a", [9, 0, 0, 0, 0], 90)
+            raise RuntimeError("db down")
+        written.extend(batch)
+        return len(batch)
+
+    buffer = ScoreBuffer(write, 60)
+    buffer.submit(1, "a", [1, 0, 0, 0, 0], 10)
+    buffer.submit(1, "b", [1, 0, 0, 0, 0], 11)
+    with pytest.raises(RuntimeError):
+        buffer.flush()
+    assert buffer.has_pending(1) and len(buffer) == 2
+    fail[0] = False
+    buffer.stop()  # 止めるときに残りを書き切る
+    assert sorted(written) == [
+        (1, "a", [9, 0, 0, 0, 0], 90),
+        (1, "b", [1, 0, 0, 0, 0], 11),
+    ]
+    assert not buffer.has_pending(1)
+
+
+def test_broken_score_is_dropped():
+    written = []
+
+    def write(batch):
+        for entry in batch:
+            entry[2][4]  # model.end_rooms と同じく 5 個目を読む
+        written.extend(batch)
+        return len(batch)
+
+    buffer = ScoreBuffer(write, 60)
+    buffer.submit(1, "a", [1, 0, 0, 0, 0], 10)
+    buffer.submit(1, "b", [1, 0, 0], 11)
+    buffer.submit(2, "c", [1, 0, 0, 0, 0], 12)
+    assert buffer.flush() == 2
+    assert [e[1] for e in written] == ["a", "c"]
+    assert buffer.dropped == 1
+    assert len(buffer) == 0 and not buffer.has_pending(1)
+
+    buffer.submit(1, "b", [2, 0, 0, 0, 0], 13)
+    assert buffer.flush() == 1
+
+
+def test_result_reads_through_buffer(monkeypatch):
+    buffer = ScoreBuffer(model.end_rooms, 60)
+    monkeypatch.setattr(model, "score_buffer", buffer)
+    host, guest = [create_user(f"score_buffer_{i}", 1000) for i in range(2)]
+    normal = LiveDifficulty.normal
+    room_id = model.create_room(host, 9401, normal)
+    model.join_room(guest, room_id, normal)
+    model.start_room(host, room_id)
+
+    model.end_room(host, room_id, [1, 2, 3, 4, 5], 100)
+    model.end_room(guest, room_id, [5, 4, 3, 2, 1], 200)
+    assert len(buffer) == 2  # まだ書いていない
+    result = model.result_room(host, room_id)
+    assert len(buffer) == 0
+    assert sorted(r.score for r in result) == [100, 200]
+
+    # leave の前にも書く (抜けた後では room_member がない)
+    room_id = model.create_room(host, 9401, normal)
+    model.start_room(host, room_id)
+    model.end_room(host, room_id, [1, 0, 0, 0, 0], 300)
+    model.leave_room(host, room_id)
+    assert len(buffer) == 0
+    if model.room_registry is not None:
+        model.room_registry.flush()
+    model.refresh_ranking()
+    top, me = model.get_ranking(host, 9401)
+    assert me.score == 300
+
+
+def test_failed_score_stop_still_stops_registry(monkeypatch):
+    calls = []
+
+    class Broken:
+        def stop(self):
+            calls.append("score_buffer")
+            raise RuntimeError("flush failed")
+
+    class Recording:
+        def stop(self):
+            calls.append("room_registry")
+
+    monkeypatch.setattr(model, "score_buffer", Broken())
+    monkeypatch.setattr(model, "room_registry", Recording())
+    monkeypatch.setattr(api, "async_engine", None)
+    asyncio.run(api.shutdown())
+    assert calls == ["score_buffer", "room_registry"]
@@ -0,0 +1,123 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from app import db, model
+from app.leaderboard import Leaderboards
+from app.model import JoinRoomResult, LiveDifficulty, create_user
+from app.sharding import SHARD_STRIDE, ShardSet, shard_of
+from app.storage import create_storage
+
+pytestmark = pytest.mark.skipif(
+    model.room_registry is not None, reason="ROOM_REGISTRY keeps rooms in memory"
+)
+
+
+@pytest.fixture
+def shards(tmp_path, monkeypatch):
+    # 主 DB + SQLite ファイル 2 つ
+    storages = [db.storage] + [
+        create_storage(
+            f"sqlite:///{tmp_path}/shard{i}.db",
+            None,
+            False,
+            QueuePool,
+            AsyncAdaptedQueuePool,
+            future=True,
+        )
+        for i in (1, 2)
+    ]
+    shard_set = ShardSet(storages)
+    monkeypatch.setattr(model, "room_shards", shard_set)
+    monkeypatch.setattr(model, "leaderboards", Leaderboards(0, 1000))
+    yield shard_set
+    for storage in storages[1:]:
+        storage.engine.dispose()
+
+
+def _rooms_on(shard, live_id):
+    with shard.engine.begin() as conn:
+        return [
+            row[0]
+            for row in conn.execute(
+                text("SELECT room_id FROM room WHERE live_id = :live_id"),
+                {"live_id": live_id},
+            )
+        ]
+
+
+def test_room_ids_encode_their_shard(shards):
+    tokens = [create_user(f"shard_{i}", 1000) for i in range(4)]
+    normal = LiveDifficulty.normal
+    room_ids = [model.create_room(token, 9201, normal) for token in tokens[:3]]
+
+    assert sorted(shard_of(room_id) for room_id in room_ids) == [0, 1, 2]
+    for shard in shards:
+        assert _rooms_on(shard, 9201) == [
+            room_id for room_id in room_ids if shard_of(room_id) == shard.index
+        ]
+
+    # user は主 DB にしかない. キャッシュになくても引ける
+    room_id = next(room_id for room_id in room_ids if shard_of(room_id) == 2)
+    model.user_cache.pop(tokens[3])
+    assert model.join_room(tokens[3], room_id, normal) == JoinRoomResult.Ok
+    status, users = model.wait_room(tokens[3], room_id)
+    assert [u.is_me for u in users] == [False, True]
+
+    model.start_room(tokens[2], room_id)
+    model.end_room(tokens[2], room_id, [1, 0, 0, 0, 0], 100)
+    model.end_rooms([(room_id, tokens[3], [2, 0, 0, 0, 0], 200)])
+    assert [r.score for r in model.result_room(tokens[3], room_id)] == [100, 200]
+
+    top, me = model.get_ranking(tokens[3], 9201)
+    assert [(u.rank, u.score) for u in top] == [(1, 200), (2, 100)]
+
+    model.leave_room(tokens[3], room_id)
+    model.leave_room(tokens[2], room_id)
+    assert _rooms_on(shards.shards[2], 9201) == []
+    assert model.count_rooms().get(1, 0) >= 2
+
+
+def test_room_list_gathers_every_shard(shards):
+    token = create_user("shard_list", 1000)
+    room_ids = sorted(
+        model.create_room(token, 9202, LiveDifficulty.normal) for _ in range(5)
+    )
+    assert len({shard_of(room_id) for room_id in room_ids}) == 3
+
+    seen = []
+    cursor = None
+    while True:
+        rooms, cursor = model.get_room_list(token, 9202, cursor, 2)
+        seen += [room.room_id for room in rooms]
+        if cursor is None:
+            break
+    assert seen == room_ids
+
+
+def test_unknown_shard_is_a_missing_room(shards):
+    token = create_user("shard_unknown", 1000)
+    room_id = 7 * SHARD_STRIDE + 1
+    assert shards.for_room(room_id).index == 0
+    assert model.join_room(token, room_id, LiveDifficulty.normal) == (
+        JoinRoomResult.Disbanned
+    )
+
+
+def test_start_ids_at_is_idempotent(tmp_path):
+    storage = create_storage(
+        f"sqlite:///{tmp_path}/ids.db",
+        None,
+        False,
+        QueuePool,
+        AsyncAdaptedQueuePool,
+        future=True,
+    )
+    storage.start_ids_at("room", 5 * SHARD_STRIDE)
+    storage.start_ids_at("room", 5 * SHARD_STRIDE)
+    with storage.engine.begin() as conn:
+        conn.execute(text("INSERT INTO room (live_id) VALUES (1)"))
+        assert conn.execute(text("SELECT room_id FROM room")).scalar() == (
+            5 * SHARD_STRIDE + 1
+        )
+    storage.engine.dispose()
@@ -0,0 +1,89 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from app.storage import (
+    SQLiteStorage,
+    Storage,
+    begin_read,
+    create_storage,
+    sqlite_schema,
+)
+
+
+def _tables(engine):
+    with engine.begin() as conn:
+        rows = conn.execute(
+            text("SELECT name FROM sqlite_master WHERE type IN ('table', 'index')")
+        ).all()
+    return {name for name, in rows}
+
+
+def test_sqlite_schema():
+    statements = sqlite_schema()
+    assert not any(s.upper().startswith("DROP") for s in statements)
+    assert any("INTEGER PRIMARY KEY AUTOINCREMENT" in s for s in statements)
+    assert any("`live_id_room_status` ON `room`" in s for s in statements)
+
+
+def test_sqlite_memory_bootstrap():
+    storage = create_storage("sqlite://", None, False, QueuePool, AsyncAdaptedQueuePool)
+    assert isinstance(storage, SQLiteStorage)
+    assert storage.async_engine is None
+    assert {"user", "room", "room_member", "live_id_room_status"} <= _tables(
+        storage.engine
+    )
+
+
+def test_sqlite_file_keeps_data(tmp_path):
+    uri = f"sqlite:///{tmp_path / 'game.db'}"
+    storage = create_storage(uri, None, False, QueuePool, AsyncAdaptedQueuePool)
+    with storage.engine.begin() as conn:
+        conn.execute(text("INSERT INTO `room` (live_id) VALUES (1)"))
+        mode = conn.execute(text("PRAGMA journal_mode")).scalar()
+    assert mode == "wal"
+    storage.engine.dispose()
+
+    # 2回目の起動でもスキーマを作り直さない
+    storage = create_storage(uri, None, False, QueuePool, AsyncAdaptedQueuePool)
+    with storage.engine.begin() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM room")).scalar() == 1
+
+
+def test_sqlite_reads_do_not_take_the_write_lock(tmp_path):
+    uri = f"sqlite:///{tmp_path / 'game.db'}"
+    storage = SQLiteStorage(
+        uri, QueuePool, AsyncAdaptedQueuePool, busy_timeout=0.1, future=True
+    )
+    storage.bootstrap()
+    with storage.engine.begin() as writer:
+        writer.execute(text("INSERT INTO `room` (live_id) VALUES (1)"))
+        # 書き込み中でも読み込みは待たない
+        with begin_read(storage.engine) as conn:
+            assert conn.execute(text("SELECT COUNT(*) FROM room")).scalar() == 0
+        # 書き込みどうしは BEGIN IMMEDIATE で待つ
+        with pytest.raises(OperationalError):
+            with storage.engine.begin() as conn:
+                pass
+    storage.engine.dispose()
+
+
+def test_storage_is_abstract():
+    with pytest.raises(TypeError):
+        Storage()
+
+
+def test_sqlite_room_list_sorts_with_an_index():
+    storage = create_storage("sqlite://", None, False, QueuePool, AsyncAdaptedQueuePool)
+    with storage.engine.begin() as conn:
+        for live_id in (0, 1):
+            where = "live_id = 1 AND " if live_id else ""
+            plan = conn.execute(
+                text(
+                    "EXPLAIN QUERY PLAN SELECT room_id FROM room WHERE "
+                    + where
+                    + "room_status = 1 AND room_id > 0 ORDER BY room_id LIMIT 10"
+                )
+            ).all()
+            assert not any("TEMP B-TREE" in row[-1] for row in plan)
@@ -0,0 +1,105 @@
+import asyncio
+import json
+
+import httpx
+from fastapi.testclient import TestClient
+
+from app.api import app
+from app.trace import TraceMiddleware, TraceRecorder
+from bench.replay import Replay, close_app_engines, load
+
+
+def _headers(token):
+    return {"Authorization": f"bearer {token}"}
+
+
+def _record(path):
+    recorder = TraceRecorder(str(path), key="test")
+    client = TestClient(TraceMiddleware(app, recorder))
+    tokens = [
+        client.post(
+            "/user/create", json={"user_name": f"trace_{i}", "leader_card_id": 1}
+        ).json()["user_token"]
+        for i in range(2)
+    ]
+    room_id = client.post(
+        "/room/create",
+        headers=_headers(tokens[0]),
+        json={"live_id": 7101, "select_difficulty": 1},
+    ).json()["room_id"]
+    client.post(
+        "/room/join",
+        headers=_headers(tokens[1]),
+        json={"room_id": room_id, "select_difficulty": 1},
+    )
+    client.post("/room/wait", headers=_headers(tokens[1]), json={"room_id": room_id})
+    client.post("/room/start", headers=_headers(tokens[0]), json={"room_id": room_id})
+    client.post(
+        "/room/end_batch",
+        json={
+            "results": [
+                {
+                    "room_id": room_id,
+                    "user_token": token,
+                    "judge_count_list": [1, 0, 0, 0, 0],
+                    "score": 100,
+                }
+                for token in tokens
+            ]
+        },
+    )
+    client.post("/room/result", headers=_headers(tokens[0]), json={"room_id": room_id})
+    client.get("/metrics")
+    assert recorder.flush() == 8
+    return recorder, tokens, room_id
+
+
+def test_trace_recorder(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    recorder, tokens, room_id = _record(path)
+    text = path.read_text()
+    assert all(token not in text for token in tokens)
+
+    entries = [json.loads(line) for line in text.splitlines()]
+    assert [e["route"] for e in entries] == [
+        "/user/create",
+        "/user/create",
+        "/room/create",
+        "/room/join",
+        "/room/wait",
+        "/room/start",
+        "/room/end_batch",
+        "/room/result",
+    ]
+    assert all(e["status"] == 200 and e["latency"] > 0 for e in entries)
+    create, join = entries[2], entries[3]
+    assert create["room_id"] == room_id
+    assert create["token"] == recorder.anonymize(tokens[0])
+    assert join["token"] == recorder.anonymize(tokens[1])
+    assert join["body"] == {"room_id": room_id, "select_difficulty": 1}
+    batch = entries[6]["body"]["results"]
+    assert [r["user_token"] for r in batch] == [create["token"], join["token"]]
+
+
+def test_replay(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    _, _, room_id = _record(path)
+    entries = load(str(path))
+
+    async def replay():
+        async with httpx.AsyncClient(app=app, base_url="http://replay") as client:
+            r = Replay(client, entries, speed=100)
+            await r.setup()
+            report = r.report(await r.run())
+        await close_app_engines()
+        return r, report
+
+    r, report = asyncio.run(replay())
+    assert report["requests"] == 8
+    assert report["users"] == 2
+    assert report["errors"] == 0
+    assert sum(row["status_mismatch"] for row in report["routes"].values()) == 0
+    # 再生では新しいルームができて, 後のリクエストはそちらへ行く
+    new_room_id = r.rooms[room_id].result()
+    assert new_room_id is not None and new_room_id != room_id
+    assert report["routes"]["/room/result"]["count"] == 1
@@ -23,3 +23,45 @@ def test_create_user():
     assert response_data.keys() == {"id", "name", "leader_card_id"}
     assert response_data["name"] == "test1"
     assert response_data["leader_card_id"] == 1000
+
+
+def test_update_user():
+    response = client.post(
+        "/user/create", json={"user_name": "test2", "leader_card_id": 1000}
+    )
+    token = response.json()["user_token"]
+    headers = {"Authorization": f"bearer {token}"}
+
+    response = client.get("/user/me", headers=headers)
+    assert response.json()["name"] == "test2"
+
+    response = client.post(
+        "/user/update",
+        headers=headers,
+        json={"user_name": "test2-renamed", "leader_card_id": 2000},
+    )
+    assert response.status_code == 200
+
+    # キャッシュが無効化されているので更新後の値が返る
+    response = client.get("/user/me", headers=headers)
+    response_data = response.json()
+    assert response_data["name"] == "test2-renamed"
+    assert response_data["leader_card_id"] == 2000
+
+
+def test_create_user_batch():
+    response = client.post(
+        "/user/create_batch",
+        json={
+            "users": [
+                {"user_name": f"batch{i}", "leader_card_id": 1000 + i} for i in range(5)
+            ]
+        },
+    )
+    assert response.status_code == 200
+    tokens = response.json()["user_tokens"]
+    assert len(set(tokens)) == 5
+
+    response = client.get("/user/me", headers={"Authorization": f"bearer {tokens[3]}"})
+    assert response.json()["name"] == "batch3"
+    assert response.json()["leader_card_id"] == 1003